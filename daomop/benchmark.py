@@ -0,0 +1,220 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+import tracemalloc
+
+from astropy.io import fits
+
+from . import sns
+from .planner import peak_rss
+from .synthetic import make_exposures, source_snr
+
+# engines that can be benchmarked, sns is the end-to-end sns.main with the default (shift) engine.
+ENGINES = ('shift', 'tree', 'fourier', 'swarp', 'sns')
+STACK_FUNCTIONS = {'shift': sns.shift, 'tree': sns.tree_shift, 'fourier': sns.fourier_shift}
+# stacking modes of the engines that only combine with running sums.
+STREAMING_MODES = {'tree': ('SUM', 'MEAN'), 'fourier': ('SUM', 'MEAN')}
+
+# the moving source injected into the benchmark exposures, every rate grid includes its rate.
+SOURCE_RATE = {'rate': 3.0, 'angle': 0.0}
+SOURCE_FLUX = 60
+# days between the starts of the benchmark exposures.
+CADENCE = 0.01
+# S/N the source must reach in the stack at its rate to count as recovered.
+RECOVERY_SNR = 5.0
+
+POINTING = '0,0'
+FILTER = 'HSC-R2'
+
+
+def rate_grid(n_rates):
+    """
+    n_rates rates (see sns.shift_rates) at the rate of the injected source, one degree apart in angle, that include
+    the angle of the source.
+    """
+    angle_min = SOURCE_RATE['angle'] - n_rates // 2
+    return sns.shift_rates(SOURCE_RATE['rate'], SOURCE_RATE['rate'], 1,
+                           angle_min, angle_min + n_rates - 1, 1)
+
+
+def benchmark_exposures(workdir, n_exposures, shape):
+    """
+    Write (once) the synthetic exposures of a benchmark in the rerun layout sns.main reads.
+
+    :return: basedir of the exposures, their filenames and the source injected in them.
+    """
+    basedir = os.path.join(workdir, f'{n_exposures}-{shape[0]}x{shape[1]}')
+    dirname = os.path.join(basedir, 'rerun', 'diff', 'deepDiff', POINTING, FILTER)
+    source = dict(SOURCE_RATE, x=shape[1] // 4, y=shape[0] // 2, flux=SOURCE_FLUX)
+    if not os.access(dirname, os.F_OK):
+        os.makedirs(dirname)
+        make_exposures(dirname, n=n_exposures, shape=shape, source=source, cadence=CADENCE)
+    filenames = sorted(os.path.join(dirname, filename) for filename in os.listdir(dirname)
+                       if filename.startswith('DIFF') and filename.endswith('.fits'))
+    return basedir, filenames, source
+
+
+def measure(function, *args, **kwargs):
+    """
+    Call function, timing it and tracing the peak memory allocated while it runs.
+
+    The allocations of worker processes are not traced.
+
+    :return: the result of function and a dict of its wall and cpu time (seconds) and peak_memory (bytes).
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if not tracing:
+            tracemalloc.stop()
+    return result, {'wall': wall, 'cpu': cpu, 'peak_memory': peak}
+
+
+def run_case(workdir, engine, stacking_mode, n_exposures, shape, section_size, n_rates, threads=1, dtype=None):
+    """
+    Time one engine stacking synthetic exposures on a rate grid and check the injected source is recovered.
+
+    The images are read before the clock starts, except by sns, which is timed from the files to the written stacks.
+
+    :param workdir: directory the synthetic exposures (and the outputs of sns) are written in.
+    :param engine: one of ENGINES
+    :param stacking_mode: a key of sns.STACKING_MODES
+    :param n_exposures: number of exposures stacked
+    :param shape: shape of the exposures
+    :param section_size: section size of the stacking
+    :param n_rates: number of rates stacked (see rate_grid)
+    :return: dict of the case, its timing, throughput (pixels * exposures * rates per second) and the S/N of the source
+             in the stack at its rate.
+    """
+    basedir, filenames, source = benchmark_exposures(workdir, n_exposures, shape)
+    rates = rate_grid(n_rates)
+    reference_idx = n_exposures // 2
+    # the source is at its reference position in the stacks.
+    hours = reference_idx * CADENCE * 24
+    logging.info(f'Benchmarking {engine} {stacking_mode} with {n_exposures} exposures, sections of {section_size} '
+                 f'and {n_rates} rates')
+    if engine == 'sns':
+        rerun = f'stack-{stacking_mode}-{n_exposures}-{section_size}-{n_rates}'
+        argv = [basedir, '--pointing', POINTING, '--rerun', f'diff:{rerun}', '--filter', FILTER,
+                '--n-sub-stacks', '1', '--stack-mode', stacking_mode, '--section-size', str(section_size),
+                '--threads', str(threads), '--rate-min', str(SOURCE_RATE['rate']),
+                '--rate-max', str(SOURCE_RATE['rate']), '--rate-step', '1',
+                '--angle-min', str(rates[0]['angle']), '--angle-max', str(rates[-1]['angle']), '--angle-step', '1']
+        if dtype is not None:
+            argv += ['--dtype', dtype]
+        _, timing = measure(sns.main, argv)
+        output_dir = os.path.join(basedir, 'rerun', rerun, 'deepDiff', POINTING, FILTER)
+        reference_filename = os.path.splitext(os.path.basename(filenames[reference_idx]))[0][8:]
+        output_filename = f'STACK-{reference_filename}-00-{SOURCE_RATE["rate"]:+06.2f}-' \
+                          f'{SOURCE_RATE["angle"]:+06.2f}.fits'
+        with fits.open(os.path.join(output_dir, output_filename)) as stack:
+            snr = source_snr(stack, source, hours)
+        shutil.rmtree(os.path.join(basedir, 'rerun', rerun))
+    else:
+        hdus = [fits.open(filename) for filename in filenames]
+        # fits reads the data when it is first used.
+        for hdu in hdus:
+            for name in ['image', 'mask', 'variance']:
+                hdu[sns.HSC_HDU_MAP[name]].data
+        motions = [sns.sky_motion(rate) for rate in rates]
+        if engine == 'swarp':
+            stacks, timing = measure(lambda: [sns.swarp(hdus, hdus[reference_idx], motion, stacking_mode=stacking_mode,
+                                                        section_size=section_size, dtype=dtype)
+                                              for motion in motions])
+        else:
+            stacks, timing = measure(STACK_FUNCTIONS[engine], hdus, hdus[reference_idx], motions,
+                                     stacking_mode=stacking_mode, section_size=section_size, threads=threads,
+                                     dtype=dtype)
+        snr = source_snr(stacks[rates.index(SOURCE_RATE)], source, hours)
+        for hdu in hdus:
+            hdu.close()
+    case = {'engine': engine, 'stacking_mode': stacking_mode, 'n_exposures': n_exposures, 'shape': list(shape),
+            'section_size': section_size, 'n_rates': n_rates, 'threads': threads, 'dtype': dtype}
+    case.update(timing)
+    case['throughput'] = shape[0] * shape[1] * n_exposures * n_rates / timing['wall']
+    case['snr'] = snr
+    case['recovered'] = bool(snr >= RECOVERY_SNR)
+    if not case['recovered']:
+        logging.error(f'{engine} {stacking_mode} did not recover the injected source, S/N {snr:.1f}')
+    return case
+
+
+def run_benchmark(workdir, engines=ENGINES, stacking_modes=None, exposures=(5, 10), section_sizes=(128, 256),
+                  rates=(1, 9), shape=(512, 512), threads=1, dtype=None):
+    """
+    Run the grid of benchmark cases (see run_case), tree and fourier only in the modes they stack in.
+
+    :return: dict of the host, start time, peak resident memory and the list of cases.
+    """
+    if stacking_modes is None:
+        stacking_modes = list(sns.STACKING_MODES)
+    result = {'host': socket.gethostname(), 'start': time.time(), 'cases': []}
+    for engine in engines:
+        for stacking_mode in stacking_modes:
+            if stacking_mode not in STREAMING_MODES.get(engine, sns.STACKING_MODES):
+                continue
+            for n_exposures in exposures:
+                for section_size in section_sizes:
+                    for n_rates in rates:
+                        result['cases'].append(run_case(workdir, engine, stacking_mode, n_exposures, shape,
+                                                        section_size, n_rates, threads=threads, dtype=dtype))
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def main(argv=None):
+    """
+    Benchmark the stacking engines on synthetic exposures.
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--workdir', default=None,
+                        help='Directory to write the synthetic exposures in, kept between runs. Default is a '
+                             'temporary directory.')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES),
+                        help='Engines to benchmark, sns runs sns.main end to end.')
+    parser.add_argument('--stack-modes', nargs='+', choices=sns.STACKING_MODES.keys(),
+                        default=list(sns.STACKING_MODES), help='Stacking modes to benchmark.')
+    parser.add_argument('--exposures', nargs='+', type=int, default=[5, 10], help='Numbers of exposures.')
+    parser.add_argument('--section-sizes', nargs='+', type=int, default=[128, 256], help='Section sizes.')
+    parser.add_argument('--rates', nargs='+', type=int, default=[1, 9], help='Sizes of the rate grid.')
+    parser.add_argument('--shape', nargs=2, type=int, default=[512, 512],
+                        help='Shape (rows, columns) of the exposures.')
+    parser.add_argument('--threads', type=int, default=1, help='Threads stacking sections in parallel.')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default=None, help='Data type of the stacking.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--log-level', help="What level to log at? (ERROR, INFO, DEBUG)", default="ERROR",
+                        choices=['INFO', 'ERROR', 'DEBUG'])
+    args = parser.parse_args(argv)
+    levels = {'INFO': logging.INFO, 'ERROR': logging.ERROR, 'DEBUG': logging.DEBUG}
+    logging.basicConfig(level=levels[args.log_level])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = tmpdir if args.workdir is None else args.workdir
+        result = run_benchmark(workdir, engines=args.engines, stacking_modes=args.stack_modes,
+                               exposures=args.exposures, section_sizes=args.section_sizes, rates=args.rates,
+                               shape=tuple(args.shape), threads=args.threads, dtype=args.dtype)
+    # throughput is in pixels * exposures * rates per second.
+    for case in result['cases']:
+        print(f"{case['engine']:8s} {case['stacking_mode']:16s} {case['n_exposures']:4d} {case['section_size']:6d} "
+              f"{case['n_rates']:4d} {case['wall']:9.3f}s {case['throughput']:10.3g}/s "
+              f"{case['peak_memory'] / 2**20:9.1f} MB S/N {case['snr']:6.1f}")
+    if args.output is not None:
+        with open(args.output, 'w') as fobj:
+            json.dump(result, fobj, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
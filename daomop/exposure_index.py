@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import sqlite3
+
+from astropy import time
+from astropy.io import fits
+
+EXPOSURE_INDEX_db = {'filename': 'TEXT PRIMARY KEY',
+                     'frameid': 'TEXT',
+                     'mjd_str': 'REAL',
+                     'mjd_end': 'REAL',
+                     'mjd_mid': 'REAL',
+                     'naxis1': 'INTEGER',
+                     'naxis2': 'INTEGER',
+                     'wcs': 'TEXT',
+                     'mtime': 'REAL',
+                     'size': 'INTEGER',
+                     'mvar': 'REAL'}
+
+WCS_KEYWORDS = ['CTYPE1', 'CTYPE2', 'CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2',
+                'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'EQUINOX', 'RADESYS']
+
+
+def init_db(dbfilename):
+    """
+    Create an SQLite database to hold the exposure index.
+
+    :param dbfilename: name of the database file.
+    """
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        column_defs = ",".join([f'`{col}` {EXPOSURE_INDEX_db[col]}' for col in EXPOSURE_INDEX_db])
+        sql = f'CREATE TABLE IF NOT EXISTS `exposures`({column_defs})'
+        logging.debug(f'Creating sql TABLE with: \n{sql}')
+        db.execute(sql)
+        # add the columns that an index made by an older version is missing.
+        columns = [row[1] for row in db.execute('PRAGMA table_info(`exposures`)').fetchall()]
+        for col in EXPOSURE_INDEX_db:
+            if col not in columns:
+                db.execute(f'ALTER TABLE `exposures` ADD COLUMN `{col}` {EXPOSURE_INDEX_db[col]}')
+        db.commit()
+
+
+def read_exposure_header(filename, image_ext=1):
+    """
+    Read the index entry of filename from its primary and image headers, the data are not read.
+
+    :param filename: FITS file to index
+    :param image_ext: extension holding the image (and WCS) header
+    :return: dict with the EXPOSURE_INDEX_db columns.
+    """
+    with fits.open(filename) as hdu:
+        primary_header = hdu[0].header
+        image_header = hdu[image_ext].header
+        mjd_start = time.Time(primary_header['MJD-STR'], format='mjd')
+        mjd_end = time.Time(primary_header['MJD-END'], format='mjd')
+        stat = os.stat(filename)
+        return {'filename': os.path.abspath(filename),
+                'frameid': primary_header.get('FRAMEID', 'Unknown'),
+                'mjd_str': mjd_start.mjd,
+                'mjd_end': mjd_end.mjd,
+                'mjd_mid': (mjd_start + (mjd_end - mjd_start)/2.0).mjd,
+                'naxis1': image_header['NAXIS1'],
+                'naxis2': image_header['NAXIS2'],
+                'wcs': json.dumps({key: image_header[key] for key in WCS_KEYWORDS if key in image_header}),
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'mvar': None}
+
+
+def refresh_exposure_index(images, dbfilename):
+    """
+    Bring the index entries of images up to date, only files that are new or have changed are read.
+
+    The headers are read before the index is locked, which is then held only to write the entries, so the CCD runs
+    sharing an index do not block each other.
+
+    :param images: list of FITS filenames
+    :param dbfilename: the exposure index database
+    :return: number of entries that were (re)read.
+    """
+    init_db(dbfilename)
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        known = {row[0]: (row[1], row[2]) for row in
+                 db.execute('SELECT `filename`, `mtime`, `size` FROM `exposures`').fetchall()}
+    entries = []
+    for image in images:
+        filename = os.path.abspath(image)
+        stat = os.stat(filename)
+        if known.get(filename) == (stat.st_mtime, stat.st_size):
+            continue
+        logging.debug(f'Indexing {filename}')
+        entry = read_exposure_header(filename)
+        entries.append([entry[name] for name in EXPOSURE_INDEX_db])
+    if entries:
+        sql = 'REPLACE INTO `exposures`(' + ",".join([f'`{name}`' for name in EXPOSURE_INDEX_db]) + ')'
+        sql += ' VALUES(' + ','.join(['?'] * len(EXPOSURE_INDEX_db)) + ')'
+        write_entries(dbfilename, sql, entries)
+    logging.info(f'Exposure index {dbfilename}: {len(entries)} of {len(images)} entries refreshed.')
+    return len(entries)
+
+
+def write_entries(dbfilename, sql, entries):
+    """
+    Execute sql for each of entries in one short exclusive transaction, waiting for other writers to finish.
+    """
+    db = sqlite3.connect(dbfilename, timeout=60, isolation_level=None)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+    except Exception:
+        db.close()
+        raise
+    try:
+        db.executemany(sql, entries)
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    finally:
+        db.close()
+
+
+def set_median_variances(median_variances, dbfilename):
+    """
+    Record the median variance (MVAR) of exposures, used by --clip, so later runs need not recompute it.
+
+    The value is cleared when refresh_exposure_index finds the exposure has changed.
+
+    :param median_variances: dict of filename: median variance
+    :param dbfilename: the exposure index database
+    """
+    write_entries(dbfilename, 'UPDATE `exposures` SET `mvar`=? WHERE `filename`=?',
+                  [(float(mvar), os.path.abspath(filename)) for filename, mvar in median_variances.items()])
+
+
+def get_exposures(images, dbfilename):
+    """
+    Retrieve the index entries of images, sorted by mid-exposure MJD.
+
+    :param images: list of FITS filenames, the index must be current for these (see refresh_exposure_index).
+    :param dbfilename: the exposure index database
+    :return: list of dict with the EXPOSURE_INDEX_db columns, wcs decoded to a dict.
+    """
+    filenames = set(os.path.abspath(image) for image in images)
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        cursor = db.execute('SELECT * FROM `exposures` ORDER BY `mjd_mid`, `filename`')
+        colnames = [x[0] for x in cursor.description]
+        exposures = [dict(zip(colnames, row)) for row in cursor.fetchall()]
+    exposures = [exposure for exposure in exposures if exposure['filename'] in filenames]
+    if len(exposures) != len(filenames):
+        raise ValueError(f'{len(filenames) - len(exposures)} images missing from {dbfilename}')
+    for exposure in exposures:
+        exposure['wcs'] = json.loads(exposure['wcs'])
+    return exposures
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+
+import numpy as np
+from astropy.io import fits
+
+# running sums of an incremental SUM or MEAN stack (see sns.fold_exposures) and the data types they are kept in. The
+# sums are over the rf*rf shifted sub-pixels of each exposure and the counts are of the sub-pixels with a value, which
+# at rf=3 holds up to 7281 exposures. A state is 12 bytes per pixel, about 100 MB for a 2048x4176 CCD, for each rate
+# of each sub-stack: the default 17x25 rate grid in 3 sub-stacks keeps about 130 GB per CCD.
+STATE_DTYPES = {'total': np.float32, 'num_frames': np.uint16, 'variance_total': np.float32, 'variance_count': np.uint16}
+STATE_ARRAYS = tuple(STATE_DTYPES)
+
+
+def state_filename(state_dir, output_filename):
+    """
+    File the running sums of the stack written to output_filename are kept in.
+    """
+    return os.path.join(state_dir, os.path.splitext(os.path.basename(output_filename))[0] + '.npz')
+
+
+def save_state(filename, partial, input_images, params):
+    """
+    Write the running sums of a stack with the names of its input images, replacing the previous state atomically.
+
+    :param partial: (total, num_frames, variance_total, variance_count) arrays
+    :param input_images: images summed, in the order they were added.
+    :param params: hash of the parameters the sums were made with (see manifest.params_hash)
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    partial_filename = f'{filename}.part'
+    with open(partial_filename, 'wb') as fobj:
+        np.savez(fobj, inputs=np.array([os.path.basename(image) for image in input_images]), params=np.array(params),
+                 **dict(zip(STATE_ARRAYS, partial)))
+    os.replace(partial_filename, filename)
+
+
+def state_inputs(filename, params):
+    """
+    The input images of the state in filename, None if there is none or it was made with other parameters.
+    """
+    if not os.access(filename, os.R_OK):
+        return None
+    with np.load(filename) as data:
+        if str(data['params']) != params:
+            logging.warning(f'{filename} was made with other parameters, restacking.')
+            return None
+        return [str(name) for name in data['inputs']]
+
+
+def load_state(filename):
+    """
+    Read the running sums kept in filename.
+
+    :return: (total, num_frames, variance_total, variance_count) arrays
+    """
+    with np.load(filename) as data:
+        return tuple(data[name] for name in STATE_ARRAYS)
+
+
+def pin_reference(state_dir, images, reference_idx):
+    """
+    Index in images of the reference exposure of the incremental stacks in state_dir.
+
+    The reference is pinned to images[reference_idx] the first time, and again if the pinned image is no longer an
+    input, which makes every state stale.
+    """
+    filename = os.path.join(state_dir, 'reference.json')
+    names = [os.path.basename(image) for image in images]
+    if os.access(filename, os.R_OK):
+        with open(filename) as fobj:
+            reference = json.load(fobj)['reference']
+        if reference in names:
+            return names.index(reference)
+        logging.warning(f'Pinned reference {reference} is no longer an input, pinning {names[reference_idx]}.')
+    os.makedirs(state_dir, exist_ok=True)
+    with open(filename, 'w') as fobj:
+        json.dump({'reference': names[reference_idx]}, fobj)
+    return reference_idx
+
+
+def stack_inputs(filename):
+    """
+    Names of the input images recorded in the primary header of a stack (see sns.annotate_stack).
+    """
+    header = fits.getheader(filename, 0)
+    return [header[f'input{index:03d}'] for index in range(header.get('NCOMBINE', 0))]
@@ -0,0 +1,98 @@
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+from .planner import peak_rss
+
+# the timings of this run, None when instrumentation is off.
+PROFILE = None
+PROFILE_LOCK = threading.Lock()
+
+# returned by stage when instrumentation is off, so an instrumented block costs a function call.
+NULL_STAGE = contextlib.nullcontext()
+
+
+def enable():
+    """
+    Start recording the stages of this process.
+    """
+    global PROFILE
+    PROFILE = {'start': time.time(), 'wall': time.perf_counter(), 'cpu': time.process_time(), 'stages': {}}
+
+
+def disable():
+    """
+    Stop recording and drop what was recorded.
+    """
+    global PROFILE
+    PROFILE = None
+
+
+def record(name, **counters):
+    """
+    Add to the counters (calls, wall, cpu, bytes_read, bytes_written) of stage name, peak_array_bytes is kept as the
+    maximum.
+    """
+    if PROFILE is None:
+        return
+    with PROFILE_LOCK:
+        entry = PROFILE['stages'].setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes_read': 0,
+                                                    'bytes_written': 0, 'peak_array_bytes': 0})
+        for key, value in counters.items():
+            if key == 'peak_array_bytes':
+                entry[key] = max(entry[key], int(value))
+            else:
+                entry[key] += value
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """
+    Context manager recording the wall and CPU time of a block as part of stage name, see stage.
+    """
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        record(name, calls=1, wall=time.perf_counter() - wall, cpu=time.thread_time() - cpu)
+
+
+def stage(name):
+    """
+    Context manager timing a block as part of stage name.
+
+    Wall and CPU time are those of the thread running the block, so stages run by several threads add up to more than
+    the elapsed time.
+    """
+    if PROFILE is None:
+        return NULL_STAGE
+    return timed_stage(name)
+
+
+def report(**extra):
+    """
+    The recorded stages, with the totals of the run and extra entries, as a JSON serializable dict.
+    """
+    with PROFILE_LOCK:
+        stages = {name: dict(entry) for name, entry in PROFILE['stages'].items()}
+    result = {'host': socket.gethostname(),
+              'pid': os.getpid(),
+              'start': PROFILE['start'],
+              'wall': time.perf_counter() - PROFILE['wall'],
+              'cpu': time.process_time() - PROFILE['cpu'],
+              'peak_rss': peak_rss(),
+              'stages': stages}
+    result.update(extra)
+    return result
+
+
+def write_report(filename, **extra):
+    """
+    Write the report of the run (see report) to filename as JSON.
+    """
+    with open(filename, 'w') as fobj:
+        json.dump(report(**extra), fobj, indent=1, sort_keys=True)
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# tasks are keyed on the absolute path of their output, so runs of other pointings or reruns can share a manifest.
+MANIFEST_db = {'task': 'TEXT PRIMARY KEY',
+               'sub_stack': 'INTEGER',
+               'rate': 'REAL',
+               'angle': 'REAL',
+               'input_hash': 'TEXT',
+               'params_hash': 'TEXT',
+               'params': 'TEXT',
+               'status': 'TEXT',
+               'owner': 'TEXT',
+               'started': 'REAL',
+               'finished': 'REAL',
+               'output': 'TEXT',
+               'size': 'INTEGER',
+               'checksum': 'TEXT',
+               'heartbeat': 'REAL'}
+
+# seconds between the heartbeats of the process holding tasks, and without one after which its tasks are claimed again
+# (e.g. those of a node that was preempted).
+HEARTBEAT_INTERVAL = 60
+CLAIM_TIMEOUT = 10 * HEARTBEAT_INTERVAL
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+def init_db(dbfilename):
+    """
+    Create an SQLite database to hold the task manifest of sns runs.
+
+    :param dbfilename: name of the database file.
+    """
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        column_defs = ",".join([f'`{col}` {MANIFEST_db[col]}' for col in MANIFEST_db])
+        sql = f'CREATE TABLE IF NOT EXISTS `tasks`({column_defs})'
+        logging.debug(f'Creating sql TABLE with: \n{sql}')
+        db.execute(sql)
+        # add the columns that a manifest made by an older version is missing.
+        columns = [row[1] for row in db.execute('PRAGMA table_info(`tasks`)').fetchall()]
+        for col in MANIFEST_db:
+            if col not in columns:
+                db.execute(f'ALTER TABLE `tasks` ADD COLUMN `{col}` {MANIFEST_db[col]}')
+        db.commit()
+
+
+def input_hash(images):
+    """
+    Hash of a set of input images, changes when an image is added, removed or modified.
+
+    :param images: list of filenames
+    :return: hex digest string
+    """
+    digest = hashlib.sha1()
+    for image in sorted(os.path.abspath(image) for image in images):
+        stat = os.stat(image)
+        digest.update(f'{image}{stat.st_mtime}{stat.st_size}'.encode())
+    return digest.hexdigest()
+
+
+def params_hash(params):
+    """
+    Hash of the dictionary of parameters that determine the content of an output.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def file_checksum(filename):
+    """
+    SHA1 checksum of the content of filename.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def owner_id():
+    """
+    Identify this process as the owner of claimed tasks.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def owner_alive(owner):
+    """
+    Is the process owning a task still running? Owners on other hosts are assumed to be alive.
+    """
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def task_is_finished(row, task_input_hash, task_params_hash):
+    """
+    Is the task recorded in row done, with the same inputs and parameters, and its output intact (if still on disk)?
+    """
+    if row['status'] != DONE or row['input_hash'] != task_input_hash or row['params_hash'] != task_params_hash:
+        return False
+    # outputs are written atomically, one that has been published and removed is still done.
+    if row['size'] is not None and os.access(row['output'], os.R_OK) and os.stat(row['output']).st_size != row['size']:
+        logging.warning(f'{row["output"]} does not match the manifest, redoing it.')
+        return False
+    return True
+
+
+def claim_tasks(dbfilename, tasks, images, params, stale_after=CLAIM_TIMEOUT):
+    """
+    Claim the tasks that are not finished and not being run by another live process.
+
+    Tasks are claimed inside an exclusive transaction, so several processes can share one manifest. The owner of a
+    running task is taken to be lost when it is a process of this host that has exited, or when its last heartbeat
+    (see start_heartbeat) is more than stale_after seconds old, which is how the tasks of a process on another host
+    (e.g. a preempted node) are claimed again.
+
+    :param dbfilename: the manifest database
+    :param tasks: list of dict with task (the absolute output filename), sub_stack, rate, angle and output (filename).
+    :param images: input images of the tasks
+    :param params: dictionary of the parameters that determine the outputs.
+    :param stale_after: seconds without a heartbeat after which a running task is claimed again, None waits for the
+                        owner to exit.
+    :return: the list of tasks claimed by this process.
+    """
+    init_db(dbfilename)
+    task_input_hash = input_hash(images)
+    task_params_hash = params_hash(params)
+    owner = owner_id()
+    now = time.time()
+    claimed = []
+    db = sqlite3.connect(dbfilename, timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for task in tasks:
+            row = db.execute('SELECT * FROM `tasks` WHERE `task`=?', (task['task'],)).fetchone()
+            if row is not None:
+                if task_is_finished(row, task_input_hash, task_params_hash):
+                    logging.debug(f'{task["task"]} is done, skipping')
+                    continue
+                last_beat = row['started'] if row['heartbeat'] is None else row['heartbeat']
+                if row['status'] == RUNNING and row['owner'] != owner and owner_alive(row['owner']) and \
+                        (stale_after is None or now - last_beat < stale_after):
+                    logging.info(f'{task["task"]} is being run by {row["owner"]}, skipping')
+                    continue
+            entry = dict(task, input_hash=task_input_hash, params_hash=task_params_hash,
+                         params=json.dumps(params, sort_keys=True), status=RUNNING, owner=owner, started=now,
+                         finished=None, output=os.path.abspath(task['output']), size=None, checksum=None,
+                         heartbeat=now)
+            db.execute(f'REPLACE INTO `tasks`({",".join(MANIFEST_db)}) VALUES({",".join(["?"] * len(MANIFEST_db))})',
+                       [entry[name] for name in MANIFEST_db])
+            claimed.append(task)
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    finally:
+        db.close()
+    logging.info(f'Claimed {len(claimed)} of {len(tasks)} tasks in {dbfilename}')
+    return claimed
+
+
+def complete_task(dbfilename, filename):
+    """
+    Record the task that writes filename as done, with the size and checksum of the output.
+    """
+    filename = os.path.abspath(filename)
+    checksum = file_checksum(filename)
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        db.execute('UPDATE `tasks` SET `status`=?, `finished`=?, `size`=?, `checksum`=? WHERE `output`=?',
+                   (DONE, time.time(), os.stat(filename).st_size, checksum, filename))
+        db.commit()
+
+
+def skip_task(dbfilename, filename):
+    """
+    Record the task that would write filename as done without an output, e.g. a rate the coarse search rejected.
+    """
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        db.execute('UPDATE `tasks` SET `status`=?, `finished`=? WHERE `output`=?',
+                   (DONE, time.time(), os.path.abspath(filename)))
+        db.commit()
+
+
+def release_tasks(dbfilename, status=FAILED):
+    """
+    Mark the tasks this process still holds as running (e.g. after an error) with status.
+    """
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        db.execute('UPDATE `tasks` SET `status`=?, `finished`=? WHERE `status`=? AND `owner`=?',
+                   (status, time.time(), RUNNING, owner_id()))
+        db.commit()
+
+
+def heartbeat(dbfilename):
+    """
+    Record that this process is still running the tasks it holds.
+    """
+    with sqlite3.connect(dbfilename, timeout=60) as db:
+        db.execute('UPDATE `tasks` SET `heartbeat`=? WHERE `status`=? AND `owner`=?',
+                   (time.time(), RUNNING, owner_id()))
+        db.commit()
+
+
+def start_heartbeat(dbfilename, interval=HEARTBEAT_INTERVAL):
+    """
+    Beat the heartbeat of the tasks this process holds every interval seconds, on a background thread.
+
+    :return: threading.Event, set it to stop the heartbeat.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                heartbeat(dbfilename)
+            except sqlite3.Error as ex:
+                logging.warning(f'Heartbeat of {dbfilename} failed: {ex}')
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
@@ -0,0 +1,141 @@
+import logging
+import math
+import os
+import resource
+
+# section sizes the planner chooses from.
+SECTION_SIZES = (64, 128, 256, 512, 1024, 2048, 4096)
+
+# bytes of a numpy intp, the frame counts of the running sums.
+INTP_SIZE = 8
+# bytes per pixel of the LSST mask planes.
+MASK_SIZE = 4
+
+
+def tile_memory(n_exposures, section_size, padding, n_rates, rf=3, engine='shift', streaming=False, itemsize=4,
+                output_itemsize=8):
+    """
+    Estimate the peak working memory of stacking one section of the images at n_rates rates.
+
+    :param n_exposures: number of exposures stacked
+    :param section_size: size of the section (native pixels)
+    :param padding: margin the section is extended by (native pixels)
+    :param n_rates: number of rates stacked in one pass over the section
+    :param rf: up-sampling factor of the shifts
+    :param engine: shift, tree, fourier or swarp
+    :param streaming: True for the SUM and MEAN modes, which are combined with running sums.
+    :param itemsize: bytes per value of the images
+    :param output_itemsize: bytes per value of the stacks
+    :return: bytes
+    """
+    section = section_size ** 2
+    extended = (section_size + 2 * padding) ** 2
+    # the rf*rf sub-pixel stacks of the rate being combined.
+    sub_pixels = 2 * rf ** 2 * section * output_itemsize
+    if engine == 'swarp':
+        # projected images and variances, and the section of each exposure's (memory mapped) pixel map.
+        return 2 * n_exposures * section * (output_itemsize + 8)
+    if engine == 'fourier':
+        # half plane complex transforms of the zero padded sections and three weight maps for each exposure, then
+        # the sum of the transforms and the weight maps of one rate.
+        padded = (section_size + 2 * padding + 2 * (padding // rf + 1)) ** 2
+        return n_exposures * (padded + 3 * extended) * itemsize + padded * itemsize + 3 * extended * 8
+    # the running sums (total, count, variance total, variance count) of a sum of shifted sections.
+    partial_sum = section * 2 * (itemsize + INTP_SIZE)
+    if engine == 'tree':
+        # partial sums kept for later rates, about one per level of the tree, and the accumulated stack of each rate.
+        levels = max(1, math.ceil(math.log2(max(1, n_exposures))))
+        return n_rates * (levels * partial_sum + 2 * section * output_itemsize) + sub_pixels
+    if streaming:
+        return 2 * partial_sum + sub_pixels
+    # shifted images and variances of each exposure, their nan flags and weights.
+    return n_exposures * section * (3 * itemsize + 1) + sub_pixels
+
+
+def stack_memory(n_exposures, shape, section_size, padding, n_rates, rf=3, engine='shift', streaming=False,
+                 itemsize=4, output_itemsize=8, threads=1, workers=1):
+    """
+    Estimate the peak memory of stacking n_exposures of shape at n_rates rates in one pass.
+
+    The exposures (image, variance and mask) are held once, as workers share them, each worker holds the stacks of
+    its n_rates and each thread one section in flight (see tile_memory). The interpreter itself is not counted.
+
+    :return: bytes
+    """
+    pixels = shape[0] * shape[1]
+    exposures = n_exposures * pixels * (2 * itemsize + MASK_SIZE)
+    stacks = 2 * n_rates * pixels * output_itemsize
+    working = threads * tile_memory(n_exposures, section_size, padding, n_rates, rf=rf, engine=engine,
+                                    streaming=streaming, itemsize=itemsize, output_itemsize=output_itemsize)
+    return exposures + workers * (stacks + working)
+
+
+def fit_rate_batch(n_exposures, shape, section_size, padding, n_rates, memory_limit, **kwargs):
+    """
+    The number of rates, at most n_rates, stacked in one pass over sections of section_size that fits in memory_limit.
+
+    :param kwargs: see stack_memory
+    :return: number of rates, 0 if not even one fits.
+    """
+    def memory(batch_size):
+        return stack_memory(n_exposures, shape, section_size, padding, batch_size, **kwargs)
+    # memory grows linearly with the number of rates in the pass.
+    per_rate = memory(2) - memory(1)
+    if per_rate <= 0:
+        return n_rates
+    return max(0, min(n_rates, int((memory_limit - memory(1)) // per_rate) + 1))
+
+
+def plan_stack(n_exposures, shape, n_rates, padding, memory_limit, rf=3, engine='shift', streaming=False, itemsize=4,
+               output_itemsize=8, threads=1, workers=1):
+    """
+    Choose the section size and the number of rates stacked per pass that fit in memory_limit.
+
+    Each pass over the images reads every section extended by padding, so the plan with the fewest
+    passes * ((section_size + 2 * padding) / section_size)**2 is taken, larger sections breaking ties.
+
+    :param n_exposures: number of exposures stacked
+    :param shape: shape of the exposures
+    :param n_rates: number of rates to stack
+    :param padding: margin the sections are extended by (native pixels)
+    :param memory_limit: bytes available
+    :return: dict of section_size, rate_batch_size, padding and predicted (bytes) of the plan.
+    """
+    candidates = [size for size in SECTION_SIZES if size < max(shape)]
+    candidates.append(min([size for size in SECTION_SIZES if size >= max(shape)] or [SECTION_SIZES[-1]]))
+    kwargs = dict(rf=rf, engine=engine, streaming=streaming, itemsize=itemsize, output_itemsize=output_itemsize,
+                  threads=threads, workers=workers)
+    if engine == 'swarp':
+        # swarp stacks one rate at a time.
+        n_rates = 1
+    plan = None
+    for section_size in candidates:
+        batch_size = fit_rate_batch(n_exposures, shape, section_size, padding, n_rates, memory_limit, **kwargs)
+        if batch_size < 1:
+            continue
+        cost = math.ceil(n_rates / batch_size) * ((section_size + 2 * padding) / section_size) ** 2
+        if plan is None or cost <= plan['cost']:
+            plan = {'section_size': section_size, 'rate_batch_size': batch_size, 'cost': cost}
+    if plan is None:
+        logging.warning(f'No stacking plan fits in {memory_limit / 2**20:.0f} MB, using the smallest sections.')
+        plan = {'section_size': candidates[0], 'rate_batch_size': 1}
+    plan.pop('cost', None)
+    plan['padding'] = padding
+    plan['predicted'] = stack_memory(n_exposures, shape, plan['section_size'], padding, plan['rate_batch_size'],
+                                     **kwargs)
+    return plan
+
+
+def physical_memory():
+    """
+    Physical memory of this host (bytes).
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process (bytes).
+    """
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
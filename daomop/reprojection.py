@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+from astropy.wcs import WCS
+
+
+def wcs_hash(header):
+    """
+    Hash of the WCS and image size described by header, used to key the cached pixel maps.
+
+    :param header: FITS image header
+    :return: hex digest string
+    """
+    wcs_string = WCS(header).to_header_string(relax=True)
+    return hashlib.sha1(f'{wcs_string}{header["NAXIS1"]}{header["NAXIS2"]}'.encode()).hexdigest()
+
+
+def pixel_map(header, reference_header, bounds=None):
+    """
+    Compute the pixel of the exposure described by header that lands on each pixel of the reference grid.
+
+    :param header: image header of the exposure
+    :param reference_header: image header of the reference, sets the output grid.
+    :param bounds: (yo, yp, xo, xp) section of the reference grid to map, default is the whole grid.
+    :return: float32 array of shape (2, NAXIS2, NAXIS1) of the reference (or of bounds), the x and y (0 based)
+             exposure pixels.
+    """
+    if bounds is None:
+        bounds = 0, reference_header['NAXIS2'], 0, reference_header['NAXIS1']
+    y, x = np.mgrid[bounds[0]:bounds[1], bounds[2]:bounds[3]]
+    ra, dec = WCS(reference_header).all_pix2world(x, y, 0)
+    x, y = WCS(header).all_world2pix(ra, dec, 0)
+    return np.array([x, y], dtype=np.float32)
+
+
+def load_pixel_map(header, reference_header, cache_dir=None):
+    """
+    Get the pixel map of header onto the reference grid, from cache_dir if it was computed before.
+
+    Maps are stored as MAP-{exposure wcs hash}-{reference wcs hash}.npy so a map is only recomputed when either WCS
+    changes.
+
+    :param header: image header of the exposure
+    :param reference_header: image header of the reference
+    :param cache_dir: directory of the cached maps, None computes the map without caching.
+    :return: pixel map (see pixel_map), memory mapped read-only when cached so only the sections used are read.
+    """
+    if cache_dir is None:
+        return pixel_map(header, reference_header)
+    filename = os.path.join(cache_dir, f'MAP-{wcs_hash(header)}-{wcs_hash(reference_header)}.npy')
+    if os.access(filename, os.R_OK):
+        logging.debug(f'Using pixel map {filename}')
+        return np.load(filename, mmap_mode='r')
+    os.makedirs(cache_dir, exist_ok=True)
+    logging.info(f'Computing pixel map {filename}')
+    result = pixel_map(header, reference_header)
+    # write to a temporary name first so a partly written map is never read back.
+    with open(f'{filename}.tmp', 'wb') as fobj:
+        np.save(fobj, result)
+    os.replace(f'{filename}.tmp', filename)
+    # the map just computed is dropped, so a cold run holds no more maps in memory than one using the cache.
+    del result
+    return np.load(filename, mmap_mode='r')
+
+
+def crval_offset(header, dra, ddec):
+    """
+    The pixel translation produced by moving CRVAL of header by dra, ddec, the change of pixel map that swarp needs
+    to follow a moving object.
+
+    :param header: image header
+    :param dra: change of CRVAL1 (degrees)
+    :param ddec: change of CRVAL2 (degrees)
+    :return: (dx, dy) pixels
+    """
+    wcs = WCS(header)
+    shifted_header = header.copy()
+    shifted_header['CRVAL1'] += dra
+    shifted_header['CRVAL2'] += ddec
+    crval = wcs.wcs.crval
+    before = wcs.all_world2pix([crval], 0)[0]
+    after = WCS(shifted_header).all_world2pix([crval], 0)[0]
+    return after[0] - before[0], after[1] - before[1]
+
+
+def reproject(data, pixel_map, offset=(0, 0), order=1):
+    """
+    Resample data onto the grid of pixel_map, reference pixels that map outside of data are nan.
+
+    :param data: 2D array on the exposure pixel grid.
+    :param pixel_map: exposure pixels of each reference pixel (see pixel_map)
+    :param offset: (dx, dy) translation added to the map (see crval_offset)
+    :param order: 1 interpolates linearly between the pixels that are not nan, 0 takes the nearest pixel (for bit
+                  masks).
+    :return: 2D array on the reference grid, float for order 1, data.dtype (0 outside of data) for order 0.
+    """
+    ny, nx = data.shape
+    x = pixel_map[0] + offset[0]
+    y = pixel_map[1] + offset[1]
+    # pixels extend half a pixel either side of their centre.
+    inside = (x > -0.5) & (x < nx - 0.5) & (y > -0.5) & (y < ny - 0.5)
+    if order == 0:
+        result = np.zeros(x.shape, dtype=data.dtype)
+        result[inside] = data[np.rint(y[inside]).astype(int), np.rint(x[inside]).astype(int)]
+        return result
+    x = np.clip(x, 0, nx - 1)
+    y = np.clip(y, 0, ny - 1)
+    x0 = np.minimum(np.floor(x).astype(int), nx - 2)
+    y0 = np.minimum(np.floor(y).astype(int), ny - 2)
+    fx = x - x0
+    fy = y - y0
+    result = np.zeros(x.shape)
+    total_weight = np.zeros(x.shape)
+    for weight, y_index, x_index in (((1 - fy) * (1 - fx), y0, x0), ((1 - fy) * fx, y0, x0 + 1),
+                                     (fy * (1 - fx), y0 + 1, x0), (fy * fx, y0 + 1, x0 + 1)):
+        values = data[y_index, x_index]
+        good = ~np.isnan(values)
+        result[good] += weight[good] * values[good]
+        total_weight[good] += weight[good]
+    # nan neighbours are left out of the interpolation, the pixel is nan if they carry most of the weight.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result /= total_weight
+    result[~inside | (total_weight < 0.5)] = np.nan
+    return result
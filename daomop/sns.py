@@ -1,17 +1,27 @@
 import argparse
 import glob
+import json
 import logging
 import math
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
 from astropy import time, units
 from astropy.io import fits
-from astropy.nddata import VarianceUncertainty, bitfield_to_boolean_mask
+from astropy.nddata import bitfield_to_boolean_mask
 from astropy.wcs import WCS
-from ccdproc import CCDData, wcs_project, Combiner
+from ccdproc import CCDData
 
+from .exposure_index import get_exposures, refresh_exposure_index, set_median_variances
+from .incremental import STATE_DTYPES, load_state, pin_reference, save_state, stack_inputs, state_filename, state_inputs
+from .instrument import disable as disable_instrument, enable as enable_instrument, record, stage, write_report
+from .manifest import CLAIM_TIMEOUT, claim_tasks, complete_task, params_hash, release_tasks, skip_task, start_heartbeat
+from .planner import fit_rate_batch, peak_rss, physical_memory, plan_stack
+from .reprojection import crval_offset, load_pixel_map, pixel_map, reproject
+from .writer import COMPRESSION_TYPES, atomic_writeto, close_writer, publish_file, start_writer, submit_write
 from .version import __version__
 
 numpy = np
@@ -42,10 +52,36 @@ LSST_MASK_BITS = {'BAD': 0,
 
 HSC_HDU_MAP = {'image': 1, 'mask': 2, 'variance': 3, 'weight': 3}
 
+# LSST mask planes kept, one per bit, in the packed uint8 masks of the exposure cube.
+PACKED_MASK_BITS = ('EDGE', 'NO_DATA', 'BRIGHT_OBJECT', 'SAT', 'INTRP', 'DETECTED')
+
 
 STACK_MASK = (2**LSST_MASK_BITS['EDGE'], 2**LSST_MASK_BITS['NO_DATA'], 2**LSST_MASK_BITS['BRIGHT_OBJECT'],
               2**LSST_MASK_BITS['SAT'], 2**LSST_MASK_BITS['INTRP'])
 
+# the STACK_MASK and DETECTED planes of a packed mask.
+PACKED_STACK_MASK = sum(2**bit for bit, name in enumerate(PACKED_MASK_BITS) if 2**LSST_MASK_BITS[name] in STACK_MASK)
+PACKED_DETECTED = 2**PACKED_MASK_BITS.index('DETECTED')
+PACKED_NO_DATA = 2**PACKED_MASK_BITS.index('NO_DATA')
+# header keyword of mask HDUs that hold a packed mask, as loaded from the exposure cube.
+PACKED_MASK_KEYWORD = 'MASKPACK'
+
+# exposures that a rate shifts by more than this many up-sampled pixels are left out of its stack.
+MAX_SHIFT = 130
+
+# rates stacked in one pass over the image sections by shift when neither --rate-batch-size nor --memory-limit is
+# given.
+RATE_BATCH_SIZE = 4
+# fraction of the physical memory the default batches of --tree and --fourier are planned to fit in.
+BATCH_MEMORY_FRACTION = 0.5
+
+# command line arguments that change the content of a stack, recorded with each task of the manifest.
+MANIFEST_PARAMS = ('filter', 'exptype', 'stack_mode', 'rectify', 'mask', 'clip', 'n_sub_stacks', 'search_bin',
+                   'search_coarsen', 'search_threshold', 'detection_maps', 'top_k', 'keep_snr', 'dtype',
+                   'output_dtype', 'compress')
+# and those that also change a detection map.
+DETECTION_MANIFEST_PARAMS = ('rate_min', 'rate_max', 'rate_step', 'angle_min', 'angle_max', 'angle_step')
+
 
 def weighted_quantile(values, quantile, sample_weight):
     """ Very close to numpy.percentile, but supports weights.  Always overwrite=True, works on arrays with nans.
@@ -62,19 +98,71 @@ def weighted_quantile(values, quantile, sample_weight):
     :param sample_weight: array-like of the same length as `array`
     :return: numpy.array with computed quantiles.
     """
-    logging.debug(f'computing weighted quantile: {quantile}')
-    sorter = np.argsort(values, axis=0)
-    values = numpy.take_along_axis(values, sorter, axis=0)
-    sample_weight = numpy.take_along_axis(sample_weight, sorter, axis=0)
-    # check for inf weights, and remove
-    sample_weight[numpy.isinf(sample_weight)] = 0.0
-    weighted_quantiles = np.nancumsum(sample_weight, axis=0) - 0.5 * sample_weight
-    weighted_quantiles /= np.nansum(sample_weight, axis=0)
-    ind = np.argmin(weighted_quantiles <= quantile, axis=0)
-    return np.take_along_axis(values, np.expand_dims(ind, axis=0), axis=0)[0]
+    with stage('weighted_quantile'):
+        logging.debug(f'computing weighted quantile: {quantile}')
+        sorter = np.argsort(values, axis=0)
+        values = numpy.take_along_axis(values, sorter, axis=0)
+        sample_weight = numpy.take_along_axis(sample_weight, sorter, axis=0)
+        # check for inf weights, and remove
+        sample_weight[numpy.isinf(sample_weight)] = 0.0
+        weighted_quantiles = np.nancumsum(sample_weight, axis=0) - 0.5 * sample_weight
+        weighted_quantiles /= np.nansum(sample_weight, axis=0)
+        ind = np.argmin(weighted_quantiles <= quantile, axis=0)
+        return np.take_along_axis(values, np.expand_dims(ind, axis=0), axis=0)[0]
+
+
+def blocked_weighted_quantile(values, quantile, sample_weight, block_size=None):
+    """
+    Weighted quantile along axis 0, a faster drop in for weighted_quantile.
+
+    The pixels are processed in blocks that are transposed so each pixel's samples are contiguous, this keeps the
+    sort and cumulative sum temporaries small and cache friendly and only the selected value is gathered.  Samples
+    whose value is nan or whose weight is nan/inf carry no weight, pixels with no weighted samples are nan.
+    Otherwise the result is the same as weighted_quantile.
+
+    :param values: numpy.array with data, samples along axis 0.
+    :param quantile: quantile to compute, in [0, 1]
+    :param sample_weight: numpy.array of weights, same shape as values.
+    :param block_size: number of pixels to process at a time.
+    :return: numpy.array with computed quantile, shape of values[0].
+    """
+    with stage('weighted_quantile'):
+        logging.debug(f'computing blocked weighted quantile: {quantile}')
+        values = np.asarray(values)
+        n = values.shape[0]
+        out_shape = values.shape[1:]
+        values = values.reshape(n, -1)
+        sample_weight = np.broadcast_to(sample_weight, (n,) + out_shape).reshape(n, -1)
+        if block_size is None:
+            block_size = max(1, 2**16 // max(1, n))
+        result = np.empty(values.shape[1], dtype=values.dtype)
+        record('weighted_quantile', peak_array_bytes=values.nbytes)
+        for start in range(0, values.shape[1], block_size):
+            block_values = values[:, start:start+block_size].T.copy()
+            block_weight = sample_weight[:, start:start+block_size].T.copy()
+            block_weight[~np.isfinite(block_weight) | np.isnan(block_values)] = 0.0
+            sorter = np.argsort(block_values, axis=1)
+            block_weight = np.take_along_axis(block_weight, sorter, axis=1)
+            weighted_quantiles = np.cumsum(block_weight, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weighted_quantiles = (weighted_quantiles - 0.5 * block_weight) / weighted_quantiles[:, -1:]
+            weighted = block_weight > 0
+            above = weighted & (weighted_quantiles > quantile)
+            ind = np.argmax(above, axis=1)
+            rows = np.arange(len(ind))
+            # if no sample is above the quantile take the last weighted sample.
+            last = n - 1 - np.argmax(weighted[:, ::-1], axis=1)
+            ind = np.where(above[rows, ind], ind, last)
+            block_result = block_values[rows, sorter[rows, ind]]
+            block_result[~weighted.any(axis=1)] = np.nan
+            result[start:start+block_size] = block_result
+        return result.reshape(out_shape)
 
 
-STACKING_MODES['WEIGHTED_MEDIAN'] = weighted_quantile
+STACKING_MODES['WEIGHTED_MEDIAN'] = blocked_weighted_quantile
+WEIGHTED_STACKING_MODES = (weighted_quantile, blocked_weighted_quantile)
+# modes that shift_combine computes with running sums instead of a stack of the images.
+STREAMING_STACKING_MODES = (np.nansum, np.nanmean)
 
 
 def mask_as_nan(data, bitmask, mask_bits=STACK_MASK):
@@ -98,58 +186,313 @@ def mask_as_nan(data, bitmask, mask_bits=STACK_MASK):
     return data
 
 
-def swarp(hdus, reference_hdu, rate, hdu_idx=None, stacking_mode="MEAN"):
+def pack_table():
+    """
+    The packed value (see pack_mask) of every value of the low 16 LSST mask planes, which hold PACKED_MASK_BITS.
+    """
+    values = np.arange(2**16)
+    table = np.zeros(values.shape, dtype=np.uint8)
+    for bit, name in enumerate(PACKED_MASK_BITS):
+        table |= (((values >> LSST_MASK_BITS[name]) & 1) << bit).astype(np.uint8)
+    return table
+
+
+PACK_TABLE = pack_table()
+
+
+def pack_mask(bitmask):
+    """
+    Pack the LSST mask planes listed in PACKED_MASK_BITS into a uint8 mask, one bit per plane.
+
+    The planes are decoded together, with one lookup of each pixel in PACK_TABLE.
+    """
+    # the cast keeps the low 16 planes.
+    return PACK_TABLE[bitmask.astype(np.uint16)]
+
+
+def pack_masks(hdus, mask_idx=None):
+    """
+    Decode the mask plane of each of hdus once, into the packed masks used by preprocess_exposures and swarp.
+
+    Masks that are already packed (see load_exposure_cube) are used as they are, so a memory mapped mask is only read
+    where it is used.
+
+    :param mask_idx: index of the mask HDU in each HDUList, default is that of HSC_HDU_MAP.
+    :return: list of uint8 arrays, see pack_mask.
+    """
+    if mask_idx is None:
+        mask_idx = HSC_HDU_MAP['mask']
+    return [hdu[mask_idx].data if hdu[mask_idx].header.get(PACKED_MASK_KEYWORD, False) else
+            pack_mask(hdu[mask_idx].data) for hdu in hdus]
+
+
+def unpack_mask(packed):
+    """
+    Expand a mask made by pack_mask back to LSST mask plane values, only the PACKED_MASK_BITS planes are set.
+    """
+    bitmask = np.zeros(packed.shape, dtype=np.uint16)
+    for bit, name in enumerate(PACKED_MASK_BITS):
+        bitmask |= ((packed >> bit) & 1).astype(np.uint16) << LSST_MASK_BITS[name]
+    return bitmask
+
+
+def preprocess_exposures(hdus, clip=None, mask=False, median_variances=None, masks=None):
+    """
+    Mask the pixels of hdus that should not be stacked, in place.
+
+    The pixels to mask are found from the packed masks, and set to nan in the image and the variance, in one pass
+    over each exposure.
+
+    :param hdus: list of HDUList
+    :param clip: set pixels that are part of a detected source and whose variance is clip times the median variance
+                 (MVAR) of the exposure to nan, None does not clip.
+    :param mask: set pixels with STACK_MASK bits to nan.
+    :param median_variances: list of the MVAR of each of hdus, None (or None entries) computes them.
+    :param masks: packed masks of hdus (see pack_masks), made here if not given.
+    :return: list of the MVAR of each of hdus, None when not clipping.
+    """
+    if median_variances is None:
+        median_variances = [None] * len(hdus)
+    median_variances = list(median_variances)
+    if clip is None and not mask:
+        return None
+    if masks is None:
+        masks = pack_masks(hdus)
+    if clip is not None:
+        logging.info(f'Masking pixels in image whose variance exceeds {clip} times the median variance.')
+    for idx, (hdu, packed) in enumerate(zip(hdus, masks)):
+        image = hdu[HSC_HDU_MAP['image']].data
+        variance = hdu[HSC_HDU_MAP['variance']].data
+        masked = (packed & PACKED_STACK_MASK) != 0 if mask else None
+        if clip is not None:
+            if median_variances[idx] is None:
+                median_variances[idx] = float(numpy.nanmedian(variance))
+            hdu[HSC_HDU_MAP['variance']].header['MVAR'] = (median_variances[idx], 'Median variance')
+            logging.debug(f'Median variance is {median_variances[idx]}')
+            # mask pixels that are both high-variance AND part of a detected source.
+            clipped = (variance > median_variances[idx] * clip) & ((packed & PACKED_DETECTED) != 0)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                # the count is a whole image sum, only worth doing when it is logged.
+                logging.debug(f'Clip setting {np.sum(clipped)} to nan')
+            masked = clipped if masked is None else masked | clipped
+        np.copyto(image, np.nan, where=masked)
+        np.copyto(variance, np.nan, where=masked)
+    return median_variances if clip is not None else None
+
+
+def exposure_cube_is_current(images, cache_dir, clip=None, mask=False):
+    """
+    Check that the exposure cube in cache_dir was built from images, with the same preprocessing (see
+    build_exposure_cube), and none of them have changed since.
+    """
+    metadata_filename = os.path.join(cache_dir, 'metadata.json')
+    if not os.access(metadata_filename, os.R_OK):
+        return False
+    with open(metadata_filename) as fobj:
+        metadata = json.load(fobj)
+    if metadata.get('clip') != clip or metadata.get('mask', False) != mask:
+        return False
+    exposures = {exposure['filename']: exposure for exposure in metadata['exposures']}
+    for image in images:
+        exposure = exposures.get(os.path.abspath(image))
+        if exposure is None:
+            return False
+        stat = os.stat(image)
+        if exposure['mtime'] != stat.st_mtime or exposure['size'] != stat.st_size:
+            return False
+    return True
+
+
+def build_exposure_cube(images, cache_dir, clip=None, mask=False, median_variances=None):
+    """
+    Convert the image, mask and variance planes of images into memory mappable cubes in cache_dir.
+
+    The image and variance are stored as native-endian float32 (image.npy, variance.npy), the mask is stored packed
+    (mask.npy, see pack_mask) and the headers and file stats of the inputs are kept in metadata.json, which is
+    written last so its presence marks a complete cube.
+
+    :param images: list of filenames of HSC difference images, all the same shape.
+    :param cache_dir: directory to store the cube in.
+    :param clip: see preprocess_exposures, applied to the cube so exposures loaded from it need no preprocessing.
+    :param mask: see preprocess_exposures
+    :param median_variances: see preprocess_exposures
+    :return: list of the MVAR of each of images, None when not clipping.
+    """
+    median_variances = [None] * len(images) if median_variances is None else list(median_variances)
+    os.makedirs(cache_dir, exist_ok=True)
+    metadata_filename = os.path.join(cache_dir, 'metadata.json')
+    if os.access(metadata_filename, os.F_OK):
+        os.unlink(metadata_filename)
+    logging.info(f'Building exposure cube of {len(images)} images in {cache_dir}')
+    cubes = {}
+    exposures = []
+    for idx, image in enumerate(images):
+        with fits.open(image) as hdu:
+            shape = hdu[HSC_HDU_MAP['image']].data.shape
+            if not cubes:
+                cube_shape = (len(images),) + shape
+                cubes = {'image': np.lib.format.open_memmap(os.path.join(cache_dir, 'image.npy'), mode='w+',
+                                                            dtype=np.float32, shape=cube_shape),
+                         'variance': np.lib.format.open_memmap(os.path.join(cache_dir, 'variance.npy'), mode='w+',
+                                                               dtype=np.float32, shape=cube_shape),
+                         'mask': np.lib.format.open_memmap(os.path.join(cache_dir, 'mask.npy'), mode='w+',
+                                                           dtype=np.uint8, shape=cube_shape)}
+            if shape != cubes['image'].shape[1:]:
+                raise ValueError(f'{image} has shape {shape}, expected {cubes["image"].shape[1:]}')
+            stat = os.stat(image)
+            exposures.append({'filename': os.path.abspath(image),
+                              'mtime': stat.st_mtime,
+                              'size': stat.st_size,
+                              'headers': [hdu[ext].header.tostring() for ext in range(4)]})
+            packed = pack_mask(hdu[HSC_HDU_MAP['mask']].data)
+            mvar = preprocess_exposures([hdu], clip, mask, median_variances[idx:idx+1], masks=[packed])
+            if mvar is not None:
+                median_variances[idx] = mvar[0]
+            cubes['image'][idx] = hdu[HSC_HDU_MAP['image']].data
+            cubes['variance'][idx] = hdu[HSC_HDU_MAP['variance']].data
+            cubes['mask'][idx] = packed
+    for cube in cubes.values():
+        cube.flush()
+    with open(metadata_filename, 'w') as fobj:
+        json.dump({'exposures': exposures, 'clip': clip, 'mask': mask}, fobj)
+    return median_variances if clip is not None else None
+
+
+def load_exposure_cube(cache_dir, images=None):
+    """
+    Load the exposure cube in cache_dir as HDULists whose data are copy-on-write memory maps of the cube.
+
+    Sections of the data are only read from disk when used and changes (e.g. masking) are not written back to
+    the cube.  The mask HDU holds the packed mask (see pack_mask), flagged by PACKED_MASK_KEYWORD in its header, which
+    pack_masks passes on as it is and unpack_mask turns (a section of) back into LSST mask planes.
+
+    :param cache_dir: directory holding a cube made by build_exposure_cube
+    :param images: filenames of the exposures to load, default is all exposures in the cube.
+    :return: list of fits.HDUList
+    """
+    with open(os.path.join(cache_dir, 'metadata.json')) as fobj:
+        metadata = json.load(fobj)
+    cubes = {layer: np.load(os.path.join(cache_dir, f'{layer}.npy'), mmap_mode='c')
+             for layer in ['image', 'variance', 'mask']}
+    index = {exposure['filename']: idx for idx, exposure in enumerate(metadata['exposures'])}
+    if images is None:
+        images = [exposure['filename'] for exposure in metadata['exposures']]
+    hdus = []
+    for image in images:
+        idx = index[os.path.abspath(image)]
+        headers = [fits.Header.fromstring(header) for header in metadata['exposures'][idx]['headers']]
+        headers[HSC_HDU_MAP['mask']][PACKED_MASK_KEYWORD] = (True, 'Mask planes packed, see sns.pack_mask')
+        hdus.append(fits.HDUList([fits.PrimaryHDU(header=headers[0]),
+                                  fits.ImageHDU(data=cubes['image'][idx], header=headers[HSC_HDU_MAP['image']]),
+                                  fits.ImageHDU(data=cubes['mask'][idx], header=headers[HSC_HDU_MAP['mask']]),
+                                  fits.ImageHDU(data=cubes['variance'][idx],
+                                                header=headers[HSC_HDU_MAP['variance']])]))
+    return hdus
+
+
+def swarp(hdus, reference_hdu, rate, hdu_idx=None, stacking_mode="MEAN", cache_dir=None, section_size=1024,
+          dtype=None, masks=None):
     """
     use the WCS to project all image to the 'reference_hdu' shifting the the CRVAL of each image by rate*dt
-    :param stacking_mode: what process to use for combining images MEAN or MEDIAN
+
+    The pixel map of each image onto the reference grid is computed once, and kept in cache_dir, shifting CRVAL by
+    rate*dt is then a translation of that map (see reprojection.crval_offset).  The images are projected and combined
+    one section of the reference grid at a time, so only a section of each image is held in projection.
+
+    :param stacking_mode: what process to use for combining images, a key of STACKING_MODES.
     :param hdu_idx: which HDU in each HDUList listed in hdus is the ImageData in?
     :param hdus: list of HDUList
     :param reference_hdu: reference HDUList in hdus
-    :param rate: dictionary with the ra/dec shift rates.
-    :return: fits.HDUList
+    :param rate: dictionary with the ra/dec shift rates, None stacks without shifting.
+    :param cache_dir: directory of the cached pixel maps, None computes the maps of each section as needed.
+    :param section_size: size of the sections of the reference grid that are projected and combined together.
+    :param dtype: data type of the projections and the stack, default is float64.
+    :param masks: packed masks of hdus (see pack_masks), made here if not given.
+    :return: fits.HDUList with the stacked image and variance.
     """
-    # Project the input images to the same grid using interpolation
-    if stacking_mode not in ['MEDIAN', 'MEAN']:
+    if stacking_mode is None:
+        stacking_mode = 'MEAN'
+    if stacking_mode not in STACKING_MODES:
         logging.warning(f'{stacking_mode} not available for swarp stack. Setting to MEAN')
         stacking_mode = 'MEAN'
+    logging.info(f'Combining images using {stacking_mode}')
+    stacking_function = STACKING_MODES[stacking_mode]
     if hdu_idx is None:
         hdu_idx = HSC_HDU_MAP
+    if masks is None:
+        masks = pack_masks(hdus, hdu_idx['mask'])
     reference_date = mid_exposure_mjd(reference_hdu[0])
-    stack_input = []
+    reference_header = reference_hdu[hdu_idx['image']].header
     logging.info(f'stacking at rate/angle set: {rate}')
-    ccd_data = {}
+    offsets = []
+    mappings = []
     for hdu in hdus:
-        wcs_header = hdu[1].header.copy()
-        dt = (mid_exposure_mjd(hdu[0]) - reference_date)
+        header = hdu[hdu_idx['image']].header
+        offset = (0, 0)
         if rate is not None:
-            wcs_header['CRVAL1'] += (rate['dra'] * dt)
-            wcs_header['CRVAL2'] += (rate['ddec'] * dt)
-        for layer in hdu_idx:
-            data = hdu[hdu_idx[layer]].data
-            if layer == 'variance':
-                data = VarianceUncertainty(data)
-            elif layer == 'mask':
-                data = bitfield_to_boolean_mask(data, ignore_flags=STACK_MASK, flip_bits=True)
-            ccd_data[layer] = data
-        logging.info(f'Adding {hdu[0]} to projected stack.')
-        stack_input.append(wcs_project(CCDData(ccd_data['image'],
-                                               mask=ccd_data['mask'],
-                                               header=wcs_header,
-                                               wcs=WCS(wcs_header),
-                                               unit='adu',
-                                               uncertainty=ccd_data['variance']),
-                                       WCS(reference_hdu.header)))
-        logging.debug(f'{stack_input[-1].header}')
-    if rate is not None:
-        combiner = Combiner(stack_input)
-        if stacking_mode == 'MEDIAN':
-            stacked_image = combiner.median_combine()
-        else:
-            stacked_image = combiner.average_combine()
-        return fits.HDUList([fits.PrimaryHDU(header=reference_hdu[0]),
-                             fits.ImageHDU(data=stacked_image.data, header=reference_hdu[1].header)])
-    else:
-        return stack_input
+            dt = (mid_exposure_mjd(hdu[0]) - reference_date).to(units.hour)
+            offset = crval_offset(header, (rate['dra'] * dt).to_value(units.degree),
+                                  (rate['ddec'] * dt).to_value(units.degree))
+        offsets.append(offset)
+        if cache_dir is not None:
+            mappings.append(load_pixel_map(header, reference_header, cache_dir))
+
+    shape = reference_header['NAXIS2'], reference_header['NAXIS1']
+    image_array = np.zeros(shape, dtype=dtype)
+    variance_array = np.zeros(shape, dtype=dtype)
+    for yo in range(0, shape[0], section_size):
+        yp = min(shape[0], yo + section_size)
+        for xo in range(0, shape[1], section_size):
+            xp = min(shape[1], xo + section_size)
+            logging.debug(f'Projecting section {yo, yp, xo, xp}')
+            outs = np.empty((len(hdus), yp - yo, xp - xo), dtype=dtype)
+            variances = np.empty((len(hdus), yp - yo, xp - xo), dtype=dtype)
+            record('project', peak_array_bytes=outs.nbytes + variances.nbytes)
+            for idx, hdu in enumerate(hdus):
+                with stage('project'):
+                    if cache_dir is None:
+                        mapping = pixel_map(hdu[hdu_idx['image']].header, reference_header, (yo, yp, xo, xp))
+                    else:
+                        mapping = mappings[idx][:, yo:yp, xo:xp]
+                    outs[idx] = reproject(hdu[hdu_idx['image']].data, mapping, offsets[idx])
+                    mask = reproject(masks[idx], mapping, offsets[idx], order=0)
+                    np.copyto(outs[idx], np.nan, where=(mask & PACKED_STACK_MASK) != 0)
+                    variances[idx] = reproject(hdu[hdu_idx['variance']].data, mapping, offsets[idx])
+            with stage('combine'):
+                image_array[yo:yp, xo:xp], variance_array[yo:yp, xo:xp] = combine(outs, variances,
+                                                                                  stacking_function)
+    return stack_hdu_list(reference_hdu[0].header,
+                          reference_header,
+                          reference_hdu[hdu_idx['variance']].header,
+                          image_array, variance_array)
+
+
+def rectify(hdus, reference_hdu, cache_dir=None):
+    """
+    Project the image, mask and variance of each of hdus onto the pixel grid of reference_hdu, in place.
+
+    The images and variances are interpolated, the bit masks (packed or not) take the nearest pixel and pixels with no
+    data are flagged NO_DATA.
+
+    :param hdus: list of HDUList
+    :param reference_hdu: reference HDUList
+    :param cache_dir: directory of the cached pixel maps, None does not cache the maps.
+    """
+    reference_header = reference_hdu[HSC_HDU_MAP['image']].header
+    for hdu in hdus:
+        image_hdu = hdu[HSC_HDU_MAP['image']]
+        mapping = load_pixel_map(image_hdu.header, reference_header, cache_dir)
+        inside = reproject(np.ones(image_hdu.data.shape, dtype=bool), mapping, order=0)
+        image_hdu.data = reproject(image_hdu.data, mapping)
+        packed = hdu[HSC_HDU_MAP['mask']].header.get(PACKED_MASK_KEYWORD, False)
+        mask = reproject(hdu[HSC_HDU_MAP['mask']].data, mapping, order=0)
+        mask[~inside] |= PACKED_NO_DATA if packed else 2**LSST_MASK_BITS['NO_DATA']
+        hdu[HSC_HDU_MAP['mask']].data = mask
+        hdu[HSC_HDU_MAP['variance']].data = reproject(hdu[HSC_HDU_MAP['variance']].data, mapping)
+        for layer in ['image', 'mask', 'variance']:
+            hdu[HSC_HDU_MAP[layer]].header = reference_header.copy()
+        if packed:
+            hdu[HSC_HDU_MAP['mask']].header[PACKED_MASK_KEYWORD] = (True, 'Mask planes packed, see sns.pack_mask')
 
 
 def down_sample_2d(inp, fr):
@@ -176,143 +519,820 @@ def frameid(hdu):
     return hdu[0].header['FRAMEID']
 
 
-def shift(hdus, reference_hdu, rate, rf=3, stacking_mode=None, section_size=1024):
+def shift_section(data, dx, dy):
+    """
+    Shift data in place by dx/dy pixels using index bounds, pixels uncovered by the shift keep their input values.
+
+    This is the shift applied to the up-sampled sections by the original shift+stack, shift_combine reproduces it on
+    the native pixel grid.
+
+    :param data: 2D array to shift.
+    :param dx: shift along axis 1 (pixels)
+    :param dy: shift along axis 0 (pixels)
+    :return: the shifted array.
+    """
+    # dest_bounds are range of the index where the data should go into
+    # source_bounds are the range of the index where the data come from.
+    # this creates a shift in the data, using index bounds.
+    offsets = {1: dx, 0: dy}
+    dest_bounds = [[0, data.shape[0]], [0, data.shape[1]]]
+    source_bounds = [[0, data.shape[0]], [0, data.shape[1]]]
+    for axis in offsets:
+        if offsets[axis] < 0:
+            dest_bounds[axis] = 0, data.shape[axis] + offsets[axis]
+            source_bounds[axis] = -offsets[axis], data.shape[axis]
+        elif offsets[axis] > 0:
+            dest_bounds[axis] = offsets[axis], data.shape[axis]
+            source_bounds[axis] = 0, data.shape[axis] - offsets[axis]
+    logging.debug(f'Placing data from section {source_bounds} into {dest_bounds}')
+    data[dest_bounds[0][0]:dest_bounds[0][1], dest_bounds[1][0]:dest_bounds[1][1]] = \
+        data[source_bounds[0][0]:source_bounds[0][1], source_bounds[1][0]:source_bounds[1][1]]
+    return data
+
+
+def combine(outs, variances, stacking_mode):
+    """
+    Combine a stack of shifted images and variances.
+
+    :param outs: list (or array) of shifted image arrays
+    :param variances: list (or array) of shifted variance arrays
+    :param stacking_mode: function from STACKING_MODES used to combine the images.
+    :return: stacked image and stacked variance arrays.
+    """
+    variances = np.asarray(variances)
+    outs = np.asarray(outs)
+    # count up data where pixels were not 'nan'
+    num_frames = numpy.sum(~numpy.isnan(outs), axis=0)
+    logging.debug(f'Stacking {len(outs)} images of shape {outs[0].shape}')
+    logging.debug(f'Combining shifted pixels')
+    if stacking_mode in WEIGHTED_STACKING_MODES:
+        stacked_data = stacking_mode(outs, 0.50001, 1./variances)
+    elif stacking_mode == np.nanmedian:
+        stacked_data = stacking_mode(outs, overwrite_input=True, axis=0)
+    else:
+        # only nanmedian accepts overwrite_input.
+        stacked_data = stacking_mode(outs, axis=0)
+    logging.debug(f'Setting variance to mean variance / N frames')
+    stacked_variance = STACKING_MODES['MEAN'](variances, axis=0)/num_frames
+    return stacked_data, stacked_variance
+
+
+def sub_pixel_index(n, offset, rf, lower, upper):
+    """
+    Find the native pixel that lands on each sub-pixel of the native pixels lower:upper after a section of length n is
+    up-sampled by rf and shifted by offset up-sampled pixels (see shift_section).
+
+    Along each axis sub-pixels a < offset % rf of a native pixel come from one native pixel and the remaining
+    rf - offset % rf from its neighbour, i.e. the fractional-pixel overlap weights of the shift.
+
+    :param n: length of the section along this axis (native pixels)
+    :param offset: shift along this axis (up-sampled pixels)
+    :param rf: up-sampling factor
+    :param lower: first native pixel of the output range
+    :param upper: end of the native output range
+    :return: source index, unshifted index and covered flag arrays of shape (rf, upper-lower), entry [a, k] is for
+             sub-pixel a of pixel lower+k. Sub-pixels not covered by the shift keep their unshifted value.
+    """
+    sub_pixels = np.arange(lower*rf, upper*rf).reshape(upper-lower, rf).T
+    source = sub_pixels - offset
+    covered = (source >= 0) & (source < n*rf)
+    source[~covered] = sub_pixels[~covered]
+    return source // rf, sub_pixels // rf, covered
+
+
+def gather_shifted(data, y_index, x_index):
+    """
+    Gather the shifted sub-pixel values of data for one sub-pixel position.
+
+    :param data: 2D native pixel section
+    :param y_index: (source, unshifted, covered) arrays along axis 0 for this sub-pixel position
+    :param x_index: (source, unshifted, covered) arrays along axis 1 for this sub-pixel position
+    :return: 2D array of the values
+    """
+    y_source, y_unshifted, y_covered = y_index
+    x_source, x_unshifted, x_covered = x_index
+    values = data[np.ix_(y_source, x_source)]
+    if not (y_covered.all() and x_covered.all()):
+        # the shift moves a rectangle of data, everything outside of that rectangle is left in place.
+        uncovered = ~(y_covered[:, None] & x_covered[None, :])
+        values[uncovered] = data[np.ix_(y_unshifted, x_unshifted)][uncovered]
+    return values
+
+
+def stream_combine(images, variances, y_index, x_index, stacking_mode):
+    """
+    Combine shifted images and variances with running sums, for the SUM and MEAN stacking modes.
+
+    Gives the same result as combine on the stack of gathered sections but only holds the accumulators, so the
+    memory needed does not grow with the number of images.
+
+    :param images: list of image sections
+    :param variances: list of variance sections
+    :param y_index: list of (source, unshifted, covered) arrays along axis 0, one for each section (see gather_shifted)
+    :param x_index: list of (source, unshifted, covered) arrays along axis 1, one for each section
+    :param stacking_mode: np.nansum or np.nanmean
+    :return: stacked image and stacked variance arrays.
+    """
+    logging.debug(f'Accumulating {len(images)} shifted images')
+    partial = None
+    for image, variance, iy, ix in zip(images, variances, y_index, x_index):
+        values = shifted_partial_sum(image, variance, iy, ix)
+        if partial is None:
+            partial = values
+            continue
+        for accumulator, value in zip(partial, values):
+            accumulator += value
+    return finish_partial_sum(partial, stacking_mode)
+
+
+def shifted_partial_sum(image, variance, y_index, x_index):
+    """
+    Gather one shifted image and variance section as the running sums of stream_combine.
+
+    :return: (total, num_frames, variance_total, variance_count) arrays, nan values are counted out.
+    """
+    values = gather_shifted(image, y_index, x_index)
+    good = ~np.isnan(values)
+    values[~good] = 0
+    values_variance = gather_shifted(variance, y_index, x_index)
+    good_variance = ~np.isnan(values_variance)
+    values_variance[~good_variance] = 0
+    return values, good.astype(np.intp), values_variance, good_variance.astype(np.intp)
+
+
+def finish_partial_sum(partial, stacking_mode):
+    """
+    Turn the running sums of stream_combine into the stacked image and variance, the sums are overwritten.
+
+    :param partial: (total, num_frames, variance_total, variance_count) arrays
+    :param stacking_mode: np.nansum or np.nanmean
+    :return: stacked image and stacked variance arrays.
+    """
+    total, num_frames, variance_total, variance_count = partial
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if stacking_mode == np.nanmean:
+            # divide in place, as np.nanmean does, to keep the data type of the images.
+            np.true_divide(total, num_frames, out=total, casting='unsafe')
+        np.true_divide(variance_total, variance_count, out=variance_total, casting='unsafe')
+        stacked_variance = variance_total/num_frames
+    return total, stacked_variance
+
+
+def shifted_exposure(image, variance, offset, rf=3):
+    """
+    Shift a whole image and variance as shift_combine does and sum the shifted sub-pixels back on the native grid.
+
+    :param offset: (dx, dy) shift in up-sampled pixels
+    :return: (total, num_frames, variance_total, variance_count) arrays of the data types of incremental.STATE_DTYPES,
+             the sums and counts are over the rf*rf sub-pixels of each pixel, nan values are counted out.
+    """
+    ny, nx = image.shape
+    y_index = sub_pixel_index(ny, offset[1], rf, 0, ny)
+    x_index = sub_pixel_index(nx, offset[0], rf, 0, nx)
+    sums = tuple(np.zeros((ny, nx), dtype=dtype) for dtype in STATE_DTYPES.values())
+    for a in range(rf):
+        for b in range(rf):
+            values = shifted_partial_sum(image, variance, [index[a] for index in y_index],
+                                         [index[b] for index in x_index])
+            for total, value in zip(sums, values):
+                np.add(total, value, out=total, casting='unsafe')
+    return sums
+
+
+def fold_exposures(partial, images, variances, geometry, shift_rate, rf=3):
+    """
+    Add exposures shifted at shift_rate to the running sums of an incremental SUM or MEAN stack.
+
+    The sums are kept on the native pixel grid, so a stack is brought up to date with a new exposure at the cost of
+    shifting that one exposure.  The sub-pixels of each exposure are summed before the division by the number of
+    frames, so next to nan pixels the stack differs slightly from that of shift_combine.  The sums are float32 and the
+    counts uint16 (see incremental.STATE_DTYPES), which bounds the number of exposures a stack can hold.
+
+    :param partial: (total, num_frames, variance_total, variance_count) arrays, None starts new sums.
+    :param images: list of 2D image arrays on the reference pixel grid, in the order they are added.
+    :param variances: list of 2D variance arrays.
+    :param geometry: exposure_geometry table of the images.
+    :param shift_rate: dictionary with the ra/dec shift rates.
+    :return: the running sums, finish_folded turns them into the stacked image and variance, partial when there are no
+             images.
+    """
+    if not len(images):
+        return partial
+    if partial is None:
+        partial = tuple(np.zeros(images[0].shape, dtype=dtype) for dtype in STATE_DTYPES.values())
+    count_max = np.iinfo(partial[1].dtype).max
+    if int(partial[1].max(initial=0)) + len(images) * rf ** 2 > count_max:
+        raise ValueError(f'An incremental stack can hold at most {count_max // rf ** 2} exposures.')
+    dxs, dys = pixel_shifts(geometry, [shift_rate], rf)
+    for image, variance, frame, dx, dy in zip(images, variances, geometry['frameid'], dxs[0], dys[0]):
+        if abs(dx) > MAX_SHIFT or abs(dy) > MAX_SHIFT:
+            logging.warning(f'Skipping {frame} due to large offset {dx},{dy}')
+            continue
+        with stage('fold'):
+            for total, value in zip(partial, shifted_exposure(image, variance, (dx, dy), rf)):
+                total += value
+    return partial
+
+
+def finish_folded(partial, stacking_mode, rf=3, dtype=None):
+    """
+    Turn the running sums of fold_exposures into the stacked image and variance.
+
+    :param stacking_mode: np.nansum or np.nanmean
+    :param dtype: data type of the stack, default float64.
+    :return: stacked image and stacked variance arrays.
+    """
+    dtype = np.float64 if dtype is None else dtype
+    return finish_partial_sum(tuple(np.asarray(value, dtype=dtype) / rf ** 2 for value in partial), stacking_mode)
+
+
+def shift_combine(images, variances, offsets, rf, stacking_mode, bounds):
+    """
+    Shift and combine sections on their native pixel grid.
+
+    Gives the same result as up-sampling each section by rf, shifting by the up-sampled offsets, combining and
+    down-sampling the stack, without building the rf**2 larger arrays: each of the rf*rf sub-pixel positions is
+    gathered from the native sections and combined in turn, so only one native-sized cube of exposures is held.
+
+    :param images: list of image sections (all the same shape)
+    :param variances: list of variance sections
+    :param offsets: list of (dx, dy) shifts, in up-sampled pixels, for each section
+    :param rf: up-sampling factor the offsets are given in
+    :param stacking_mode: function from STACKING_MODES used to combine the images.
+    :param bounds: (yl, yu, xl, xu) region of the sections to return.
+    :return: stacked image and variance arrays of the bounds region.
+    """
+    yl, yu, xl, xu = bounds
+    ny, nx = images[0].shape
+    y_index = [sub_pixel_index(ny, dy, rf, yl, yu) for dx, dy in offsets]
+    x_index = [sub_pixel_index(nx, dx, rf, xl, xu) for dx, dy in offsets]
+    stacked_data = stacked_variance = None
+    for a in range(rf):
+        for b in range(rf):
+            y_sub = [[index[a] for index in y] for y in y_index]
+            x_sub = [[index[b] for index in x] for x in x_index]
+            if stacking_mode in STREAMING_STACKING_MODES:
+                with stage('combine'):
+                    data, variance = stream_combine(images, variances, y_sub, x_sub, stacking_mode)
+            else:
+                with stage('gather'):
+                    outs = np.array([gather_shifted(image, iy, ix) for image, iy, ix in zip(images, y_sub, x_sub)])
+                    shifted_variances = np.array([gather_shifted(variance, iy, ix)
+                                                  for variance, iy, ix in zip(variances, y_sub, x_sub)])
+                record('gather', peak_array_bytes=outs.nbytes + shifted_variances.nbytes)
+                with stage('combine'):
+                    data, variance = combine(outs, shifted_variances, stacking_mode)
+            if stacked_data is None:
+                stacked_data = np.empty(((yu-yl)*rf, (xu-xl)*rf), dtype=data.dtype)
+                stacked_variance = np.empty(((yu-yl)*rf, (xu-xl)*rf), dtype=variance.dtype)
+            stacked_data[a::rf, b::rf] = data
+            stacked_variance[a::rf, b::rf] = variance
+    logging.debug(f'Down sampling to original grid (poor-mans quick interp method)')
+    with stage('down_sample'):
+        return down_sample_2d(stacked_data, rf), down_sample_2d(stacked_variance, rf)
+
+
+def add_partial_sums(left, right):
+    """
+    Add the running sums of two groups of sections, None stands for a group with no sections.
+
+    The sums of the other group are returned as they are when one group has no sections.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return tuple(left_sum + right_sum for left_sum, right_sum in zip(left, right))
+
+
+def tree_combine(images, variances, rate_offsets, order, rf, stacking_mode, bounds):
+    """
+    Shift and combine sections at many rates on their native pixel grid, sharing partial sums between the rates.
+
+    The sections, taken in time order, are split into a binary tree of groups of neighbouring exposures, the running
+    sums (see stream_combine) of a group being the sum of those of its two halves.  The sums of a group depend only
+    on the shifts of its members and neighbouring rates give the same shifts to the exposures taken close to the
+    reference epoch, so each (group, shifts) partial sum needed by more than one rate is computed once, and kept
+    only until its last use.  An extra rate then costs the groups whose shifts change, not every exposure.
+
+    Gives the same result as shift_combine at each rate, up to floating point rounding, for the SUM and MEAN modes.
+
+    :param images: list of image sections (all the same shape)
+    :param variances: list of variance sections
+    :param rate_offsets: for each rate, a list of the (dx, dy) shift of each section, None leaves the section out.
+    :param order: indices of the sections in time order
+    :param rf: up-sampling factor the offsets are given in
+    :param stacking_mode: np.nansum or np.nanmean
+    :param bounds: (yl, yu, xl, xu) region of the sections to return.
+    :return: list of (image, variance) arrays of the bounds region, one for each rate.
+    """
+    yl, yu, xl, xu = bounds
+    ny, nx = images[0].shape
+    root = (0, len(order))
+
+    def children(lo, hi):
+        middle = (lo + hi) // 2
+        return (lo, middle), (middle, hi)
+
+    def node_key(rate_idx, lo, hi):
+        return lo, hi, tuple(rate_offsets[rate_idx][idx] for idx in order[lo:hi])
+
+    # count the uses of each partial sum, a group seen before comes from the cache so is not descended into.
+    uses = {}
+
+    def count_uses(rate_idx, lo, hi):
+        key = node_key(rate_idx, lo, hi)
+        uses[key] = uses.get(key, 0) + 1
+        if uses[key] == 1 and hi - lo > 1:
+            for child in children(lo, hi):
+                count_uses(rate_idx, *child)
+
+    y_index = {}
+    x_index = {}
+    for rate_idx, offsets in enumerate(rate_offsets):
+        count_uses(rate_idx, *root)
+        for offset in offsets:
+            if offset is not None:
+                dx, dy = offset
+                if dy not in y_index:
+                    y_index[dy] = sub_pixel_index(ny, dy, rf, yl, yu)
+                if dx not in x_index:
+                    x_index[dx] = sub_pixel_index(nx, dx, rf, xl, xu)
+    logging.debug(f'Combining {len(rate_offsets)} rates from {len(uses)} partial sums')
+
+    def partial_sum(rate_idx, lo, hi, a, b, cache, remaining):
+        key = node_key(rate_idx, lo, hi)
+        remaining[key] -= 1
+        if key in cache:
+            partial = cache[key]
+            if remaining[key] == 0:
+                del cache[key]
+            return partial
+        if hi - lo == 1:
+            idx = order[lo]
+            partial = None
+            if rate_offsets[rate_idx][idx] is not None:
+                dx, dy = rate_offsets[rate_idx][idx]
+                partial = shifted_partial_sum(images[idx], variances[idx],
+                                              [index[a] for index in y_index[dy]],
+                                              [index[b] for index in x_index[dx]])
+        else:
+            partial = add_partial_sums(*[partial_sum(rate_idx, *child, a, b, cache, remaining)
+                                         for child in children(lo, hi)])
+        if remaining[key] > 0:
+            cache[key] = partial
+        return partial
+
+    stacked_data = [None] * len(rate_offsets)
+    stacked_variance = [None] * len(rate_offsets)
+    for a in range(rf):
+        for b in range(rf):
+            cache = {}
+            remaining = dict(uses)
+            for rate_idx in range(len(rate_offsets)):
+                partial = partial_sum(rate_idx, *root, a, b, cache, remaining)
+                if partial is None:
+                    data = np.full((yu-yl, xu-xl), np.nan)
+                    variance = np.full((yu-yl, xu-xl), np.nan)
+                else:
+                    if any(partial is value for value in cache.values()):
+                        # the sums are kept for another rate, as those of the root or, when the rest of the tree
+                        # is left out, of a group that add_partial_sums passed on, so keep them intact.
+                        partial = tuple(np.copy(value) for value in partial)
+                    data, variance = finish_partial_sum(partial, stacking_mode)
+                # down sample by accumulating the rf*rf sub-pixel positions.
+                if stacked_data[rate_idx] is None:
+                    stacked_data[rate_idx] = data
+                    stacked_variance[rate_idx] = variance
+                else:
+                    stacked_data[rate_idx] += data
+                    stacked_variance[rate_idx] += variance
+    return [(data / rf**2, variance / rf**2) for data, variance in zip(stacked_data, stacked_variance)]
+
+
+def add_linear_shift(total, values, dx, dy):
+    """
+    Add values, shifted by dx, dy pixels using linear interpolation between pixels, to total.
+
+    :param total: 2D array to add to, same shape as values.
+    :param values: 2D array to shift, pixels shifted off the array are dropped.
+    :param dx: shift along axis 1 (pixels)
+    :param dy: shift along axis 0 (pixels)
+    """
+    ny, nx = values.shape
+    x_pixels = int(np.floor(dx))
+    y_pixels = int(np.floor(dy))
+    for sy, wy in ((y_pixels, 1 - (dy - y_pixels)), (y_pixels + 1, dy - y_pixels)):
+        for sx, wx in ((x_pixels, 1 - (dx - x_pixels)), (x_pixels + 1, dx - x_pixels)):
+            if wy * wx == 0 or abs(sy) >= ny or abs(sx) >= nx:
+                continue
+            total[max(0, sy):ny + min(0, sy), max(0, sx):nx + min(0, sx)] += \
+                wy * wx * values[max(0, -sy):ny - max(0, sy), max(0, -sx):nx - max(0, sx)]
+
+
+def fourier_combine(images, variances, rate_shifts, stacking_mode, bounds, pad):
+    """
+    Shift and combine sections at many rates using exact fractional pixel shifts applied as Fourier phase ramps.
+
+    Shifting is linear, so the sum of the shifted images at a rate is the inverse transform of the sum of the image
+    transforms times their phase ramps: each image section is transformed once and every rate then costs a
+    multiply-add per section and one inverse transform.  nan pixels are given zero weight, the 0/1 weight maps and the
+    variances are shifted by linear interpolation, which unlike a phase ramp does not ring around the nan pixels, and
+    the sums are normalised by the shifted weights.
+
+    :param images: list of image sections (all the same shape)
+    :param variances: list of variance sections
+    :param rate_shifts: for each rate, a list of the (dx, dy) shift (pixels) of each section, None leaves the
+                        section out.
+    :param stacking_mode: np.nansum or np.nanmean
+    :param bounds: (yl, yu, xl, xu) region of the sections to return.
+    :param pad: zeros added around each image section, at least the largest shift, so shifts do not wrap around.
+    :return: list of (image, variance) arrays of the bounds region, one for each rate, pixels covered by less than half
+             an exposure are nan.
+    """
+    yl, yu, xl, xu = bounds
+    shape = images[0].shape[0] + 2*pad, images[0].shape[1] + 2*pad
+    transforms = []
+    weights = []
+    weighted_variances = []
+    variance_weights = []
+    for image, variance in zip(images, variances):
+        dtype = np.result_type(image.dtype, np.float32)
+        weight = ~np.isnan(image)
+        variance_weight = ~np.isnan(variance)
+        transforms.append(np.fft.rfft2(np.pad(np.where(weight, image, 0).astype(dtype), pad)))
+        weights.append(weight.astype(dtype))
+        weighted_variances.append(np.where(variance_weight, variance, 0).astype(dtype))
+        variance_weights.append(variance_weight.astype(dtype))
+    y_frequency = np.fft.fftfreq(shape[0])
+    x_frequency = np.fft.rfftfreq(shape[1])
+
+    stacks = []
+    for shifts in rate_shifts:
+        total = np.zeros_like(transforms[0])
+        weight, variance, variance_weight = [np.zeros(images[0].shape) for _ in range(3)]
+        for idx, offset in enumerate(shifts):
+            if offset is None:
+                continue
+            dx, dy = offset
+            # shifting by +dx, +dy pixels multiplies the transform by exp(-2 pi i (k_x dx + k_y dy))
+            ramp = np.outer(np.exp(-2j * np.pi * y_frequency * dy), np.exp(-2j * np.pi * x_frequency * dx))
+            total += transforms[idx] * ramp.astype(total.dtype)
+            add_linear_shift(weight, weights[idx], dx, dy)
+            add_linear_shift(variance, weighted_variances[idx], dx, dy)
+            add_linear_shift(variance_weight, variance_weights[idx], dx, dy)
+        data = np.fft.irfft2(total, s=shape)[pad+yl:pad+yu, pad+xl:pad+xu]
+        weight = weight[yl:yu, xl:xu]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if stacking_mode == np.nanmean:
+                data = data / weight
+            variance = variance[yl:yu, xl:xu] / variance_weight[yl:yu, xl:xu] / weight
+        uncovered = weight < 0.5
+        data[uncovered] = np.nan
+        variance[uncovered] = np.nan
+        stacks.append((data, variance))
+    return stacks
+
+
+def fov_corner(header):
+    """
+    The pixel location used to register exposures, follows the (NAXIS2, NAXIS1) ordering of data.shape.
+    """
+    return [header['NAXIS2'], header['NAXIS1']]
+
+
+def exposure_geometry(hdus, reference_hdu):
+    """
+    Build a table of the quantities needed to compute the shift of each exposure relative to reference_hdu.
+
+    These are constant for an exposure, so the table is built once and the pixel shifts at any set of rates are then
+    computed with pixel_shifts.
+
+    The table is a dictionary of arrays with one entry per exposure in hdus:
+      frameid: FRAMEID of the exposure
+      mjd: MJD at mid-exposure
+      dt: time from the reference mid-exposure (hours)
+      offset: (ra, dec) offset (arc-seconds) from the reference FOV corner to the exposure FOV corner
+      jacobian: 2x2 matrix of pixels per arc-second of (ra, dec) at the exposure FOV corner
+
+    :param hdus: list of HDUList
+    :param reference_hdu: reference HDUList
+    :return: dict
+    """
+    with stage('geometry'):
+        reference_mjd = mid_exposure_mjd(reference_hdu[0])
+        reference_corner = WCS(reference_hdu[1].header).wcs_pix2world([fov_corner(reference_hdu[1].header), ],
+                                                                      0)[0]
+        logging.debug(f'Reference Sky Coord {reference_corner}')
+        logging.debug(f'Reference exposure taken at {reference_mjd.isot}')
+        geometry = {'frameid': [], 'mjd': [], 'dt': [], 'offset': [], 'jacobian': []}
+        # step (degrees) used for the central difference estimate of the jacobian.
+        step = 1.0/3600.0
+        for hdu in hdus:
+            header = hdu[HSC_HDU_MAP['image']].header
+            mjd = mid_exposure_mjd(hdu[0])
+            wcs = WCS(header)
+            corner = wcs.wcs_pix2world([fov_corner(header), ], 0)[0]
+            steps = np.array([[corner[0] + step, corner[1]], [corner[0] - step, corner[1]],
+                              [corner[0], corner[1] + step], [corner[0], corner[1] - step]])
+            pixels = wcs.wcs_world2pix(steps, 0)
+            jacobian = np.array([(pixels[0] - pixels[1]), (pixels[2] - pixels[3])]).T / (2 * step * 3600.0)
+            geometry['frameid'].append(hdu[0].header.get('FRAMEID', 'Unknown'))
+            geometry['mjd'].append(mjd.mjd)
+            geometry['dt'].append((mjd - reference_mjd).to_value(units.hour))
+            geometry['offset'].append((reference_corner - corner) * 3600.0)
+            geometry['jacobian'].append(jacobian)
+        geometry = {key: np.array(value) for key, value in geometry.items()}
+        # keep the shapes of the per exposure vectors and matrices when there are no exposures.
+        geometry['offset'] = geometry['offset'].reshape(-1, 2)
+        geometry['jacobian'] = geometry['jacobian'].reshape(-1, 2, 2)
+        return geometry
+
+
+def pixel_offsets(geometry, rates):
+    """
+    Compute the (fractional) pixel shifts of every exposure in geometry at every rate in rates.
+
+    :param geometry: exposure geometry table from exposure_geometry
+    :param rates: list of dictionaries with the ra/dec shift rates.
+    :return: dx, dy float arrays of shape (len(rates), number of exposures)
+    """
+    rate_unit = units.arcsecond/units.hour
+    rx = np.array([rate['dra'].to_value(rate_unit) for rate in rates])
+    ry = np.array([rate['ddec'].to_value(rate_unit) for rate in rates])
+    # sky motion (arc-seconds) less the offset needed to align the exposure with the reference.
+    dra = rx[:, None] * geometry['dt'][None, :] - geometry['offset'][None, :, 0]
+    ddec = ry[:, None] * geometry['dt'][None, :] - geometry['offset'][None, :, 1]
+    jacobian = geometry['jacobian']
+    dx = jacobian[None, :, 0, 0] * dra + jacobian[None, :, 0, 1] * ddec
+    dy = jacobian[None, :, 1, 0] * dra + jacobian[None, :, 1, 1] * ddec
+    return dx, dy
+
+
+def pixel_shifts(geometry, rates, rf=3):
+    """
+    Compute the up-sampled integer pixel shifts of every exposure in geometry at every rate in rates.
+
+    :param geometry: exposure geometry table from exposure_geometry
+    :param rates: list of dictionaries with the ra/dec shift rates.
+    :param rf: up-sampling factor of the shifts.
+    :return: dx, dy integer arrays of shape (len(rates), number of exposures)
+    """
+    dx, dy = pixel_offsets(geometry, rates)
+    return np.trunc(rf * dx).astype(int), np.trunc(rf * dy).astype(int)
+
+
+def shift_padding(dxs, dys, rf=3):
+    """
+    Margin of native pixels a section must be extended by so that every shifted pixel comes from the data.
+
+    :param dxs: x shifts (up-sampled pixels) of each exposure at each rate, see pixel_shifts.
+    :param dys: y shifts (up-sampled pixels), shifts larger than MAX_SHIFT are not used so need no padding.
+    :param rf: up-sampling factor of the shifts
+    :return: padding in native pixels
+    """
+    use = (np.fabs(dxs) <= MAX_SHIFT) & (np.fabs(dys) <= MAX_SHIFT)
+    if not np.any(use):
+        return 0
+    return int(math.ceil(max(np.fabs(dxs[use]).max(), np.fabs(dys[use]).max()) / rf))
+
+
+def shift(hdus, reference_hdu, rate, rf=3, stacking_mode=None, section_size=1024, geometry=None, threads=1,
+          dtype=None):
     """
     Original pixel grid expansion shift+stack code from wes.
 
-    :rtype: fits.HDUList
+    The images are shifted in steps of 1/rf pixels and combined on the native pixel grid by shift_combine.  When rate
+    is a list of rates each section of the input images is extracted once and then shifted+stacked at every rate in
+    the list before moving to the next section, the result for each rate is identical to calling shift with that
+    single rate.
+
+    :param rate: dictionary with the ra/dec shift rates, or list of such dictionaries.
+    :param geometry: exposure_geometry table of hdus, built here if not given.
+    :param threads: number of threads stacking sections in parallel.
+    :param dtype: data type the stacking is done in (see shift_stack).
+    :rtype: fits.HDUList or list of fits.HDUList
+    :return: combined data after shifting at dx/dy and combined using stacking_mode.
+    """
+    rates = rate if isinstance(rate, (list, tuple)) else [rate]
+    if geometry is None:
+        geometry = exposure_geometry(hdus, reference_hdu)
+    stacks = shift_stack([hdu[HSC_HDU_MAP['image']].data for hdu in hdus],
+                         [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus],
+                         geometry, rates, rf=rf, stacking_mode=stacking_mode, section_size=section_size,
+                         threads=threads, dtype=dtype)
+    hdu_lists = [stack_hdu_list(reference_hdu[0].header,
+                                reference_hdu[HSC_HDU_MAP['image']].header,
+                                reference_hdu[HSC_HDU_MAP['variance']].header,
+                                image_array, variance_array) for image_array, variance_array in stacks]
+    if isinstance(rate, (list, tuple)):
+        return hdu_lists
+    return hdu_lists[0]
+
+
+def tree_shift(hdus, reference_hdu, rate, rf=3, stacking_mode=None, section_size=1024, geometry=None, threads=1,
+               dtype=None):
+    """
+    Synthetic tracking version of shift for the SUM and MEAN modes, the rates in a list share partial stacks.
+
+    Stacks the same as shift (up to floating point rounding), but the exposures are combined through a tree of
+    partial sums of neighbouring exposures that is shared by all the rates in the list (see tree_combine), so pass
+    many neighbouring rates at once.
+
+    :param rate: dictionary with the ra/dec shift rates, or list of such dictionaries.
+    :param geometry: exposure_geometry table of hdus, built here if not given.
+    :param threads: number of threads stacking sections in parallel.
+    :param dtype: data type the stacking is done in (see shift_stack).
+    :rtype: fits.HDUList or list of fits.HDUList
     :return: combined data after shifting at dx/dy and combined using stacking_mode.
     """
+    if stacking_mode not in ['SUM', 'MEAN', None]:
+        logging.warning(f'{stacking_mode} not available for tree shift stack. Setting to MEAN')
+        stacking_mode = 'MEAN'
+    rates = rate if isinstance(rate, (list, tuple)) else [rate]
+    if geometry is None:
+        geometry = exposure_geometry(hdus, reference_hdu)
+    stacks = shift_stack([hdu[HSC_HDU_MAP['image']].data for hdu in hdus],
+                         [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus],
+                         geometry, rates, rf=rf, stacking_mode=stacking_mode, section_size=section_size,
+                         threads=threads, partial_sums=True, dtype=dtype)
+    hdu_lists = [stack_hdu_list(reference_hdu[0].header,
+                                reference_hdu[HSC_HDU_MAP['image']].header,
+                                reference_hdu[HSC_HDU_MAP['variance']].header,
+                                image_array, variance_array) for image_array, variance_array in stacks]
+    if isinstance(rate, (list, tuple)):
+        return hdu_lists
+    return hdu_lists[0]
+
+
+def fourier_shift(hdus, reference_hdu, rate, rf=3, stacking_mode=None, section_size=1024, geometry=None,
+                  threads=1, dtype=None):
+    """
+    Shift+stack with exact fractional pixel shifts done as Fourier phase ramps, for the SUM and MEAN modes.
+
+    Each section of each exposure is Fourier transformed once for all the rates in the list (see fourier_combine), so
+    pass many rates at once.  The exposures used are those shift would use with up-sampling factor rf.
+
+    :param rate: dictionary with the ra/dec shift rates, or list of such dictionaries.
+    :param geometry: exposure_geometry table of hdus, built here if not given.
+    :param threads: number of threads stacking sections in parallel.
+    :param dtype: data type the stacking is done in (see shift_stack).
+    :rtype: fits.HDUList or list of fits.HDUList
+    :return: combined data after shifting at dx/dy and combined using stacking_mode.
+    """
+    if stacking_mode not in ['SUM', 'MEAN', None]:
+        logging.warning(f'{stacking_mode} not available for fourier shift stack. Setting to MEAN')
+        stacking_mode = 'MEAN'
+    rates = rate if isinstance(rate, (list, tuple)) else [rate]
+    if geometry is None:
+        geometry = exposure_geometry(hdus, reference_hdu)
+    stacks = shift_stack([hdu[HSC_HDU_MAP['image']].data for hdu in hdus],
+                         [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus],
+                         geometry, rates, rf=rf, stacking_mode=stacking_mode, section_size=section_size,
+                         threads=threads, fourier=True, dtype=dtype)
+    hdu_lists = [stack_hdu_list(reference_hdu[0].header,
+                                reference_hdu[HSC_HDU_MAP['image']].header,
+                                reference_hdu[HSC_HDU_MAP['variance']].header,
+                                image_array, variance_array) for image_array, variance_array in stacks]
+    if isinstance(rate, (list, tuple)):
+        return hdu_lists
+    return hdu_lists[0]
+
+
+def shift_stack(images, variances, geometry, rates, rf=3, stacking_mode=None, section_size=1024, threads=1,
+                sections=None, partial_sums=False, fourier=False, dtype=None):
+    """
+    Shift+stack image and variance arrays at each of the rates, the array level work of shift.
+
+    :param images: list (or cube) of 2D image arrays, all on the reference pixel grid.
+    :param variances: list (or cube) of 2D variance arrays.
+    :param geometry: exposure_geometry table of the images.
+    :param rates: list of dictionaries with the ra/dec shift rates.
+    :param threads: number of threads stacking sections in parallel.
+    :param sections: (yo, xo) origins of the sections to stack, default is all sections, others are set to nan.
+    :param partial_sums: combine the rates with tree_combine, sharing partial sums (SUM and MEAN only).
+    :param fourier: combine the rates with fourier_combine, using exact fractional shifts (SUM and MEAN only).
+    :param dtype: data type (e.g. float32) the images are converted to, once, and that the shifted sections and the
+                  stacks are held in. Default stacks the images as they are into float64 stacks.
+    :return: list of (image_array, variance_array), one for each rate.
+    """
+    if dtype is not None:
+        # native byte order, so sections are not converted each time they are gathered.
+        images = [np.asarray(image, dtype=dtype) for image in images]
+        variances = [np.asarray(variance, dtype=dtype) for variance in variances]
     if stacking_mode is None:
         stacking_mode = 'SUM'
     logging.info(f'Combining images using {stacking_mode}')
     stacking_mode = STACKING_MODES.get(stacking_mode, STACKING_MODES['DEFAULT'])
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        for this_rate in rates:
+            logging.info(f'Shifting at ({this_rate["dra"]},{this_rate["ddec"]})')
 
-    rx = rate['dra']
-    ry = rate['ddec']
-    logging.info(f'Shifting at ({rx},{ry})')
-
-    mid_mjd = mid_exposure_mjd(reference_hdu[0])
-    wcs = WCS(reference_hdu[1].header)
-    ref_skycoord = wcs.wcs_pix2world([reference_hdu[1].data.shape, ], 0)
-    logging.debug(f'Reference Sky Coord {ref_skycoord}')
-    logging.debug(f'Reference exposure taken at {mid_mjd.isot}')
-    logging.info(f'Shifting {len(hdus)} to remove object motion')
-    y_section_grid = np.arange(0, reference_hdu[1].data.shape[0], section_size)
+    # compute the x and y shift for each image at each rate, scaled by the up-sampling factor.
+    dxs, dys = pixel_shifts(geometry, rates, rf)
+    use = (np.fabs(dxs) <= MAX_SHIFT) & (np.fabs(dys) <= MAX_SHIFT)
+    for rate_idx, exposure_idx in zip(*np.nonzero(~use)):
+        logging.warning(f'Skipping {geometry["frameid"][exposure_idx]} due to large offset '
+                        f'{dxs[rate_idx, exposure_idx]},{dys[rate_idx, exposure_idx]}')
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # formatting the shifts of every exposure at every rate is costly for large rate grids.
+        logging.debug(f'Up-scaled pixel shifts dx: {dxs} dy: {dys}')
+    padding = shift_padding(dxs, dys, rf)
+    if fourier:
+        # phase ramps ring around the edges of a section, so those are kept MAX_SHIFT pixels away.
+        padding = MAX_SHIFT
+    logging.debug(f'Extending sections by {padding} pixels')
+    rate_offsets = [[(int(dx), int(dy)) if good else None for dx, dy, good in zip(dxs[rate_idx], dys[rate_idx],
+                                                                                   use[rate_idx])]
+                    for rate_idx in range(len(rates))]
+    # partial sums are grouped by neighbouring exposures in time.
+    order = np.argsort(geometry['dt'], kind='stable')
+    if fourier:
+        x_shifts, y_shifts = pixel_offsets(geometry, rates)
+        rate_shifts = [[(dx, dy) if good else None for dx, dy, good in zip(x_shifts[rate_idx], y_shifts[rate_idx],
+                                                                            use[rate_idx])]
+                       for rate_idx in range(len(rates))]
+
+    logging.info(f'Shifting {len(images)} to remove object motion')
+    shape = images[0].shape
+    y_section_grid = np.arange(0, shape[0], section_size)
     logging.debug(f'Chunk grid: y {y_section_grid}')
-    x_section_grid = np.arange(0, reference_hdu[1].data.shape[1], section_size)
+    x_section_grid = np.arange(0, shape[1], section_size)
     logging.debug(f'Chunk grid: y {x_section_grid}')
-    image_array = np.zeros(reference_hdu[1].data.shape)
-    variance_array = np.zeros(reference_hdu[1].data.shape)
-    padding = 130
-    # setup the space to store the scaled up image and variance
-    # scaled_images = {}
-    # scaled_variances = {}
-    # for hdu in hdus:
-    #     scaled_images[frameid(hdu)] = np.zeros((rf*(section_size+2*padding), rf*(section_size+2*padding)))
-    #     scaled_variances[frameid(hdu)] = np.zeros((rf*(section_size+2*padding), rf*(section_size+2*padding)))
+    fill = 0.0 if sections is None else np.nan
+    image_arrays = [np.full(shape, fill, dtype=dtype) for _ in rates]
+    variance_arrays = [np.full(shape, fill, dtype=dtype) for _ in rates]
+    tiles = []
     for yo in y_section_grid:
         # yo,yp are the bounds were data will be inserted into image_array
         # but we need y1,y2 range of data to come from input to allow for 
         # shifting of pixel boundaries.
         yo = int(yo)
         y1 = int(max(0, yo-padding))
-        yp = int(min(image_array.shape[0], yo+section_size))
-        y2 = int(min(image_array.shape[0], yp+padding))
+        yp = int(min(shape[0], yo+section_size))
+        y2 = int(min(shape[0], yp+padding))
         yl = yo - y1
         yu = yl + yp - yo 
         for xo in x_section_grid:
             xo = int(xo)
             x1 = int(max(0, xo-padding))
-            xp = int(min(image_array.shape[1], xo+section_size))
-            x2 = int(min(image_array.shape[1], xp+padding))
+            xp = int(min(shape[1], xo+section_size))
+            x2 = int(min(shape[1], xp+padding))
             xl = xo - x1
             xu = xl + xp - xo
-            logging.debug(f'Taking section {y1,y2,x1,x2} shifting, '
-                          f'cutting out {yl,yu,xl,xu} '
-                          f'and  placing in {yo,yp,xo,xp} ')
-            # outs contains the shifted versions of the arrays after down sampling.
-            outs = []
-            variances = []
-            for hdu in hdus:
-                # compute the x and y shift for image at this time and scale the size of shift for the
-                # scaling factor of this shift.
-                logging.debug(f'Adding exposure taken at {mid_exposure_mjd(hdu[0]).isot}')
-                wcs = WCS(hdu[1].header)
-                dra = (rx*(mid_exposure_mjd(hdu[0]) - mid_mjd)).decompose()
-                ddec = (ry*(mid_exposure_mjd(hdu[0]) - mid_mjd)).decompose()
-                logging.debug(f'Working on array {hdu[0]} of size '
-                              f'{hdu[1].data.shape} and shifting by '
-                              f'dx {dra} and dy {ddec}')
-                # Use the WCS to determine the x/y shit to allow for different ccd orientations.
-                sky_coord = wcs.wcs_pix2world((hdu[1].data.shape,), 0)
-                logging.debug(f'Corner of the FOV is {sky_coord}')
-                # Add offset needed to align the corner of the image with the reference image.
-                dra -= (ref_skycoord[0][0] - sky_coord[0][0])*units.degree
-                ddec -= (ref_skycoord[0][1] - sky_coord[0][1])*units.degree
-                c1 = wcs.wcs_world2pix(sky_coord, 0)
-                c2 = wcs.wcs_world2pix([[sky_coord[0][0]+dra.to('degree').value,
-                                         sky_coord[0][1]+ddec.to('degree').value], ], 0)
-                dx = int(rf*(c2[0][0]-c1[0][0]))
-                dy = int(rf*(c2[0][1]-c1[0][1]))
-                if math.fabs(dx) > padding or math.fabs(dy) > padding:
-                    logging.warning(f'Skipping {hdu[0].header.get("FRAMEID", "Unknown")} due to large offset {dx},{dy}')
-                    continue
-                logging.debug(f'Translates into a up-scaled pixel shift of {dx},{dy}')
-
-                # Weight by the variance. 
-                # up_sample_2d(scaled_images[frameid(hdu)], hdu[HSC_HDU_MAP['image']].data[y1:y2, x1:x2], rf)
-                # up_sample_2d(scaled_variances[frameid(hdu)], hdu[HSC_HDU_MAP['variance']].data[y1:y2, x1:x2], rf)
-                # y_dim = (y2-y1)*rf
-                # x_dim = (x2-x1)*rf
-                # rep = scaled_images[frameid(hdu)][0:ydim,0:xdim]
-                # variance = scaled_variances[frameid(hdu)][0:ydim,0:xdim]
-                rep = np.repeat(np.repeat(hdu[HSC_HDU_MAP['image']].data[y1:y2, x1:x2], rf, axis=0),
-                                rf, axis=1)
-                logging.debug("Data from shape {} has been sampled into shape {}".format(
-                    hdu[1].data[y1:y2, x1:x2].shape, rep.shape))
-                variance = np.repeat(np.repeat(hdu[HSC_HDU_MAP['variance']].data[y1:y2, x1:x2], rf, axis=0),
-                                     rf, axis=1)
-                # dest_bounds are range of the index where the data should go into
-                # source_bounds are the range of the index where the data come from.
-                # this creates a shift in the data, using index bounds.
-                offsets = {1: dx, 0: dy}
-                dest_bounds = [[0, rep.shape[0]], [0, rep.shape[1]]]
-                source_bounds = [[0, rep.shape[0]], [0, rep.shape[1]]]
-                for axis in offsets:
-                    if offsets[axis] < 0:
-                        dest_bounds[axis] = 0, rep.shape[axis] + offsets[axis]
-                        source_bounds[axis] = -offsets[axis], rep.shape[axis]
-                    elif offsets[axis] > 0:
-                        dest_bounds[axis] = offsets[axis], rep.shape[axis]
-                        source_bounds[axis] = 0, rep.shape[axis] - offsets[axis]
-                logging.debug(f'Placing data from section {source_bounds} into {dest_bounds}')
-                rep[dest_bounds[0][0]:dest_bounds[0][1], dest_bounds[1][0]:dest_bounds[1][1]] = \
-                    rep[source_bounds[0][0]:source_bounds[0][1], source_bounds[1][0]:source_bounds[1][1]]
-                variance[dest_bounds[0][0]:dest_bounds[0][1], dest_bounds[1][0]:dest_bounds[1][1]] = \
-                    variance[source_bounds[0][0]:source_bounds[0][1], source_bounds[1][0]:source_bounds[1][1]]
-                outs.append(rep)
-                variances.append(variance)
-            variances = np.array(variances)
-            outs = np.array(outs)
-            # count up data where pixels were not 'nan'
-            num_frames = numpy.sum(~numpy.isnan(outs), axis=0)
-            logging.debug(f'Stacking {len(outs)} images of shape {outs[0].shape}')
-            logging.debug(f'Combining shifted pixels')
-            if stacking_mode == weighted_quantile:
-                stacked_data = stacking_mode(outs, 0.50001, 1./variances)
+            if sections is not None and (yo, xo) not in sections:
+                continue
+            tiles.append(((y1, y2, x1, x2), (yl, yu, xl, xu), (yo, yp, xo, xp)))
+
+    def stack_tile(tile):
+        (y1, y2, x1, x2), bounds, (yo, yp, xo, xp) = tile
+        logging.debug(f'Taking section {y1,y2,x1,x2} shifting, '
+                      f'cutting out {bounds} '
+                      f'and  placing in {yo,yp,xo,xp} ')
+        # extract each exposure section once, the shifts for each rate are then taken from these.
+        image_sections = [image[y1:y2, x1:x2] for image in images]
+        variance_sections = [variance[y1:y2, x1:x2] for variance in variances]
+        if partial_sums or fourier:
+            if fourier:
+                with stage('fourier_combine'):
+                    stacks = fourier_combine(image_sections, variance_sections, rate_shifts, stacking_mode, bounds,
+                                             padding // rf + 1)
             else:
-                stacked_data = stacking_mode(outs, overwrite_input=True, axis=0)
-            logging.debug(f'Setting variance to mean variance / N frames')
-            stacked_variance = STACKING_MODES['MEAN'](variances, axis=0)/num_frames
-            logging.debug(f'Got back stack of shape {stacked_data.shape}, downSampling...')
-            logging.debug(f'Down sampling to original grid (poor-mans quick interp method)')
-            image_array[yo:yp, xo:xp] = down_sample_2d(stacked_data, rf)[yl:yu, xl:xu]
-            variance_array[yo:yp, xo:xp] = down_sample_2d(stacked_variance, rf)[yl:yu, xl:xu]
+                with stage('tree_combine'):
+                    stacks = tree_combine(image_sections, variance_sections, rate_offsets, order, rf, stacking_mode,
+                                          bounds)
+            for rate_idx, (image_array, variance_array) in enumerate(stacks):
+                image_arrays[rate_idx][yo:yp, xo:xp] = image_array
+                variance_arrays[rate_idx][yo:yp, xo:xp] = variance_array
+            return
+        for rate_idx in range(len(rates)):
+            selected = np.nonzero(use[rate_idx])[0]
+            offsets = [rate_offsets[rate_idx][idx] for idx in selected]
+            image_arrays[rate_idx][yo:yp, xo:xp], variance_arrays[rate_idx][yo:yp, xo:xp] = \
+                shift_combine([image_sections[idx] for idx in selected],
+                              [variance_sections[idx] for idx in selected],
+                              offsets, rf, stacking_mode, bounds)
+
+    # tiles write to disjoint parts of the output arrays, so can be stacked in any order.
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(stack_tile, tiles))
+    else:
+        for tile in tiles:
+            stack_tile(tile)
+    return list(zip(image_arrays, variance_arrays))
+
+
+def stack_hdu_list(primary_header, image_header, variance_header, image_array, variance_array):
+    """
+    Package the stacked image and variance into an HDUList with the reference headers.
+
+    :rtype: fits.HDUList
+    """
     logging.debug(f'Down sampled image has shape {image_array.shape}')
-    hdu_list = fits.HDUList([fits.PrimaryHDU(header=reference_hdu[0].header),
-                             fits.ImageHDU(data=image_array, header=reference_hdu[HSC_HDU_MAP['image']].header),
-                             fits.ImageHDU(data=variance_array, header=reference_hdu[HSC_HDU_MAP['variance']].header)])
+    hdu_list = fits.HDUList([fits.PrimaryHDU(header=primary_header),
+                             fits.ImageHDU(data=image_array, header=image_header),
+                             fits.ImageHDU(data=variance_array, header=variance_header)])
     hdu_list[1].header['EXTNAME'] = 'STACK'
     hdu_list[2].header['EXTNAME'] = 'VARIANCE'
     return hdu_list
@@ -341,7 +1361,372 @@ def mid_exposure_mjd(hdu):
     return mjd_start + (mjd_end - mjd_start)/2.0
 
 
-def main():
+def sky_motion(rate):
+    """
+    Convert a rate/angle entry of shift_rates to the ra/dec shift rates used by the stacking functions.
+    """
+    dra = rate['rate']*np.cos(np.deg2rad(rate['angle'])) * units.arcsecond/units.hour
+    ddec = rate['rate']*np.sin(np.deg2rad(rate['angle'])) * units.arcsecond/units.hour
+    return {'dra': dra, 'ddec': ddec}
+
+
+def bin_hdu_list(hdu, fr):
+    """
+    Bin the image and variance of an exposure by fr, adjusting the WCS to match.
+
+    Pixels are averaged with down_sample_2d ignoring nan pixels, the variance is that of the binned mean.  Rows and
+    columns beyond a multiple of fr are dropped.
+
+    :param hdu: HDUList of an exposure
+    :param fr: binning factor
+    :return: fits.HDUList laid out as HSC_HDU_MAP, the mask is empty.
+    """
+    header = hdu[HSC_HDU_MAP['image']].header.copy()
+    for key in ['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'CDELT1', 'CDELT2']:
+        if key in header:
+            header[key] *= fr
+    for key in ['CRPIX1', 'CRPIX2']:
+        header[key] = (header[key] - 0.5) / fr + 0.5
+    shape = hdu[HSC_HDU_MAP['image']].data.shape
+    ny, nx = fr * (shape[0] // fr), fr * (shape[1] // fr)
+    binned = {}
+    for layer in ['image', 'variance']:
+        data = hdu[HSC_HDU_MAP[layer]].data[:ny, :nx]
+        good = ~np.isnan(data)
+        fraction = down_sample_2d(good.astype(np.float32), fr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            binned[layer] = (down_sample_2d(np.where(good, data, 0).astype(np.float32), fr) / fraction)
+    binned['variance'] /= (fr**2 * fraction)
+    hdu_list = [fits.PrimaryHDU(header=hdu[0].header)]
+    for layer in ['image', 'mask', 'variance']:
+        data = binned.get(layer, np.zeros(binned['image'].shape, dtype=np.uint16))
+        hdu_list.append(fits.ImageHDU(data=data, header=header))
+    return fits.HDUList(hdu_list)
+
+
+def coarse_rate_cells(rates, coarse_rates):
+    """
+    Assign each rate to the coarse rate nearest to it, in units of the spacing of the coarse grid.
+
+    :param rates: list of rate/angle dictionaries (see shift_rates)
+    :param coarse_rates: list of rate/angle dictionaries of the coarse grid
+    :return: list with the index into coarse_rates of the cell holding each rate.
+    """
+    coarse = np.array([[rate['rate'], rate['angle']] for rate in coarse_rates], dtype=float)
+    fine = np.array([[rate['rate'], rate['angle']] for rate in rates], dtype=float)
+    scale = np.array([np.ptp(coarse[:, idx]) / max(1, len(np.unique(coarse[:, idx])) - 1) for idx in range(2)])
+    scale[scale == 0] = 1.0
+    distance = (((fine[:, None, :] - coarse[None, :, :]) / scale)**2).sum(axis=-1)
+    return list(np.argmin(distance, axis=1))
+
+
+def significant_sections(image, variance, fr, shape, section_size, threshold):
+    """
+    Find the sections of the full resolution grid where a binned stack has a pixel above threshold S/N.
+
+    :param image: binned stacked image
+    :param variance: binned stacked variance
+    :param fr: binning factor of the stack
+    :param shape: shape of the full resolution image
+    :param section_size: size of the full resolution sections
+    :param threshold: S/N needed for a section to be significant
+    :return: set of (yo, xo) origins of significant sections.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = image / np.sqrt(variance)
+    sections = set()
+    for yo in range(0, shape[0], section_size):
+        for xo in range(0, shape[1], section_size):
+            tile = snr[yo//fr:(yo+section_size)//fr, xo//fr:(xo+section_size)//fr]
+            if tile.size > 0 and np.nanmax(tile, initial=-np.inf) >= threshold:
+                sections.add((yo, xo))
+    return sections
+
+
+def hierarchical_search(hdus, reference_hdu, rates, coarse_rates, bin_factor=4, threshold=5.0, rf=3,
+                        stacking_mode=None, section_size=1024, threads=1, geometry=None, dtype=None, batch_size=None):
+    """
+    Coarse-to-fine shift+stack, only stacking at full resolution where a binned coarse search finds signal.
+
+    The exposures are binned by bin_factor and shift+stacked at each of the coarse_rates.  Each of the rates is
+    assigned to the nearest coarse rate, and is then shift+stacked at full resolution but only in the sections
+    where the binned stack of its coarse rate has a pixel above threshold S/N.  Rates whose coarse stack has no
+    significant section are not stacked at all.  The refined stacks are yielded as each batch of rates is done, so
+    only batch_size full frame stacks are held at a time.
+
+    :param hdus: list of HDUList
+    :param reference_hdu: reference HDUList
+    :param rates: list of rate/angle dictionaries (see shift_rates) of the full search
+    :param coarse_rates: list of rate/angle dictionaries of the coarse search
+    :param bin_factor: binning used for the coarse search
+    :param threshold: S/N a coarse stack must reach for a section to be refined
+    :param geometry: exposure_geometry table of hdus, built here if not given.
+    :param dtype: data type the stacking is done in (see shift_stack).
+    :param batch_size: number of rates refined in one pass over the sections, default is all the rates of a coarse cell.
+    :return: generator of (rate, HDUList) of the refined rates, sections not refined are nan.
+    """
+    binned_hdus = [bin_hdu_list(hdu, bin_factor) for hdu in hdus]
+    binned_reference = bin_hdu_list(reference_hdu, bin_factor)
+    coarse_stacks = shift_stack([hdu[HSC_HDU_MAP['image']].data for hdu in binned_hdus],
+                                [hdu[HSC_HDU_MAP['variance']].data for hdu in binned_hdus],
+                                exposure_geometry(binned_hdus, binned_reference),
+                                [sky_motion(rate) for rate in coarse_rates], rf=rf, stacking_mode=stacking_mode,
+                                section_size=max(1, section_size // bin_factor), threads=threads, dtype=dtype)
+    shape = reference_hdu[HSC_HDU_MAP['image']].data.shape
+    cell_sections = [significant_sections(image, variance, bin_factor, shape, section_size, threshold)
+                     for image, variance in coarse_stacks]
+    if geometry is None:
+        geometry = exposure_geometry(hdus, reference_hdu)
+    cells = coarse_rate_cells(rates, coarse_rates)
+    for cell, sections in enumerate(cell_sections):
+        cell_rates = [rate for rate, rate_cell in zip(rates, cells) if rate_cell == cell]
+        logging.info(f'Coarse rate {coarse_rates[cell]} has {len(sections)} significant sections, '
+                     f'refining {len(cell_rates) if sections else 0} rates.')
+        if not sections or not cell_rates:
+            continue
+        cell_batch_size = len(cell_rates) if batch_size is None else batch_size
+        for start in range(0, len(cell_rates), cell_batch_size):
+            batch = cell_rates[start:start+cell_batch_size]
+            stacks = shift_stack([hdu[HSC_HDU_MAP['image']].data for hdu in hdus],
+                                 [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus],
+                                 geometry, [sky_motion(rate) for rate in batch], rf=rf,
+                                 stacking_mode=stacking_mode, section_size=section_size, threads=threads,
+                                 sections=sections, dtype=dtype)
+            for rate, (image_array, variance_array) in zip(batch, stacks):
+                output = stack_hdu_list(reference_hdu[0].header,
+                                        reference_hdu[HSC_HDU_MAP['image']].header,
+                                        reference_hdu[HSC_HDU_MAP['variance']].header,
+                                        image_array, variance_array)
+                output[0].header['SRCHBIN'] = (bin_factor, 'Binning of coarse rate search')
+                output[0].header['SRCHSECT'] = (len(sections), 'Sections refined by rate search')
+                yield rate, output
+
+
+def annotate_stack(output, rate, shift_rate, stack_mode, input_images):
+    """
+    Keep a history of which visits went into the stack and how it was made in the primary header of output.
+    """
+    dra = shift_rate['dra']
+    ddec = shift_rate['ddec']
+    output[0].header['SOFTWARE'] = f'{__name__}-{__version__}'
+    output[0].header['NCOMBINE'] = (len(input_images), 'Number combined')
+    output[0].header['COMBALGO'] = (stack_mode, 'Stacking mode')
+    output[0].header['RATE'] = (rate['rate'], 'arc-second/hour')
+    output[0].header['ANGLE'] = (rate['angle'], 'degree')
+    output[0].header['DRA'] = (dra.value, str(dra.unit))
+    output[0].header['DDEC'] = (ddec.value, str(ddec.unit))
+    for i_index, image_name in enumerate(input_images):
+        output[0].header[f'input{i_index:03d}'] = os.path.basename(image_name)
+    return output
+
+
+def init_detection_maps(shape, top_k=1):
+    """
+    Start the reduction of a rate grid of stacks into detection maps.
+
+    The maps hold, for each pixel, the top_k largest S/N over the stacks added so far and the rate and angle that
+    gave them, planes are in decreasing order of S/N.
+
+    :param shape: shape of the stacks
+    :param top_k: number of rates kept per pixel.
+    :return: dict of snr, rate and angle arrays of shape (top_k, ny, nx).
+    """
+    return {'snr': np.full((top_k,) + tuple(shape), -np.inf),
+            'rate': np.full((top_k,) + tuple(shape), np.nan),
+            'angle': np.full((top_k,) + tuple(shape), np.nan)}
+
+
+def add_detection(detection_maps, snr, rate, angle):
+    """
+    Insert an S/N map, and the rate and angle it was found at, into the top S/N planes of detection_maps.
+
+    :param detection_maps: maps from init_detection_maps, updated in place.
+    :param snr: 2D S/N array, nan pixels are ignored.
+    :param rate: rate ("/hr) of snr, scalar or array the shape of snr.
+    :param angle: angle (degree) of snr, scalar or array the shape of snr.
+    """
+    snr = np.where(np.isnan(snr), -np.inf, snr)
+    rate = np.broadcast_to(rate, snr.shape).astype(float)
+    angle = np.broadcast_to(angle, snr.shape).astype(float)
+    # insertion sort: a better value takes the place of the current one, which moves down a plane.
+    for plane in range(detection_maps['snr'].shape[0]):
+        better = snr > detection_maps['snr'][plane]
+        for key, value in (('snr', snr), ('rate', rate), ('angle', angle)):
+            displaced = detection_maps[key][plane][better]
+            detection_maps[key][plane][better] = value[better]
+            value[better] = displaced
+
+
+def merge_detection_maps(detection_maps, other):
+    """
+    Merge the detection maps other, reduced from another part of the rate grid, into detection_maps.
+    """
+    for plane in range(other['snr'].shape[0]):
+        add_detection(detection_maps, other['snr'][plane], other['rate'][plane], other['angle'][plane])
+
+
+def save_stack(output, output_filename, rate, detection_maps=None, keep_snr=None, writer=None):
+    """
+    Write an annotated stack, or when reducing to detection maps, add its S/N to the maps instead.
+
+    :param output: stack HDUList with the image and variance
+    :param output_filename: file to write the stack to
+    :param rate: rate/angle dictionary of the stack (see shift_rates)
+    :param detection_maps: maps from init_detection_maps, None writes every stack.
+    :param keep_snr: when reducing, still write the stacks with a pixel at or above this S/N.
+    :param writer: writer (see writer.start_writer) to write the stack with, default writes it here.
+    :return: True if the stack was written.
+    """
+    if writer is None:
+        writer = start_writer(queue_size=0)
+    if detection_maps is None:
+        submit_write(writer, output, output_filename)
+        return True
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = output[1].data / np.sqrt(output[2].data)
+    add_detection(detection_maps, snr, rate['rate'], rate['angle'])
+    if keep_snr is not None and np.any(snr >= keep_snr):
+        submit_write(writer, output, output_filename)
+        return True
+    return False
+
+
+def write_detection_maps(detection_maps, output_filename, reference_hdu, stack_mode, input_images):
+    """
+    Write detection maps as SNR, RATE and ANGLE float32 image extensions, with the planes along the third axis.
+    """
+    header = reference_hdu[HSC_HDU_MAP['image']].header
+    hdu_list = fits.HDUList([fits.PrimaryHDU(header=reference_hdu[0].header)])
+    for key in ['snr', 'rate', 'angle']:
+        hdu_list.append(fits.ImageHDU(data=detection_maps[key].astype(np.float32), header=header))
+        hdu_list[-1].header['EXTNAME'] = key.upper()
+    hdu_list[0].header['SOFTWARE'] = f'{__name__}-{__version__}'
+    hdu_list[0].header['NCOMBINE'] = (len(input_images), 'Number combined')
+    hdu_list[0].header['COMBALGO'] = (stack_mode, 'Stacking mode')
+    hdu_list[0].header['TOPK'] = (detection_maps['snr'].shape[0], 'Rates kept per pixel')
+    for i_index, image_name in enumerate(input_images):
+        hdu_list[0].header[f'input{i_index:03d}'] = os.path.basename(image_name)
+    atomic_writeto(hdu_list, output_filename)
+
+
+# The exposure cube and stacking parameters of a stack worker process, set by init_stack_worker.
+STACK_WORKER = {}
+
+
+def init_stack_worker(shm_name, cube_shape, dtype, state):
+    """
+    Attach a stack worker process to the shared memory exposure cube.
+
+    :param shm_name: name of the shared memory block holding the (2, n, ny, nx) image and variance cube.
+    :param cube_shape: shape of the cube
+    :param dtype: data type of the cube
+    :param state: dictionary of geometry, reference headers, input images and stacking parameters.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    STACK_WORKER.update(state)
+    STACK_WORKER['shm'] = shm
+    STACK_WORKER['cube'] = np.ndarray(cube_shape, dtype=dtype, buffer=shm.buf)
+    STACK_WORKER['writer'] = start_writer(queue_size=0, dtype=state['output_dtype'],
+                                          compression_type=state['compression_type'])
+
+
+def stack_worker(batch):
+    """
+    Shift+stack the shared exposure cube at a batch of rates and write the results.
+
+    :param batch: list of (rate, shift_rate, output_filename)
+    :return: list of the files written and the detection maps of the batch (None unless reducing to detection maps)
+    """
+    cube = STACK_WORKER['cube']
+    stacks = shift_stack(cube[0], cube[1], STACK_WORKER['geometry'], [shift_rate for _, shift_rate, _ in batch],
+                         stacking_mode=STACK_WORKER['stack_mode'], section_size=STACK_WORKER['section_size'],
+                         threads=STACK_WORKER['threads'], dtype=STACK_WORKER['dtype'])
+    detection_maps = None
+    if STACK_WORKER['top_k'] is not None:
+        detection_maps = init_detection_maps(cube.shape[2:], STACK_WORKER['top_k'])
+    written = []
+    for (rate, shift_rate, output_filename), (image_array, variance_array) in zip(batch, stacks):
+        output = stack_hdu_list(*STACK_WORKER['headers'], image_array, variance_array)
+        annotate_stack(output, rate, shift_rate, STACK_WORKER['stack_mode'], STACK_WORKER['input_images'])
+        if save_stack(output, output_filename, rate, detection_maps, STACK_WORKER['keep_snr'],
+                      STACK_WORKER['writer']):
+            written.append(output_filename)
+    return written, detection_maps
+
+
+def shift_in_parallel(hdus, reference_hdu, pending, input_images, workers, batch_size=None, stacking_mode=None,
+                      section_size=1024, geometry=None, threads=1, detection_maps=None, keep_snr=None, writer=None,
+                      dtype=None):
+    """
+    Shift+stack hdus at each of the pending rates using a pool of worker processes.
+
+    The (already masked/clipped) image and variance data are copied once into a shared memory cube that all the
+    workers read from, the workers take batches of rates from the pool queue and write their outputs independently.
+
+    :param hdus: list of HDUList
+    :param reference_hdu: reference HDUList
+    :param pending: list of (rate, shift_rate, output_filename) to stack
+    :param input_images: filenames of the hdus, recorded in the output headers.
+    :param workers: number of worker processes
+    :param batch_size: number of rates each worker stacks in one pass, default splits pending evenly over workers.
+    :param detection_maps: reduce the stacks into these detection maps instead of writing them (see save_stack).
+    :param keep_snr: when reducing, still write the stacks with a pixel at or above this S/N.
+    :param writer: the data type and compression of this writer (see writer.start_writer) are used by the workers.
+    :param dtype: data type of the shared cube and of the stacking (see shift_stack), default is that of the data.
+    :return: list of the files written.
+    """
+    if not len(pending) > 0:
+        return []
+    if geometry is None:
+        geometry = exposure_geometry(hdus, reference_hdu)
+    if batch_size is None:
+        batch_size = int(math.ceil(len(pending) / workers))
+    images = [hdu[HSC_HDU_MAP['image']].data for hdu in hdus]
+    variances = [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus]
+    cube_dtype = np.result_type(*images, *variances).newbyteorder('=') if dtype is None else np.dtype(dtype)
+    cube_shape = (2, len(hdus)) + images[0].shape
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(cube_shape)) * cube_dtype.itemsize)
+    try:
+        cube = np.ndarray(cube_shape, dtype=cube_dtype, buffer=shm.buf)
+        for idx in range(len(hdus)):
+            cube[0, idx] = images[idx]
+            cube[1, idx] = variances[idx]
+        del cube
+        state = {'geometry': geometry,
+                 'headers': (reference_hdu[0].header,
+                             reference_hdu[HSC_HDU_MAP['image']].header,
+                             reference_hdu[HSC_HDU_MAP['variance']].header),
+                 'input_images': input_images,
+                 'stack_mode': stacking_mode,
+                 'section_size': section_size,
+                 'threads': threads,
+                 'dtype': dtype,
+                 'top_k': None if detection_maps is None else detection_maps['snr'].shape[0],
+                 'keep_snr': keep_snr,
+                 'output_dtype': None if writer is None else writer['dtype'],
+                 'compression_type': None if writer is None else writer['compression_type']}
+        batches = [pending[start:start+batch_size] for start in range(0, len(pending), batch_size)]
+        logging.info(f'Stacking {len(pending)} rates in {len(batches)} batches using {workers} workers.')
+        written = []
+        with Pool(workers, initializer=init_stack_worker, initargs=(shm.name, cube_shape, cube_dtype, state)) as pool:
+            for filenames, batch_maps in pool.imap_unordered(stack_worker, batches):
+                logging.info(f'Wrote {filenames}')
+                written.extend(filenames)
+                if batch_maps is not None:
+                    merge_detection_maps(detection_maps, batch_maps)
+        return written
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def main(argv=None, publish=None):
+    """
+    Shift+stack the images of one CCD of a pointing on a grid of rates.
+
+    :param argv: command line arguments, default is sys.argv.
+    :param publish: function called with the name of each output file once it is written (see writer.start_writer)
+    """
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      fromfile_prefix_chars='@')
     parser.add_argument('basedir', help="Root directory of LSST pipelined data")
@@ -353,6 +1738,11 @@ def main():
     parser.add_argument('--ccd', help="Which CCD to stack?", type=int, default=0)
     parser.add_argument('--exptype', help="What type of exposures to co-add?", default='deepDiff')
     parser.add_argument('--swarp', action='store_true', help="Use projection to do shifts, default is pixel shifts.")
+    parser.add_argument('--tree', action='store_true',
+                        help="Pixel shift with partial stacks shared between the rates of a batch (SUM and MEAN).")
+    parser.add_argument('--fourier', action='store_true',
+                        help="Shift by exact fractional pixels as Fourier phase ramps, each exposure is transformed "
+                             "once per batch of rates (SUM and MEAN).")
     parser.add_argument('--stack-mode', choices=STACKING_MODES.keys(),
                         default='WEIGHTED_MEDIAN', help="How to combine images.")
     parser.add_argument('--rectify', action='store_true', help="Rectify images to WCS of reference, otherwise "
@@ -360,7 +1750,7 @@ def main():
     parser.add_argument('--log-level', help="What level to log at? (ERROR, INFO, DEBUG)", default="ERROR",
                         choices=['INFO', 'ERROR', 'DEBUG'])
     parser.add_argument('--mask', action='store_true', help='set masked pixels to nan before shift/stack')
-    parser.add_argument('--n-sub-stacks', default=3, help='How many sub-stacks should we produce')
+    parser.add_argument('--n-sub-stacks', type=int, default=3, help='How many sub-stacks should we produce')
     parser.add_argument('--rate-min', type=float, default=1, help='Minimum shift rate ("/hr)')
     parser.add_argument('--rate-max', type=float, default=5, help='Maximum shift rate ("/hr)')
     parser.add_argument('--rate-step', type=float, default=0.25, help='Step-size for shift rate ("/hr)')
@@ -371,15 +1761,100 @@ def main():
                         help='Mask pixel whose variance is clip times the median variance')
     parser.add_argument('--section-size', type=int, default=1024,
                         help='Break images into section when stacking (conserves memory)')
+    parser.add_argument('--exposure-index', default=None,
+                        help='SQLite index of the image headers, default is exposure_index.db in the input rerun.')
+    parser.add_argument('--cube-cache', action='store_true',
+                        help='Convert the images to memory mapped float32 cubes, stored with the output, and stack '
+                             'from those. The cube is rebuilt when the input images change.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes stacking the rate grid, each sub-stack is loaded once into shared '
+                             'memory and read by all the workers. Only the default pixel shift stacks in parallel, '
+                             'it can not be used with --swarp, --tree, --fourier, --search-bin or an --incremental '
+                             'SUM or MEAN stack.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads stacking image sections in parallel within each shift+stack.')
+    parser.add_argument('--search-bin', type=int, default=0,
+                        help='Run a coarse-to-fine rate search: stack images binned by this factor on a coarse rate '
+                             'grid and only write full resolution stacks (of the significant sections) for rates '
+                             'near coarse rates with signal, with pixel shifts (not --swarp, --tree or --fourier). '
+                             '0 stacks every rate.')
+    parser.add_argument('--search-coarsen', type=int, default=2,
+                        help='Rate and angle steps of the coarse search grid are this multiple of the full grid.')
+    parser.add_argument('--search-threshold', type=float, default=5.0,
+                        help='S/N a coarse stack section must reach to be refined at full resolution.')
+    parser.add_argument('--detection-maps', action='store_true',
+                        help='Reduce the stacks of each sub-stack to DETECT maps of the best S/N over the rates and '
+                             'the rate and angle giving it, instead of writing every stack.')
+    parser.add_argument('--top-k', type=int, default=1,
+                        help='Number of best rates per pixel kept in the detection maps.')
+    parser.add_argument('--keep-snr', type=float, default=None,
+                        help='With --detection-maps, still write the stacks that have a pixel at or above this S/N.')
+    parser.add_argument('--write-queue', type=int, default=2,
+                        help='Number of stacks that may wait to be written by the background writer, 0 writes each '
+                             'stack before computing the next.')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default=None,
+                        help='Data type the exposures are converted to, once, and the stacking is done in. float32 '
+                             'halves the memory traffic and the size of the stacks. Default stacks the data as read '
+                             'into float64 stacks.')
+    parser.add_argument('--output-dtype', choices=['float32', 'float64'], default=None,
+                        help='Data type of the written stacks, default keeps the data type of the stack.')
+    parser.add_argument('--compress', choices=COMPRESSION_TYPES, default=None,
+                        help='Tile compress the written stacks, the variance is quantized more coarsely.')
+    parser.add_argument('--rate-batch-size', type=int, default=None,
+                        help='Number of rates to shift+stack in each pass over the image sections. Each rate in the '
+                             'pass holds a full frame image and variance stack until the pass is done, 16 bytes per '
+                             'pixel (8 with --dtype float32), about 137 MB for a 2048x4176 CCD. Default is '
+                             f'{RATE_BATCH_SIZE} rates for pixel shifts, while --tree and --fourier, which share '
+                             'partial sums and transforms between the rates of a pass, take as many rates as the '
+                             f'memory planner fits in {BATCH_MEMORY_FRACTION:.0%} of the physical memory.')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='Memory (GB) the stacking of a sub-stack may use. The section size and number of rates '
+                             'per pass are then planned to fit, in place of --section-size and --rate-batch-size.')
+    parser.add_argument('--timing-report', default=None,
+                        help='Write the wall and CPU time, bytes read and written and peak array size of each stage of '
+                             'the run to this JSON file, {pointing} and {ccd} are replaced by those of the run.')
+    parser.add_argument('--manifest', default=None,
+                        help='SQLite manifest of the stacking tasks, shared by the processes stacking the CCD. Tasks '
+                             'finished with the same inputs and parameters are skipped, others are claimed and '
+                             'redone. Default skips outputs that exist.')
+    parser.add_argument('--claim-timeout', type=float, default=CLAIM_TIMEOUT,
+                        help='Seconds without a heartbeat after which a task claimed in the manifest by another '
+                             'process, on this or another host (e.g. a preempted node), is claimed again. The tasks of '
+                             'a process of this host that has exited are claimed at once.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Bring the stacks up to date with exposures added since the last run. SUM and MEAN stacks '
+                             'keep their running sums (in STATE-<ccd>, 12 bytes per pixel for each rate of each '
+                             'sub-stack) and only the new exposures are shifted and added, other modes restack the '
+                             'sub-stacks whose inputs changed. The reference exposure of the first run is kept.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.rate_batch_size is not None and args.rate_batch_size < 1:
+        parser.error('--rate-batch-size must be at least 1.')
+    if args.search_bin > 0 and (args.swarp or args.tree or args.fourier):
+        parser.error('--search-bin pixel shifts the coarse and refined stacks, it can not be used with --swarp, '
+                     '--tree or --fourier.')
+    if args.incremental and (args.swarp or args.tree or args.fourier or args.search_bin > 0 or args.detection_maps
+                             or args.manifest is not None):
+        parser.error('--incremental pixel shifts every stack, it can not be used with --swarp, --tree, --fourier, '
+                     '--search-bin, --detection-maps or --manifest.')
+    if args.workers > 1 and (args.swarp or args.tree or args.fourier or args.search_bin > 0
+                             or (args.incremental and args.stack_mode in ['SUM', 'MEAN'])):
+        parser.error('--workers only parallelizes the default pixel shift, it can not be used with --swarp, --tree, '
+                     '--fourier, --search-bin or an --incremental SUM or MEAN stack.')
     levels = {'INFO': logging.INFO, 'ERROR': logging.ERROR, 'DEBUG': logging.DEBUG}
     logging.basicConfig(level=levels[args.log_level])
+    if args.timing_report is not None:
+        enable_instrument()
 
+    # engine names the stack function for the memory planner.
     if args.swarp:
-        stack_function = swarp
+        stack_function, engine = swarp, 'swarp'
+    elif args.tree:
+        stack_function, engine = tree_shift, 'tree'
+    elif args.fourier:
+        stack_function, engine = fourier_shift, 'fourier'
     else:
-        stack_function = shift
+        stack_function, engine = shift, 'shift'
 
     ccd = f'{args.ccd:03d}'
 
@@ -413,85 +1888,291 @@ def main():
         logging.debug(f'Selecting {num_of_images}, every {stride} image list.')
         images = images[::stride]
 
-    # Organize images in MJD order.
-    images = np.array(images)
-    mjds = []
-    for image in images:
-        with fits.open(image) as hdu:
-            mjds.append(time.Time(mid_exposure_mjd((hdu[0]))))
-    ind = np.argsort(mjds)
-    reference_idx = int(len(ind)//2)
-    images = images[ind]
-    reference_hdu = fits.open(images[reference_idx])
+    # Organize images in MJD order, using the header index of the rerun rather than opening every image.
+    index_db = args.exposure_index
+    if index_db is None:
+        index_db = os.path.join(args.basedir, 'rerun', input_rerun, 'exposure_index.db')
+    refresh_exposure_index(images, index_db)
+    exposures = get_exposures(images, index_db)
+    images = np.array([exposure['filename'] for exposure in exposures])
+    # the median variances of --clip are kept in the index.
+    median_variances = {exposure['filename']: exposure['mvar'] for exposure in exposures}
+    reference_idx = int(len(images)//2)
+    state_dir = os.path.join(output_dir, f'STATE-{ccd}')
+    if args.incremental:
+        # the stacks stay on the reference epoch of the first run, so new exposures can be added to them.
+        reference_idx = pin_reference(state_dir, images, reference_idx)
+    # mask and clip are applied once, when the cube is built, unless the images must be rectified first.
+    preprocessed = args.cube_cache and not (args.rectify and not args.swarp)
+    if args.cube_cache:
+        cache_dir = os.path.join(output_dir, f'CUBE-{ccd}')
+        preprocess = {'clip': args.clip, 'mask': args.mask} if preprocessed else {}
+        if not exposure_cube_is_current(images, cache_dir, **preprocess):
+            computed = build_exposure_cube(images, cache_dir, median_variances=[median_variances[image]
+                                                                                 for image in images], **preprocess)
+            if computed is not None:
+                set_median_variances(dict(zip(images, computed)), index_db)
+        reference_hdu = load_exposure_cube(cache_dir, [images[reference_idx]])[0]
+    else:
+        reference_hdu = fits.open(images[reference_idx])
     reference_filename = os.path.splitext(os.path.basename(images[reference_idx]))[0][8:]
     logging.debug(f'Will use {reference_filename} as base name for storage.')
     logging.debug(f'Determined the reference_hdu image to be {mid_exposure_mjd(reference_hdu[0]).isot}')
+    # pixel maps onto the reference grid, for --rectify and --swarp.
+    reproject_cache = os.path.join(output_dir, f'REPROJECT-{ccd}')
+
+    manifest_params = None
+    written = publish
+    streaming = args.stack_mode in ['SUM', 'MEAN']
+    if args.incremental:
+        # states kept in other data types are discarded.
+        state_params = params_hash(dict({name: getattr(args, name) for name in MANIFEST_PARAMS},
+                                        reference=os.path.basename(images[reference_idx]),
+                                        state_dtypes=[np.dtype(dtype).name for dtype in STATE_DTYPES.values()]))
+    if args.manifest is not None:
+        manifest_params = {name: getattr(args, name) for name in MANIFEST_PARAMS}
+        if args.detection_maps:
+            manifest_params.update({name: getattr(args, name) for name in DETECTION_MANIFEST_PARAMS})
+        manifest_params['stack_function'] = stack_function.__name__
+
+        def written(filename):
+            complete_task(args.manifest, filename)
+            if publish is not None:
+                publish(filename)
+
+    # stacks are written on a background thread while the next ones are computed.
+    writer = start_writer(args.write_queue, args.output_dtype, args.compress, publish=written)
+    # keep the claims of this process in the manifest alive while it runs.
+    heartbeat = start_heartbeat(args.manifest) if args.manifest is not None else None
 
     # do the stacking in groups of images as set from the CL.
-    for index in range(args.n_sub_stacks):
-        sub_images = images[index::args.n_sub_stacks]
-        hdus = [fits.open(image) for image in sub_images]
-
-        if not args.swarp and args.rectify:
-            # Need to project all images to same WCS before passing to stack.
-            logging.info('Swarp-ing the input images to a common projection and reference frame.')
-            swarped = swarp(hdus, reference_hdu, None)
-            for idx in range(len(swarped)):
-                hdus[idx][1].data = swarped[idx].data
-                hdus[idx][1].header = swarped[idx].header
-                hdus[idx][2].data = swarped[idx].mask
-                hdus[idx][3].data = swarped[idx].uncertainty
-
-        if args.clip is not None:
-            # Use the variance data section to mask high variance pixels from the stack.
-            # mask pixels that are both high-variance AND part of a detected source.
-            logging.info(f'Masking pixels in image whose variance exceeds {args.clip} times the median variance.')
-            for hdu in hdus:
-                hdu[HSC_HDU_MAP['variance']].header['MVAR'] = (numpy.nanmedian(hdu[HSC_HDU_MAP['variance']].data),
-                                                               'Median variance')
-                logging.debug(f'Median variance is {hdu[HSC_HDU_MAP["variance"]].header["MVAR"]}')
-                bright_mask = hdu[HSC_HDU_MAP['variance']].data > hdu[HSC_HDU_MAP['variance']].header['MVAR']*args.clip
-                detected_mask = bitfield_to_boolean_mask(hdu[HSC_HDU_MAP['mask']].data,
-                                                         ignore_flags=LSST_MASK_BITS['DETECTED'],
-                                                         flip_bits=True)
-                logging.debug(f'Bright Mask flagged {np.sum(bright_mask)}')
-                hdu[HSC_HDU_MAP['image']].data[bright_mask & detected_mask] = np.nan
-                logging.debug(f'Clip setting {np.sum(bright_mask & detected_mask)} to nan')
-                hdu[HSC_HDU_MAP['variance']].data[bright_mask & detected_mask] = np.nan
-
-        if args.mask:
-            # set masked pixel to 'nan' before sending for stacking
-            for hdu in hdus:
-                hdu[HSC_HDU_MAP['image']].data = mask_as_nan(hdu[HSC_HDU_MAP['image']].data,
-                                                             hdu[HSC_HDU_MAP['mask']].data)
-                hdu[HSC_HDU_MAP['variance']].data = mask_as_nan(hdu[HSC_HDU_MAP['variance']].data,
-                                                                hdu[HSC_HDU_MAP['mask']].data)
-
-        for rate in shift_rates(args.rate_min, args.rate_max, args.rate_step,
-                                args.angle_min, args.angle_max, args.angle_step):
-            dra = rate['rate']*np.cos(np.deg2rad(rate['angle'])) * units.arcsecond/units.hour
-            ddec = rate['rate']*np.sin(np.deg2rad(rate['angle'])) * units.arcsecond/units.hour
-            output_filename = f'STACK-{reference_filename}-{index:02d}-' \
-                              f'{rate["rate"]:+06.2f}-{rate["angle"]:+06.2f}.fits'
-            output_filename = os.path.join(output_dir, output_filename)
-            if os.access(output_filename, os.R_OK):
-                logging.warning(f'{output_filename} exists, skipping')
+    try:
+        for index in range(args.n_sub_stacks):
+            sub_images = images[index::args.n_sub_stacks]
+            detection_filename = os.path.join(output_dir, f'DETECT-{reference_filename}-{index:02d}.fits')
+            # the images read for this sub-stack.
+            stack_images = sub_images
+            pending = []
+            for rate in shift_rates(args.rate_min, args.rate_max, args.rate_step,
+                                    args.angle_min, args.angle_max, args.angle_step):
+                output_filename = f'STACK-{reference_filename}-{index:02d}-' \
+                                  f'{rate["rate"]:+06.2f}-{rate["angle"]:+06.2f}.fits'
+                pending.append((rate, sky_motion(rate), os.path.join(output_dir, output_filename)))
+            if args.manifest is not None:
+                if args.detection_maps:
+                    tasks = [{'task': os.path.abspath(detection_filename), 'sub_stack': index, 'rate': None,
+                              'angle': None, 'output': detection_filename}]
+                else:
+                    tasks = [{'task': os.path.abspath(output_filename), 'sub_stack': index, 'rate': rate['rate'],
+                              'angle': rate['angle'], 'output': output_filename}
+                             for rate, _, output_filename in pending]
+                claimed = [task['output'] for task in claim_tasks(args.manifest, tasks, sub_images, manifest_params,
+                                                                  stale_after=args.claim_timeout)]
+                if not claimed:
+                    continue
+                if not args.detection_maps:
+                    pending = [entry for entry in pending if entry[2] in claimed]
+            elif args.detection_maps:
+                if os.access(detection_filename, os.R_OK):
+                    logging.warning(f'{detection_filename} exists, skipping')
+                    continue
+            elif args.incremental:
+                names = [os.path.basename(image) for image in sub_images]
+                # number of the sub-stack images already in each stack, these are first in MJD order.
+                stacked = {}
+                for _, _, output_filename in pending:
+                    if streaming:
+                        inputs = state_inputs(state_filename(state_dir, output_filename), state_params)
+                    else:
+                        inputs = stack_inputs(output_filename) if os.access(output_filename, os.R_OK) else None
+                    if inputs is None or inputs != names[:len(inputs)]:
+                        stacked[output_filename] = 0
+                    elif len(inputs) < len(names) or not os.access(output_filename, os.R_OK):
+                        # other modes can not add to a stack.
+                        stacked[output_filename] = len(inputs) if streaming else 0
+                    else:
+                        logging.warning(f'{os.path.basename(output_filename)} is up to date, skipping')
+                pending = [entry for entry in pending if entry[2] in stacked]
+                if not pending:
+                    continue
+                first = min(stacked.values())
+                stack_images = sub_images[first:]
+            else:
+                # outputs are written atomically, so a file that exists is complete.
+                existing = set(os.listdir(output_dir))
+                for _, _, output_filename in pending:
+                    if os.path.basename(output_filename) in existing:
+                        logging.warning(f'{os.path.basename(output_filename)} exists, skipping')
+                pending = [entry for entry in pending if os.path.basename(entry[2]) not in existing]
+            with stage('read'):
+                if args.cube_cache:
+                    hdus = load_exposure_cube(cache_dir, stack_images)
+                    record('read', bytes_read=sum(hdu[ext].data.nbytes for hdu in hdus for ext in range(1, 4)))
+                else:
+                    hdus = [fits.open(image) for image in stack_images]
+                    record('read', bytes_read=sum(os.path.getsize(image) for image in stack_images))
+
+            sub_variances = [median_variances[image] for image in stack_images]
+            if args.clip is not None and not preprocessed:
+                # MVAR is the median variance of the exposure as read, whether or not it is then rectified.
+                with stage('median_variance'):
+                    sub_variances = [float(numpy.nanmedian(hdu[HSC_HDU_MAP['variance']].data)) if mvar is None
+                                     else mvar for hdu, mvar in zip(hdus, sub_variances)]
+                set_median_variances(dict(zip(stack_images, sub_variances)), index_db)
+
+            if not args.swarp and args.rectify:
+                # Need to project all images to same WCS before passing to stack.
+                logging.info('Swarp-ing the input images to a common projection and reference frame.')
+                with stage('rectify'):
+                    rectify(hdus, reference_hdu, cache_dir=reproject_cache)
+
+            # the mask planes are decoded once, for the preprocessing and for swarp.
+            masks = None
+            if stack_function == swarp or not (preprocessed or (args.clip is None and not args.mask)):
+                with stage('preprocess'):
+                    masks = pack_masks(hdus)
+
+            if not preprocessed:
+                with stage('preprocess'):
+                    preprocess_exposures(hdus, args.clip, args.mask, sub_variances, masks=masks)
+
+            if args.dtype is not None:
+                # convert once, every stack of every rate then reads native arrays of that type.
+                with stage('convert'):
+                    for hdu in hdus:
+                        for layer in ['image', 'variance']:
+                            hdu[HSC_HDU_MAP[layer]].data = np.asarray(hdu[HSC_HDU_MAP[layer]].data,
+                                                                      dtype=args.dtype)
+
+            if args.incremental and streaming:
+                with stage('stack'):
+                    geometry = exposure_geometry(hdus, reference_hdu)
+                    stack_data = [hdu[HSC_HDU_MAP['image']].data for hdu in hdus]
+                    stack_variances = [hdu[HSC_HDU_MAP['variance']].data for hdu in hdus]
+                    for rate, shift_rate, output_filename in pending:
+                        filename = state_filename(state_dir, output_filename)
+                        partial = load_state(filename) if stacked[output_filename] > 0 else None
+                        # the images not yet in this stack.
+                        new = slice(stacked[output_filename] - first, None)
+                        partial = fold_exposures(partial, stack_data[new], stack_variances[new],
+                                                 {key: value[new] for key, value in geometry.items()}, shift_rate)
+                        if stacked[output_filename] < len(sub_images):
+                            save_state(filename, partial, sub_images, state_params)
+                        output = stack_hdu_list(reference_hdu[0].header,
+                                                reference_hdu[HSC_HDU_MAP['image']].header,
+                                                reference_hdu[HSC_HDU_MAP['variance']].header,
+                                                *finish_folded(partial, STACKING_MODES[args.stack_mode],
+                                                               dtype=args.dtype))
+                        annotate_stack(output, rate, shift_rate, args.stack_mode, sub_images)
+                        save_stack(output, output_filename, rate, writer=writer)
                 continue
-            output = stack_function(hdus, reference_hdu, {'dra': dra, 'ddec': ddec},
-                                    stacking_mode=args.stack_mode, section_size=args.section_size)
-            logging.debug(f'Got stack result {output}')
-            # Keep a history of which visits when into the stack.
-            output[0].header['SOFTWARE'] = f'{__name__}-{__version__}'
-            output[0].header['NCOMBINE'] = (len(hdus), 'Number combined')
-            output[0].header['COMBALGO'] = (args.stack_mode, 'Stacking mode')
-            output[0].header['RATE'] = (rate['rate'], 'arc-second/hour')
-            output[0].header['ANGLE'] = (rate['angle'], 'degree')
-            output[0].header['DRA'] = (dra.value, str(dra.unit))
-            output[0].header['DDEC'] = (ddec.value, str(ddec.unit))
-            for i_index, image_name in enumerate(sub_images[index]):
-                output[0].header[f'input{i_index:03d}'] = os.path.basename(image_name)
-            output.writeto(output_filename)
 
+            # shift can stack a list of rates in one pass over the image sections, swarp works one rate at a time.
+            batch_size = 1
+            rate_batch_size = args.rate_batch_size
+            stack_kwargs = {'stacking_mode': args.stack_mode, 'section_size': args.section_size, 'dtype': args.dtype}
+            if stack_function == swarp:
+                stack_kwargs['cache_dir'] = reproject_cache
+                stack_kwargs['masks'] = masks
+            if stack_function in (shift, tree_shift, fourier_shift):
+                # the exposure geometry is the same for every rate.
+                stack_kwargs['geometry'] = exposure_geometry(hdus, reference_hdu)
+                stack_kwargs['threads'] = args.threads
+            plan = None
+            padding = 0
+            if stack_function in (shift, tree_shift):
+                padding = shift_padding(*pixel_shifts(stack_kwargs['geometry'],
+                                                      [shift_rate for _, shift_rate, _ in pending]))
+            elif stack_function == fourier_shift:
+                padding = MAX_SHIFT
+            data = hdus[0][HSC_HDU_MAP['image']].data
+            plan_kwargs = dict(engine=engine, streaming=streaming, itemsize=data.dtype.itemsize,
+                               output_itemsize=8 if args.dtype is None else np.dtype(args.dtype).itemsize,
+                               threads=args.threads if stack_function != swarp else 1,
+                               workers=args.workers if stack_function == shift and args.search_bin == 0 else 1)
+            if args.memory_limit is not None:
+                plan = plan_stack(len(hdus), data.shape, max(1, len(pending)), padding, args.memory_limit * 2**30,
+                                  **plan_kwargs)
+                logging.info(f'Stacking plan: {plan}')
+                stack_kwargs['section_size'] = plan['section_size']
+                rate_batch_size = plan['rate_batch_size']
+            elif rate_batch_size is None and stack_function in (tree_shift, fourier_shift):
+                # the more rates in a pass, the more partial sums and transforms they share.
+                # sections are no larger than the images.
+                section_size = min(args.section_size, max(data.shape))
+                rate_batch_size = max(1, fit_rate_batch(len(hdus), data.shape, section_size, padding,
+                                                        max(1, len(pending)),
+                                                        BATCH_MEMORY_FRACTION * physical_memory(), **plan_kwargs))
+                logging.info(f'Stacking {rate_batch_size} rates per pass.')
+            elif rate_batch_size is None:
+                rate_batch_size = RATE_BATCH_SIZE
+            if stack_function in (shift, tree_shift, fourier_shift):
+                batch_size = rate_batch_size
+
+            detection_maps = None
+            if args.detection_maps:
+                detection_maps = init_detection_maps(reference_hdu[HSC_HDU_MAP['image']].data.shape, args.top_k)
+            with stage('stack'):
+                if stack_function == shift and args.search_bin > 0:
+                    # only write the stacks that the coarse search says are worth making.
+                    coarse_rates = shift_rates(args.rate_min, args.rate_max, args.rate_step * args.search_coarsen,
+                                               args.angle_min, args.angle_max, args.angle_step * args.search_coarsen)
+                    filenames = {(rate['rate'], rate['angle']): output_filename for rate, _, output_filename in pending}
+                    for rate, output in hierarchical_search(hdus, reference_hdu, [rate for rate, _, _ in pending],
+                                                            coarse_rates, bin_factor=args.search_bin,
+                                                            threshold=args.search_threshold,
+                                                            batch_size=rate_batch_size, **stack_kwargs):
+                        annotate_stack(output, rate, sky_motion(rate), args.stack_mode, sub_images)
+                        save_stack(output, filenames.pop((rate['rate'], rate['angle'])), rate, detection_maps,
+                                   args.keep_snr, writer)
+                    if args.manifest is not None:
+                        # the rates the search rejected are finished too.
+                        for output_filename in filenames.values():
+                            skip_task(args.manifest, output_filename)
+                elif stack_function == shift and args.workers > 1:
+                    for output_filename in shift_in_parallel(hdus, reference_hdu, pending, sub_images, args.workers,
+                                                             batch_size=rate_batch_size, detection_maps=detection_maps,
+                                                             keep_snr=args.keep_snr, writer=writer, **stack_kwargs):
+                        publish_file(writer, output_filename)
+                else:
+                    for start in range(0, len(pending), batch_size):
+                        batch = pending[start:start+batch_size]
+                        if batch_size > 1:
+                            outputs = stack_function(hdus, reference_hdu, [shift_rate for _, shift_rate, _ in batch],
+                                                     **stack_kwargs)
+                        else:
+                            outputs = [stack_function(hdus, reference_hdu, shift_rate, **stack_kwargs)
+                                       for _, shift_rate, _ in batch]
+                        for (rate, shift_rate, output_filename), output in zip(batch, outputs):
+                            logging.debug(f'Got stack result {output}')
+                            annotate_stack(output, rate, shift_rate, args.stack_mode, sub_images)
+                            save_stack(output, output_filename, rate, detection_maps, args.keep_snr, writer)
+            if detection_maps is not None:
+                with stage('write'):
+                    write_detection_maps(detection_maps, detection_filename, reference_hdu, args.stack_mode,
+                                         sub_images)
+                record('write', bytes_written=os.path.getsize(detection_filename))
+                publish_file(writer, detection_filename)
+            if plan is not None:
+                logging.info(f'Predicted peak memory {plan["predicted"] / 2**20:.0f} MB, '
+                             f'measured peak RSS {peak_rss() / 2**20:.0f} MB')
+
+        close_writer(writer)
+    except Exception:
+        # stop the writer thread, the error of the stacking is the one raised.
+        close_writer(writer, raise_errors=False)
+        if args.manifest is not None:
+            # let other processes, or a rerun, redo the tasks this one did not finish.
+            release_tasks(args.manifest)
+        raise
+    finally:
+        if heartbeat is not None:
+            heartbeat.set()
+    if args.timing_report is not None:
+        write_report(args.timing_report.format(pointing=args.pointing[0], ccd=ccd),
+                     argv=sys.argv[1:] if argv is None else list(argv), pointing=args.pointing[0], ccd=args.ccd,
+                     n_images=len(images))
+        disable_instrument()
     return 0
 
 
@@ -0,0 +1,85 @@
+import argparse
+import logging
+import os
+import shlex
+import subprocess
+import sys
+
+from . import sns
+from .instrument import disable as disable_instrument
+
+
+def command_publisher(command, retries=3, delete=False):
+    """
+    Build a publish hook that runs a shell command on each output file, e.g. to copy it to VOSpace.
+
+    :param command: shell command, {filename} is replaced by the (quoted) name of the file.
+    :param retries: number of times to try the command before giving up.
+    :param delete: remove the file once the command has succeeded.
+    :return: function taking the filename.
+    """
+    def publish(filename):
+        for attempt in range(retries):
+            if subprocess.run(command.format(filename=shlex.quote(filename)), shell=True).returncode == 0:
+                break
+            logging.warning(f'Publishing {filename} failed (attempt {attempt + 1} of {retries})')
+        else:
+            raise OSError(f'Failed to publish {filename} using: {command}')
+        if delete:
+            os.unlink(filename)
+    return publish
+
+
+def run_batch(basedir, pointings, ccds, sns_args, publish=None):
+    """
+    Run sns on each CCD of each pointing, in one process, with the whole rate grid of each CCD in one pass.
+
+    :param basedir: root directory of LSST pipelined data
+    :param pointings: list of sky patches (e.g. 0,0)
+    :param ccds: list of CCD numbers
+    :param sns_args: other daomop-sns command line arguments (rerun, rate grid, stacking options), used for all.
+    :param publish: function called with the name of each output file once it is written.
+    :return: list of the (pointing, ccd) that failed.
+    """
+    failed = []
+    for pointing in pointings:
+        for ccd in ccds:
+            logging.info(f'Stacking pointing {pointing} CCD {ccd}')
+            try:
+                sns.main([basedir, '--pointing', pointing, '--ccd', str(ccd)] + list(sns_args), publish=publish)
+            except Exception as ex:
+                logging.error(f'Stacking pointing {pointing} CCD {ccd} failed: {ex}')
+                failed.append((pointing, ccd))
+            finally:
+                # a failed CCD must not leave its timings recording into the next one.
+                disable_instrument()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     fromfile_prefix_chars='@', allow_abbrev=False,
+                                     description='Run daomop-sns over a list of pointings and CCDs, arguments not '
+                                                 'listed here are passed to daomop-sns.')
+    parser.add_argument('basedir', help="Root directory of LSST pipelined data")
+    parser.add_argument('--pointings', nargs='+', required=True, help="sky patches to process (e.g. 0,0 0,1)")
+    parser.add_argument('--ccds', nargs='+', type=int, required=True, help="CCDs to stack")
+    parser.add_argument('--publish', default=None,
+                        help='Shell command run on each output once it is written, {filename} is replaced by the '
+                             'file name (e.g. "vcp {filename} vos:project/STACKS/")')
+    parser.add_argument('--publish-retries', type=int, default=3, help='Times to try the publish command.')
+    parser.add_argument('--delete-after-publish', action='store_true',
+                        help='Remove each output once it is published.')
+    args, sns_args = parser.parse_known_args()
+
+    publish = None
+    if args.publish is not None:
+        publish = command_publisher(args.publish, retries=args.publish_retries, delete=args.delete_after_publish)
+    failed = run_batch(args.basedir, args.pointings, args.ccds, sns_args, publish=publish)
+    for pointing, ccd in failed:
+        logging.error(f'Failed: pointing {pointing} CCD {ccd}')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
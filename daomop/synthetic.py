@@ -0,0 +1,100 @@
+import os
+
+import numpy
+from astropy.io import fits
+
+from .sns import LSST_MASK_BITS
+
+# arc-seconds per pixel of the synthetic images, that of HSC.
+PIXEL_SCALE = 0.168
+
+# sigma (pixels) of the gaussian PSF of the injected sources.
+PSF_SIGMA = 1.5
+
+
+def source_position(source, hours):
+    """
+    Pixel position of a moving source some hours after the first exposure.
+
+    The motion follows the convention of the stacking engines, shift() at the source's rate and angle aligns it: angle 0
+    moves along +x and positive angles towards -y.
+
+    :param source: dict with the x, y (pixel) position at the first exposure, the rate ("/hr) and optionally the angle
+                   (degrees, default 0) of the motion.
+    :return: x, y
+    """
+    angle = numpy.deg2rad(source.get('angle', 0.0))
+    distance = source['rate'] * hours / PIXEL_SCALE
+    return source['x'] + distance * numpy.cos(angle), source['y'] - distance * numpy.sin(angle)
+
+
+def make_exposures(dirname, n=5, shape=(60, 80), seed=0, source=None, cadence=0.01):
+    """
+    Write n HSC-like difference images (image/mask/variance) with a common TAN WCS into dirname.
+
+    The images are gaussian noise with nan pixels, the masks have SAT and DETECTED bits set and the variance is
+    that of the noise. source is an optional dictionary (or list of dictionaries) with the x, y (pixel) position at
+    the first exposure, the rate ("/hr), angle (degrees, default 0) and peak flux of a moving source to add to the
+    images (see source_position).
+
+    :param cadence: days between the starts of the exposures.
+    :return: list of the filenames written, in MJD order.
+    """
+    rng = numpy.random.default_rng(seed)
+    sources = [] if source is None else [source] if isinstance(source, dict) else source
+    filenames = []
+    for idx in range(n):
+        mjd_start = 59000.0 + idx * cadence
+        primary = fits.PrimaryHDU()
+        primary.header['FRAMEID'] = f'HSCA{idx:08d}'
+        primary.header['MJD-STR'] = mjd_start
+        primary.header['MJD-END'] = mjd_start + 0.002
+        wcs_header = fits.Header()
+        wcs_header['CTYPE1'] = 'RA---TAN'
+        wcs_header['CTYPE2'] = 'DEC--TAN'
+        wcs_header['CRPIX1'] = shape[1] / 2.0
+        wcs_header['CRPIX2'] = shape[0] / 2.0
+        wcs_header['CRVAL1'] = 180.0
+        wcs_header['CRVAL2'] = 10.0
+        wcs_header['CD1_1'] = -PIXEL_SCALE / 3600.0
+        wcs_header['CD1_2'] = 0.0
+        wcs_header['CD2_1'] = 0.0
+        wcs_header['CD2_2'] = PIXEL_SCALE / 3600.0
+        image = rng.normal(0, 10, shape).astype('float32')
+        if sources:
+            yy, xx = numpy.mgrid[0:shape[0], 0:shape[1]]
+            for this_source in sources:
+                x, y = source_position(this_source, idx * cadence * 24)
+                image += this_source['flux'] * numpy.exp(-((xx - x)**2 + (yy - y)**2) / (2 * PSF_SIGMA**2))
+        image[rng.random(shape) < 0.01] = numpy.nan
+        mask = numpy.zeros(shape, dtype='int32')
+        mask[rng.random(shape) < 0.02] = 2**LSST_MASK_BITS['SAT']
+        mask[rng.random(shape) < 0.05] |= 2**LSST_MASK_BITS['DETECTED']
+        variance = rng.uniform(50, 150, shape).astype('float32')
+        hdu_list = fits.HDUList([primary,
+                                 fits.ImageHDU(data=image, header=wcs_header),
+                                 fits.ImageHDU(data=mask, header=wcs_header),
+                                 fits.ImageHDU(data=variance, header=wcs_header)])
+        filename = os.path.join(dirname, f'DIFF-{idx:07d}-000.fits')
+        hdu_list.writeto(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def source_snr(stack, source, hours, radius=2):
+    """
+    Peak S/N of a stack within radius pixels of where source is at the stack's reference epoch.
+
+    :param stack: HDUList of a stack (see sns.stack_hdu_list)
+    :param source: the source dictionary given to make_exposures
+    :param hours: time of the stack's reference exposure since the first exposure
+    :return: S/N, nan if the source is off the stack.
+    """
+    x, y = source_position(source, hours)
+    x, y = int(round(x)), int(round(y))
+    data = stack[1].data
+    if not (0 <= x < data.shape[1] and 0 <= y < data.shape[0]):
+        return numpy.nan
+    section = (slice(max(0, y - radius), y + radius + 1), slice(max(0, x - radius), x + radius + 1))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return float(numpy.nanmax(data[section] / numpy.sqrt(stack[2].data[section])))
@@ -0,0 +1,51 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from astropy.io import fits
+
+from . import benchmark, sns, synthetic
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run_benchmark(self):
+        result = benchmark.run_benchmark(self.tmpdir.name, stacking_modes=['MEAN', 'WEIGHTED_MEDIAN'], exposures=[4],
+                                         section_sizes=[32], rates=[3], shape=(48, 80))
+        # tree and fourier only stack in MEAN.
+        self.assertEqual([('shift', 'MEAN'), ('shift', 'WEIGHTED_MEDIAN'), ('tree', 'MEAN'), ('fourier', 'MEAN'),
+                          ('swarp', 'MEAN'), ('swarp', 'WEIGHTED_MEDIAN'), ('sns', 'MEAN'), ('sns', 'WEIGHTED_MEDIAN')],
+                         [(case['engine'], case['stacking_mode']) for case in result['cases']])
+        for case in result['cases']:
+            self.assertTrue(case['recovered'], case)
+            self.assertGreater(case['throughput'], 0)
+            self.assertGreater(case['peak_memory'], 0)
+        # the outputs of sns are removed, the exposures kept for the next run.
+        self.assertEqual(['diff'], os.listdir(os.path.join(self.tmpdir.name, '4-48x80', 'rerun')))
+
+    def test_source_recovery(self):
+        basedir, filenames, source = benchmark.benchmark_exposures(self.tmpdir.name, 4, (48, 80))
+        hdus = [fits.open(filename) for filename in filenames]
+        hours = 2 * benchmark.CADENCE * 24
+        stacks = sns.shift(hdus, hdus[2], [sns.sky_motion(rate) for rate in [{'rate': 3.0, 'angle': 0.0},
+                                                                              {'rate': 3.0, 'angle': 45.0}]],
+                           stacking_mode='MEAN', section_size=32)
+        self.assertGreaterEqual(synthetic.source_snr(stacks[0], source, hours), benchmark.RECOVERY_SNR)
+        # stacked at the wrong rate the source is spread out.
+        self.assertLess(synthetic.source_snr(stacks[1], source, hours), benchmark.RECOVERY_SNR)
+
+    def test_main(self):
+        output = os.path.join(self.tmpdir.name, 'benchmark.json')
+        benchmark.main(['--workdir', self.tmpdir.name, '--engines', 'shift', '--stack-modes', 'SUM', '--exposures', '3',
+                        '--section-sizes', '64', '--rates', '1', '--shape', '40', '64', '--output', output])
+        with open(output) as fobj:
+            result = json.load(fobj)
+        self.assertEqual(1, len(result['cases']))
+        self.assertGreater(result['peak_rss'], 0)
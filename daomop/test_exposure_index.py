@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+from unittest import TestCase
+
+from . import exposure_index
+from .synthetic import make_exposures
+
+
+def index_exposures(filenames, dbfilename):
+    exposure_index.refresh_exposure_index(filenames, dbfilename)
+    exposure_index.set_median_variances({filename: float(len(filenames)) for filename in filenames}, dbfilename)
+
+
+class Test(TestCase):
+
+    def test_refresh_exposure_index(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filenames = make_exposures(dirname, n=4)
+            dbfilename = os.path.join(dirname, 'exposure_index.db')
+            self.assertEqual(exposure_index.refresh_exposure_index(filenames[::-1], dbfilename), 4)
+            self.assertEqual(exposure_index.refresh_exposure_index(filenames, dbfilename), 0)
+            os.utime(filenames[1], (0, 0))
+            self.assertEqual(exposure_index.refresh_exposure_index(filenames, dbfilename), 1)
+            exposures = exposure_index.get_exposures(filenames[::-1], dbfilename)
+            self.assertEqual([exposure['filename'] for exposure in exposures], filenames)
+            self.assertEqual(exposures[0]['frameid'], 'HSCA00000000')
+            self.assertEqual((exposures[0]['naxis2'], exposures[0]['naxis1']), (60, 80))
+            self.assertEqual(exposures[0]['wcs']['CTYPE1'], 'RA---TAN')
+            self.assertAlmostEqual(exposures[0]['mjd_mid'], 59000.001)
+            self.assertIsNone(exposures[0]['mvar'])
+            exposure_index.set_median_variances({filename: 100.0 for filename in filenames}, dbfilename)
+            os.utime(filenames[1], (1, 1))
+            exposure_index.refresh_exposure_index(filenames, dbfilename)
+            exposures = exposure_index.get_exposures(filenames, dbfilename)
+            self.assertEqual([100.0, None, 100.0, 100.0], [exposure['mvar'] for exposure in exposures])
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filenames = make_exposures(dirname, n=8)
+            dbfilename = os.path.join(dirname, 'exposure_index.db')
+            # the CCD runs of a pointing share the index of the rerun. The processes are spawned, as sqlite
+            # connections (and their locks) must not be copied into forked processes.
+            with multiprocessing.get_context('spawn').Pool(4) as pool:
+                pool.starmap(index_exposures, [([], dbfilename)] * 4)
+                # the writers wait out one that holds the index longer than the default sqlite timeout (5 s).
+                db = sqlite3.connect(dbfilename, isolation_level=None)
+                db.execute('BEGIN IMMEDIATE')
+                result = pool.starmap_async(index_exposures,
+                                            [(filenames[start:], dbfilename) for start in range(4)] * 2)
+                time.sleep(6)
+                db.execute('COMMIT')
+                db.close()
+                result.get()
+            exposures = exposure_index.get_exposures(filenames, dbfilename)
+            self.assertEqual(filenames, [exposure['filename'] for exposure in exposures])
+            self.assertTrue(all(exposure['mvar'] is not None for exposure in exposures))
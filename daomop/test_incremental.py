@@ -0,0 +1,113 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+
+from . import incremental, sns
+from .synthetic import make_exposures
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.basedir = self.tmpdir.name
+        self.filenames = make_exposures(self.basedir, n=6)
+        self.input_dir = os.path.join(self.basedir, 'rerun', 'diff', 'deepDiff', '0,0', 'HSC-R2')
+        os.makedirs(self.input_dir)
+        self.add_exposures(4)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_exposures(self, n):
+        for filename in self.filenames[:n]:
+            if not os.access(os.path.join(self.input_dir, os.path.basename(filename)), os.F_OK):
+                shutil.copy(filename, self.input_dir)
+
+    def run_sns(self, stack_mode, rerun='stack'):
+        sns.main([self.basedir, '--pointing', '0,0', '--rerun', f'diff:{rerun}', '--n-sub-stacks', '2',
+                  '--stack-mode', stack_mode, '--rate-min', '1', '--rate-max', '2', '--rate-step', '1',
+                  '--angle-min', '0', '--angle-max', '0', '--angle-step', '1', '--incremental'])
+        return sorted(glob.glob(os.path.join(self.basedir, 'rerun', rerun, 'deepDiff', '0,0', 'HSC-R2',
+                                             'STACK-*.fits')))
+
+    def test_fold_exposures(self):
+        hdus = [fits.open(filename) for filename in self.filenames]
+        geometry = sns.exposure_geometry(hdus, hdus[2])
+        rate = sns.sky_motion({'rate': 2.5, 'angle': 10.0})
+        images = [hdu[1].data for hdu in hdus]
+        variances = [hdu[3].data for hdu in hdus]
+        expected = sns.fold_exposures(None, images, variances, geometry, rate)
+        partial = sns.fold_exposures(None, images[:4], variances[:4], {key: value[:4] for key, value in
+                                                                       geometry.items()}, rate)
+        partial = sns.fold_exposures(partial, images[4:], variances[4:], {key: value[4:] for key, value in
+                                                                          geometry.items()}, rate)
+        for expected_sum, result in zip(expected, partial):
+            numpy.testing.assert_array_equal(expected_sum, result)
+        # with no new exposures the sums are unchanged.
+        self.assertEqual((1, 0), sns.pixel_offsets(sns.exposure_geometry([], hdus[2]), [rate])[0].shape)
+        self.assertIs(partial, sns.fold_exposures(partial, [], [], sns.exposure_geometry([], hdus[2]), rate))
+        # without nan pixels the stack is that of shift.
+        images = [numpy.nan_to_num(image) for image in images]
+        expected = sns.shift_stack(images, variances, geometry, [rate], stacking_mode='MEAN')[0]
+        result = sns.finish_folded(sns.fold_exposures(None, images, variances, geometry, rate), numpy.nanmean)
+        for expected_array, result_array in zip(expected, result):
+            numpy.testing.assert_allclose(expected_array, result_array, rtol=1e-5, atol=1e-5)
+
+    def test_incremental(self):
+        stacks = self.run_sns('MEAN')
+        self.assertEqual(4, len(stacks))
+        self.assertEqual(2, fits.getheader(stacks[0])['NCOMBINE'])
+        state_dir = os.path.join(os.path.dirname(stacks[0]), 'STATE-000')
+        with open(os.path.join(state_dir, 'reference.json')) as fobj:
+            reference = json.load(fobj)['reference']
+        self.assertEqual('DIFF-0000002-000.fits', reference)
+        mtimes = [os.path.getmtime(stack) for stack in stacks]
+        self.assertEqual(stacks, self.run_sns('MEAN'))
+        self.assertEqual(mtimes, [os.path.getmtime(stack) for stack in stacks])
+
+        # a stack whose state is current is written again from the state.
+        with fits.open(stacks[0]) as hdu:
+            expected = hdu[1].data.copy()
+        os.unlink(stacks[0])
+        self.assertEqual(stacks, self.run_sns('MEAN'))
+        self.assertEqual(mtimes[1:], [os.path.getmtime(stack) for stack in stacks[1:]])
+        with fits.open(stacks[0]) as hdu:
+            numpy.testing.assert_array_equal(expected, hdu[1].data)
+
+        # the new exposures are added to the stacks, which keep their reference.
+        self.add_exposures(6)
+        self.assertEqual(stacks, self.run_sns('MEAN'))
+        self.assertEqual(['DIFF-0000000-000.fits', 'DIFF-0000002-000.fits', 'DIFF-0000004-000.fits'],
+                         incremental.stack_inputs(stacks[0]))
+        with numpy.load(incremental.state_filename(state_dir, stacks[0])) as state:
+            self.assertEqual(['DIFF-0000000-000.fits', 'DIFF-0000002-000.fits', 'DIFF-0000004-000.fits'],
+                             list(state['inputs']))
+            self.assertEqual([numpy.float32, numpy.uint16, numpy.float32, numpy.uint16],
+                             [state[name].dtype for name in incremental.STATE_ARRAYS])
+        # and are the stacks of all the exposures on that reference.
+        fresh_dir = os.path.join(self.basedir, 'rerun', 'fresh', 'deepDiff', '0,0', 'HSC-R2', 'STATE-000')
+        os.makedirs(fresh_dir)
+        shutil.copy(os.path.join(state_dir, 'reference.json'), fresh_dir)
+        for stack, expected in zip(stacks, self.run_sns('MEAN', rerun='fresh')):
+            self.assertEqual(os.path.basename(expected), os.path.basename(stack))
+            with fits.open(stack) as result, fits.open(expected) as expected_hdu:
+                for ext in [1, 2]:
+                    numpy.testing.assert_array_equal(expected_hdu[ext].data, result[ext].data)
+
+    def test_incremental_median(self):
+        stacks = self.run_sns('MEDIAN')
+        mtimes = [os.path.getmtime(stack) for stack in stacks]
+        self.assertEqual(stacks, self.run_sns('MEDIAN'))
+        self.assertEqual(mtimes, [os.path.getmtime(stack) for stack in stacks])
+        # stacks that are missing the new exposures are redone.
+        self.add_exposures(5)
+        self.run_sns('MEDIAN')
+        self.assertEqual([3, 3, 2, 2], [fits.getheader(stack)['NCOMBINE'] for stack in stacks])
+        self.assertEqual(mtimes[2:], [os.path.getmtime(stack) for stack in stacks[2:]])
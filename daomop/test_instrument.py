@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from astropy.io import fits
+
+from . import instrument, sns
+from .synthetic import make_exposures
+from .test_sns import make_rates
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        instrument.disable()
+        self.tmpdir.cleanup()
+
+    def test_stage(self):
+        self.assertIs(instrument.NULL_STAGE, instrument.stage('shift'))
+        instrument.record('shift', calls=1)
+        instrument.enable()
+        filenames = make_exposures(self.tmpdir.name)
+        hdus = [fits.open(filename) for filename in filenames]
+        sns.shift(hdus, hdus[2], make_rates(), stacking_mode='WEIGHTED_MEDIAN', section_size=32)
+        stages = instrument.report()['stages']
+        for name in ['geometry', 'gather', 'combine', 'weighted_quantile', 'down_sample']:
+            self.assertGreater(stages[name]['calls'], 0)
+            self.assertGreater(stages[name]['wall'], 0)
+        # 3 rates, 9 sub-pixel positions of the 6 sections of a 60x80 exposure.
+        self.assertEqual(3 * 9 * 6, stages['combine']['calls'])
+        self.assertGreater(stages['gather']['peak_array_bytes'], 0)
+
+    def test_timing_report(self):
+        basedir = self.tmpdir.name
+        dirname = os.path.join(basedir, 'rerun', 'diff', 'deepDiff', '0,0', 'HSC-R2')
+        os.makedirs(dirname)
+        filenames = make_exposures(dirname, n=4)
+        report_filename = os.path.join(basedir, 'timing-{pointing}-{ccd}.json')
+        sns.main([basedir, '--pointing', '0,0', '--rerun', 'diff:stack', '--n-sub-stacks', '1', '--stack-mode', 'MEAN',
+                  '--rate-min', '1', '--rate-max', '2', '--rate-step', '1', '--angle-min', '0', '--angle-max', '0',
+                  '--angle-step', '1', '--timing-report', report_filename])
+        self.assertIsNone(instrument.PROFILE)
+        with open(os.path.join(basedir, 'timing-0,0-000.json')) as fobj:
+            report = json.load(fobj)
+        self.assertEqual(4, report['n_images'])
+        self.assertEqual(sum(os.path.getsize(filename) for filename in filenames),
+                         report['stages']['read']['bytes_read'])
+        self.assertEqual(2, report['stages']['write']['calls'])
+        self.assertGreater(report['stages']['write']['bytes_written'], 0)
+        self.assertGreater(report['peak_rss'], 0)
@@ -0,0 +1,101 @@
+import os
+import socket
+import sqlite3
+import tempfile
+import time
+from unittest import TestCase
+
+from . import manifest, sns
+from .synthetic import make_exposures
+
+
+def make_tasks(dirname, n=3):
+    return [{'task': os.path.join(dirname, f'STACK-{idx}.fits'), 'sub_stack': 0, 'rate': float(idx), 'angle': 0.0,
+             'output': os.path.join(dirname, f'STACK-{idx}.fits')} for idx in range(n)]
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tmpdir.name
+        self.dbfilename = os.path.join(self.dirname, 'manifest.db')
+        self.images = []
+        for idx in range(2):
+            self.images.append(os.path.join(self.dirname, f'DIFF-{idx}.fits'))
+            with open(self.images[-1], 'w') as fobj:
+                fobj.write(f'image {idx}')
+        self.params = {'stack_mode': 'MEAN'}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def set_owner(self, owner, heartbeat=None):
+        with sqlite3.connect(self.dbfilename) as db:
+            db.execute('UPDATE `tasks` SET `owner`=?', (owner,))
+            if heartbeat is not None:
+                db.execute('UPDATE `tasks` SET `heartbeat`=?', (heartbeat,))
+
+    def test_claim_tasks(self):
+        tasks = make_tasks(self.dirname)
+        self.assertEqual(tasks, manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        for task in tasks[:2]:
+            with open(task['output'], 'w') as fobj:
+                fobj.write('stack')
+            manifest.complete_task(self.dbfilename, task['output'])
+        # the running task of another live process on this host is not claimed, the dead process's task is.
+        self.set_owner(f'{socket.gethostname()}:{os.getppid()}')
+        self.assertEqual([], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        self.set_owner(f'{socket.gethostname()}:{2**22 + 1}')
+        self.assertEqual(tasks[2:], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        # the task of another host is claimed once its heartbeat is stale.
+        self.set_owner('elsewhere:1')
+        self.assertEqual([], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        self.assertEqual(tasks[2:], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params,
+                                                         stale_after=-1))
+        self.set_owner('elsewhere:1', heartbeat=time.time() - manifest.CLAIM_TIMEOUT - 1)
+        self.assertEqual(tasks[2:], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        # while the owner beats its heartbeat, its tasks are kept.
+        self.set_owner(manifest.owner_id(), heartbeat=0)
+        manifest.heartbeat(self.dbfilename)
+        self.set_owner('elsewhere:1')
+        self.assertEqual([], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        self.set_owner(manifest.owner_id())
+        # a partial output is redone.
+        with open(tasks[1]['output'], 'w') as fobj:
+            fobj.write('st')
+        self.assertEqual(tasks[1:], manifest.claim_tasks(self.dbfilename, tasks, self.images, self.params))
+        manifest.release_tasks(self.dbfilename)
+        # new parameters or inputs redo the finished tasks.
+        self.assertEqual(tasks, manifest.claim_tasks(self.dbfilename, tasks, self.images, {'stack_mode': 'SUM'}))
+        for task in tasks:
+            manifest.skip_task(self.dbfilename, task['output'])
+        self.assertEqual(tasks, manifest.claim_tasks(self.dbfilename, tasks, self.images[:1], {'stack_mode': 'SUM'}))
+        # the same outputs of another pointing are other tasks.
+        other = os.path.join(self.dirname, 'other')
+        os.mkdir(other)
+        self.assertEqual(make_tasks(other), manifest.claim_tasks(self.dbfilename, make_tasks(other), self.images[:1],
+                                                                 {'stack_mode': 'SUM'}))
+
+    def test_main(self):
+        basedir = os.path.join(self.dirname, 'base')
+        dirname = os.path.join(basedir, 'rerun', 'diff', 'deepDiff', '0,0', 'HSC-R2')
+        os.makedirs(dirname)
+        make_exposures(dirname, n=4)
+        argv = [basedir, '--pointing', '0,0', '--rerun', 'diff:stack', '--n-sub-stacks', '2', '--stack-mode', 'MEAN',
+                '--rate-min', '1', '--rate-max', '2', '--rate-step', '1', '--angle-min', '0', '--angle-max', '0',
+                '--angle-step', '1', '--manifest', self.dbfilename]
+        published = []
+        self.assertEqual(0, sns.main(argv, publish=published.append))
+        self.assertEqual(4, len(published))
+        # a restart does nothing, even when the outputs have been published and removed.
+        for filename in published:
+            os.unlink(filename)
+        sns.main(argv, publish=published.append)
+        self.assertEqual(4, len(published))
+        # a change of stack parameters redoes them.
+        sns.main(argv + ['--output-dtype', 'float32'], publish=published.append)
+        self.assertEqual(8, len(published))
+        with sqlite3.connect(self.dbfilename) as db:
+            self.assertEqual([(manifest.DONE, 4)], db.execute('SELECT `status`, count(*) FROM `tasks` '
+                                                                'GROUP BY `status`').fetchall())
@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+import numpy
+
+from . import planner, sns
+
+
+class Test(TestCase):
+
+    def test_plan_stack(self):
+        shape = (4176, 2048)
+        # a generous limit stacks every rate in one pass with the largest sections.
+        plan = planner.plan_stack(20, shape, 100, 40, 2**40)
+        self.assertEqual((4096, 100, 40), (plan['section_size'], plan['rate_batch_size'], plan['padding']))
+        for engine in ['shift', 'tree', 'fourier', 'swarp']:
+            for memory_limit in [2**32, 2**34]:
+                plan = planner.plan_stack(20, shape, 100, 40, memory_limit, engine=engine, threads=4)
+                self.assertLessEqual(plan['predicted'], memory_limit)
+                self.assertEqual(plan['predicted'], planner.stack_memory(20, shape, plan['section_size'], 40,
+                                                                         plan['rate_batch_size'], engine=engine,
+                                                                         threads=4))
+        # fewer rates fit in a pass with less memory.
+        self.assertLess(planner.plan_stack(20, shape, 100, 40, 2**32)['rate_batch_size'],
+                        planner.plan_stack(20, shape, 100, 40, 2**34)['rate_batch_size'])
+        # when nothing fits the smallest plan is used.
+        plan = planner.plan_stack(20, shape, 100, 40, 2**20)
+        self.assertEqual((planner.SECTION_SIZES[0], 1), (plan['section_size'], plan['rate_batch_size']))
+
+    def test_shift_padding(self):
+        dxs = numpy.array([[0, 10, -200], [5, -31, 2]])
+        dys = numpy.array([[1, 2, 3], [-4, 5, 6]])
+        # the -200 shift is beyond MAX_SHIFT so the exposure is left out.
+        self.assertEqual(11, sns.shift_padding(dxs, dys, rf=3))
+        self.assertEqual(0, sns.shift_padding(dxs[:1, 2:], dys[:1, 2:]))
+
+    def test_peak_rss(self):
+        before = planner.peak_rss()
+        data = numpy.ones(2**25)
+        self.assertGreaterEqual(planner.peak_rss(), max(before, data.nbytes))
@@ -0,0 +1,56 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+from astropy.wcs import WCS
+from ccdproc import CCDData, wcs_project
+
+from . import reprojection
+from .synthetic import make_exposures
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        filenames = make_exposures(self.tmpdir.name, n=2)
+        self.reference_header = fits.getheader(filenames[0], 1)
+        self.header = self.reference_header.copy()
+        self.header['CRPIX1'] += 2.3
+        self.header['CRPIX2'] -= 1.6
+        self.data = fits.getdata(filenames[1], 1)
+        self.data[numpy.isnan(self.data)] = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reproject(self):
+        mapping = reprojection.pixel_map(self.header, self.reference_header)
+        result = reprojection.reproject(self.data, mapping)
+        expected = wcs_project(CCDData(self.data, wcs=WCS(self.header), unit='adu'), WCS(self.reference_header))
+        numpy.testing.assert_allclose(result[5:-5, 5:-5], expected.data[5:-5, 5:-5], atol=1e-3)
+        self.assertTrue(numpy.isnan(result[:, -2:]).all())
+
+    def test_crval_offset(self):
+        mapping = reprojection.pixel_map(self.header, self.reference_header)
+        shifted_header = self.header.copy()
+        shifted_header['CRVAL1'] += 2.0 / 3600.0
+        shifted_header['CRVAL2'] -= 1.0 / 3600.0
+        expected = reprojection.pixel_map(shifted_header, self.reference_header)
+        offset = reprojection.crval_offset(self.header, 2.0 / 3600.0, -1.0 / 3600.0)
+        numpy.testing.assert_allclose(mapping[0] + offset[0], expected[0], atol=1e-3)
+        numpy.testing.assert_allclose(mapping[1] + offset[1], expected[1], atol=1e-3)
+
+    def test_load_pixel_map(self):
+        cache_dir = os.path.join(self.tmpdir.name, 'maps')
+        expected = reprojection.load_pixel_map(self.header, self.reference_header, cache_dir)
+        self.assertIsInstance(expected, numpy.memmap)
+        numpy.testing.assert_array_equal(reprojection.pixel_map(self.header, self.reference_header), expected)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+        result = reprojection.load_pixel_map(self.header, self.reference_header, cache_dir)
+        self.assertIsInstance(result, numpy.memmap)
+        numpy.testing.assert_array_equal(expected, result)
+        reprojection.load_pixel_map(self.reference_header, self.reference_header, cache_dir)
+        self.assertEqual(2, len(os.listdir(cache_dir)))
@@ -1,10 +1,35 @@
+import logging
+import os
+import tempfile
+import time
 from unittest import TestCase
+
+from astropy import units
+from astropy.io import fits
 from . import sns
+from .synthetic import make_exposures
 import numpy
 
 
+def make_rates(rates=((1.0, 0.0), (2.5, 10.0), (4.0, -20.0))):
+    return [{'dra': rate * numpy.cos(numpy.deg2rad(angle)) * units.arcsecond / units.hour,
+             'ddec': rate * numpy.sin(numpy.deg2rad(angle)) * units.arcsecond / units.hour}
+            for rate, angle in rates]
+
+
 class Test(TestCase):
 
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filenames = make_exposures(self.tmpdir.name)
+        self.hdus = [fits.open(filename) for filename in self.filenames]
+        self.reference_hdu = self.hdus[len(self.hdus) // 2]
+
+    def tearDown(self):
+        for hdu in self.hdus:
+            hdu.close()
+        self.tmpdir.cleanup()
+
     def test_weighted_quantile(self):
         n = numpy.random.choice(numpy.arange(50), [50, ], replace=False)
         image_stack = numpy.array([numpy.ones((10, 10))*i for i in n])
@@ -13,3 +38,338 @@ class Test(TestCase):
         self.assertEqual(wq.shape[0], image_stack.shape[1])
         self.assertEqual(wq.shape[1], image_stack.shape[2])
         self.assertAlmostEqual(wq[5, 5], 25, 2)
+
+    def test_blocked_weighted_quantile(self):
+        rng = numpy.random.default_rng(2)
+        values = rng.normal(0, 10, (15, 40, 30)).astype('float32')
+        weights = rng.uniform(0.5, 2.0, values.shape).astype('float32')
+        expected = sns.weighted_quantile(values.copy(), 0.50001, weights.copy())
+        for block_size in [None, 1, 7, 10000]:
+            result = sns.blocked_weighted_quantile(values, 0.50001, weights, block_size=block_size)
+            self.assertEqual(expected.tobytes(), result.tobytes())
+
+    def test_blocked_weighted_quantile_bad_samples(self):
+        values = numpy.array([[1., 1., numpy.nan, 4., numpy.nan],
+                              [2., 3., numpy.nan, 5., numpy.nan],
+                              [3., 2., numpy.nan, 6., 7.]])
+        weights = numpy.array([[1., numpy.inf, 1., 1., 1.],
+                               [1., 1., 1., numpy.nan, 1.],
+                               [10., 1., 1., 1., 1.]])
+        result = sns.blocked_weighted_quantile(values, 0.50001, weights)
+        # inf/nan weights carry no weight, all-nan pixels are nan and a single sample is its own median.
+        numpy.testing.assert_array_equal(result, [3., 3., numpy.nan, 6., 7.])
+
+    def test_blocked_weighted_quantile_benchmark(self):
+        rng = numpy.random.default_rng(3)
+        values = rng.normal(0, 10, (20, 300, 300)).astype('float32')
+        weights = rng.uniform(0.5, 2.0, values.shape).astype('float32')
+        start = time.perf_counter()
+        expected = sns.weighted_quantile(values.copy(), 0.50001, weights.copy())
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = sns.blocked_weighted_quantile(values, 0.50001, weights)
+        blocked_time = time.perf_counter() - start
+        logging.info(f'weighted_quantile: {reference_time:.3f}s blocked_weighted_quantile: {blocked_time:.3f}s')
+        self.assertEqual(expected.tobytes(), result.tobytes())
+
+    def test_shift_multi_rate(self):
+        rates = make_rates()
+        for stacking_mode in ['WEIGHTED_MEDIAN', 'MEAN']:
+            stacks = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=32)
+            self.assertEqual(len(stacks), len(rates))
+            for rate, stack in zip(rates, stacks):
+                single = sns.shift(self.hdus, self.reference_hdu, rate, stacking_mode=stacking_mode, section_size=32)
+                for ext in [1, 2]:
+                    self.assertEqual(single[ext].data.tobytes(), stack[ext].data.tobytes())
+
+    def test_shift_combine_matches_up_sampled_stack(self):
+        rng = numpy.random.default_rng(1)
+        rf = 3
+        images = [rng.normal(0, 10, (20, 24)).astype('float32') for _ in range(4)]
+        variances = [rng.uniform(50, 150, (20, 24)).astype('float32') for _ in range(4)]
+        images[1][rng.random((20, 24)) < 0.1] = numpy.nan
+        offsets = [(0, 0), (4, -7), (-13, 2), (30, -1)]
+        for stacking_mode in ['WEIGHTED_MEDIAN', 'MEDIAN', 'MEAN', 'SUM']:
+            stacking_mode = sns.STACKING_MODES[stacking_mode]
+            outs = [sns.shift_section(numpy.repeat(numpy.repeat(image, rf, axis=0), rf, axis=1), dx, dy)
+                    for image, (dx, dy) in zip(images, offsets)]
+            shifted_variances = [sns.shift_section(numpy.repeat(numpy.repeat(variance, rf, axis=0), rf, axis=1), dx, dy)
+                                 for variance, (dx, dy) in zip(variances, offsets)]
+            expected = [sns.down_sample_2d(stack, rf)[5:15, 3:20]
+                        for stack in sns.combine(outs, shifted_variances, stacking_mode)]
+            result = sns.shift_combine(images, variances, offsets, rf, stacking_mode, (5, 15, 3, 20))
+            for expected_array, result_array in zip(expected, result):
+                self.assertEqual(expected_array.tobytes(), result_array.tobytes())
+
+    def test_pixel_shifts(self):
+        rates = make_rates()
+        geometry = sns.exposure_geometry(self.hdus, self.reference_hdu)
+        dxs, dys = sns.pixel_shifts(geometry, rates, rf=3)
+        self.assertEqual(dxs.shape, (len(rates), len(self.hdus)))
+        reference_mjd = sns.mid_exposure_mjd(self.reference_hdu[0])
+        for rate_idx, rate in enumerate(rates):
+            for idx, hdu in enumerate(self.hdus):
+                # the shift from a full WCS transformation of the rate motion.
+                wcs = sns.WCS(hdu[1].header)
+                dt = sns.mid_exposure_mjd(hdu[0]) - reference_mjd
+                corner = wcs.wcs_pix2world([hdu[1].data.shape], 0)
+                moved = [[corner[0][0] + (rate['dra'] * dt).to_value(units.degree),
+                          corner[0][1] + (rate['ddec'] * dt).to_value(units.degree)]]
+                delta = 3 * (wcs.wcs_world2pix(moved, 0) - wcs.wcs_world2pix(corner, 0))[0]
+                self.assertEqual(dxs[rate_idx, idx], int(delta[0]))
+                self.assertEqual(dys[rate_idx, idx], int(delta[1]))
+
+    def test_shift_in_parallel(self):
+        rates = make_rates()
+        pending = [({'rate': idx, 'angle': 0.0}, rate, os.path.join(self.tmpdir.name, f'STACK-{idx}.fits'))
+                   for idx, rate in enumerate(rates)]
+        written = sns.shift_in_parallel(self.hdus, self.reference_hdu, pending, self.filenames, 2,
+                                        stacking_mode='WEIGHTED_MEDIAN', section_size=32)
+        self.assertEqual(sorted(written), sorted([output_filename for _, _, output_filename in pending]))
+        for _, rate, output_filename in pending:
+            expected = sns.shift(self.hdus, self.reference_hdu, rate, stacking_mode='WEIGHTED_MEDIAN', section_size=32)
+            with fits.open(output_filename) as result:
+                self.assertEqual(result[0].header['NCOMBINE'], len(self.hdus))
+                for ext in [1, 2]:
+                    numpy.testing.assert_array_equal(expected[ext].data, result[ext].data)
+        # the other engines do not stack in parallel, so --workers is refused rather than ignored.
+        for options in [['--tree'], ['--fourier'], ['--swarp'], ['--search-bin', '2'],
+                        ['--incremental', '--stack-mode', 'SUM']]:
+            with self.assertRaises(SystemExit):
+                sns.main([self.tmpdir.name, '--pointing', '0,0', '--workers', '2'] + options)
+
+    def test_detection_maps(self):
+        rng = numpy.random.default_rng(1)
+        snrs = rng.normal(0, 1, (6, 4, 5))
+        snrs[2, 0, 0] = numpy.nan
+        detection_maps = sns.init_detection_maps((4, 5), top_k=3)
+        halves = [sns.init_detection_maps((4, 5), top_k=3) for _ in range(2)]
+        for idx, snr in enumerate(snrs):
+            sns.add_detection(detection_maps, snr, idx, -idx)
+            sns.add_detection(halves[idx % 2], snr, idx, -idx)
+        sns.merge_detection_maps(halves[0], halves[1])
+        order = numpy.argsort(-numpy.where(numpy.isnan(snrs), -numpy.inf, snrs), axis=0, kind='stable')[:3]
+        for result in [detection_maps, halves[0]]:
+            numpy.testing.assert_array_equal(result['snr'], numpy.take_along_axis(snrs, order, axis=0))
+            numpy.testing.assert_array_equal(result['rate'], order)
+            numpy.testing.assert_array_equal(result['angle'], -order)
+
+    def test_shift_in_parallel_detection_maps(self):
+        rates = make_rates()
+        pending = [({'rate': idx, 'angle': 0.0}, rate, os.path.join(self.tmpdir.name, f'STACK-{idx}.fits'))
+                   for idx, rate in enumerate(rates)]
+        detection_maps = sns.init_detection_maps(self.hdus[0][1].data.shape, top_k=2)
+        written = sns.shift_in_parallel(self.hdus, self.reference_hdu, pending, self.filenames, 2,
+                                        section_size=32, detection_maps=detection_maps, keep_snr=1000)
+        self.assertEqual([], written)
+        expected = sns.init_detection_maps(self.hdus[0][1].data.shape, top_k=2)
+        for (rate, _, _), stack in zip(pending, sns.shift(self.hdus, self.reference_hdu, rates, section_size=32)):
+            sns.add_detection(expected, stack[1].data / numpy.sqrt(stack[2].data), rate['rate'], rate['angle'])
+        for key in ['snr', 'rate', 'angle']:
+            numpy.testing.assert_array_equal(expected[key], detection_maps[key])
+
+    def test_tree_shift(self):
+        rates = make_rates()
+        # the same rate twice shares every partial sum.
+        rates.append(rates[0])
+        for stacking_mode in ['SUM', 'MEAN']:
+            expected = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=32)
+            result = sns.tree_shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode,
+                                    section_size=32)
+            for expected_stack, result_stack in zip(expected, result):
+                for ext in [1, 2]:
+                    numpy.testing.assert_allclose(expected_stack[ext].data, result_stack[ext].data, rtol=1e-5,
+                                                  atol=1e-4)
+
+    def test_tree_combine_excluded(self):
+        # exposures shifted by more than MAX_SHIFT are left out, here the first half of some of the rates, which then
+        # share the partial sums of the second half with rates that keep every exposure.
+        rng = numpy.random.default_rng(2)
+        images = [rng.normal(100, 10, (20, 24)) for _ in range(6)]
+        variances = [rng.uniform(1, 20, (20, 24)) for _ in range(6)]
+        late = [(0, 0), (1, 2), (2, 4)]
+        rate_offsets = [[None] * 3 + late, [(-3, -6), (-2, -4), (-1, -2)] + late, [None] * 3 + late,
+                        [(-6, -3), (-4, -2), (-2, -1)] + late]
+        for stacking_mode in [numpy.nansum, numpy.nanmean]:
+            result = sns.tree_combine(images, variances, rate_offsets, list(range(6)), 3, stacking_mode,
+                                      (0, 20, 0, 24))
+            for offsets, (data, variance) in zip(rate_offsets, result):
+                kept = [idx for idx, offset in enumerate(offsets) if offset is not None]
+                expected = sns.shift_combine([images[idx] for idx in kept], [variances[idx] for idx in kept],
+                                             [offsets[idx] for idx in kept], 3, stacking_mode, (0, 20, 0, 24))
+                numpy.testing.assert_allclose(expected[0], data, rtol=1e-10)
+                numpy.testing.assert_allclose(expected[1], variance, rtol=1e-10)
+
+    def test_fourier_combine(self):
+        yy, xx = numpy.mgrid[0:64, 0:64]
+
+        def gaussian(x, y):
+            return 100 * numpy.exp(-((xx - x)**2 + (yy - y)**2) / 8.0)
+
+        shifts = [(2.0, -3.0), (0.5, 0.25)]
+        image = gaussian(30, 32)
+        image[5, 5] = numpy.nan
+        variance = numpy.ones(image.shape)
+        for stacking_mode in [numpy.nanmean, numpy.nansum]:
+            stacks = sns.fourier_combine([image], [variance], [[shift] for shift in shifts], stacking_mode,
+                                         (0, 64, 0, 64), 8)
+            for (dx, dy), (data, stacked_variance) in zip(shifts, stacks):
+                numpy.testing.assert_allclose(data[16:48, 16:48], gaussian(30 + dx, 32 + dy)[16:48, 16:48],
+                                              atol=1e-3)
+                numpy.testing.assert_allclose(stacked_variance[16:48, 16:48], 1, atol=1e-3)
+        # the zero padding keeps a shift from wrapping around the section.
+        data, stacked_variance = sns.fourier_combine([image], [variance], [[(8.0, 0.0)]], numpy.nanmean,
+                                                     (0, 64, 0, 64), 8)[0]
+        self.assertTrue(numpy.isnan(data[:, :7]).all())
+
+    def test_fourier_shift(self):
+        dirname = os.path.join(self.tmpdir.name, 'source')
+        os.mkdir(dirname)
+        filenames = make_exposures(dirname, shape=(128, 128), source={'x': 50, 'y': 70, 'rate': 3.0, 'flux': 60})
+        hdus = [fits.open(filename) for filename in filenames]
+        rates = [sns.sky_motion(rate) for rate in sns.shift_rates(3, 3, 1, 0, 0, 1)]
+        expected = sns.shift(hdus, hdus[2], rates, stacking_mode='MEAN', section_size=64)[0]
+        result = sns.fourier_shift(hdus, hdus[2], rates, stacking_mode='MEAN', section_size=64)[0]
+        # the source is at x = 58.57 in the reference exposure.
+        y, x = numpy.unravel_index(numpy.nanargmax(result[1].data), result[1].data.shape)
+        self.assertEqual(70, y)
+        self.assertLess(abs(x - 58.57), 1)
+        # exact shifts do not blur the source as the rf quantized shifts do.
+        self.assertGreater(numpy.nanmax(result[1].data), numpy.nanmax(expected[1].data))
+        numpy.testing.assert_allclose(numpy.nanmedian(result[2].data), numpy.nanmedian(expected[2].data), rtol=0.05)
+
+    def test_swarp(self):
+        rate = sns.sky_motion({'rate': 2.5, 'angle': 0.0})
+        cache_dir = os.path.join(self.tmpdir.name, 'maps')
+        for stacking_mode in ['MEAN', 'MEDIAN', 'WEIGHTED_MEDIAN']:
+            expected = sns.swarp(self.hdus, self.reference_hdu, rate, stacking_mode=stacking_mode)
+            result = sns.swarp(self.hdus, self.reference_hdu, rate, stacking_mode=stacking_mode, cache_dir=cache_dir,
+                               section_size=16)
+            for ext in [1, 2]:
+                self.assertEqual(expected[ext].data.tobytes(), result[ext].data.tobytes())
+        # the exposures share a WCS, so without motion swarp stacks the masked images pixel by pixel.
+        result = sns.swarp(self.hdus, self.reference_hdu, None, stacking_mode='MEAN', section_size=32)
+        images = [sns.mask_as_nan(hdu[1].data.astype(float), hdu[2].data) for hdu in self.hdus]
+        numpy.testing.assert_allclose(result[1].data, numpy.nanmean(images, axis=0))
+        numpy.testing.assert_allclose(result[2].data, numpy.mean([hdu[3].data for hdu in self.hdus], axis=0) /
+                                      numpy.sum(~numpy.isnan(images), axis=0), rtol=1e-6)
+
+    def test_shift_threads(self):
+        rates = make_rates()
+        for stacking_mode in sns.STACKING_MODES:
+            expected = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=16)
+            result = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=16,
+                               threads=4)
+            for expected_stack, result_stack in zip(expected, result):
+                for ext in [1, 2]:
+                    self.assertEqual(expected_stack[ext].data.tobytes(), result_stack[ext].data.tobytes())
+
+    def test_shift_float32(self):
+        rates = make_rates()
+        for stacking_mode in sns.STACKING_MODES:
+            expected = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=32)
+            result = sns.shift(self.hdus, self.reference_hdu, rates, stacking_mode=stacking_mode, section_size=32,
+                               dtype=numpy.float32)
+            for expected_stack, result_stack in zip(expected, result):
+                for ext in [1, 2]:
+                    self.assertEqual(numpy.dtype(numpy.float32), result_stack[ext].data.dtype)
+                    numpy.testing.assert_allclose(expected_stack[ext].data, result_stack[ext].data, rtol=1e-5,
+                                                  atol=1e-4)
+
+    def test_hierarchical_search(self):
+        dirname = os.path.join(self.tmpdir.name, 'source')
+        os.mkdir(dirname)
+        filenames = make_exposures(dirname, shape=(128, 128),
+                                   source={'x': 50, 'y': 70, 'rate': 3.0, 'flux': 60})
+        hdus = [fits.open(filename) for filename in filenames]
+        rates = sns.shift_rates(1, 4, 0.5, -10, 10, 5)
+        coarse_rates = sns.shift_rates(1, 4, 1, -10, 10, 10)
+        self.assertEqual([], list(sns.hierarchical_search(hdus, hdus[2], rates, coarse_rates, threshold=1000,
+                                                          section_size=32)))
+        results = list(sns.hierarchical_search(hdus, hdus[2], rates, coarse_rates, threshold=8, stacking_mode='MEAN',
+                                               section_size=32))
+        # refining the rates of a coarse cell in batches gives the same stacks.
+        batched = list(sns.hierarchical_search(hdus, hdus[2], rates, coarse_rates, threshold=8, stacking_mode='MEAN',
+                                               section_size=32, batch_size=1))
+        self.assertEqual([rate for rate, output in results], [rate for rate, output in batched])
+        for (_, output), (_, batched_output) in zip(results, batched):
+            numpy.testing.assert_array_equal(output[1].data, batched_output[1].data)
+        self.assertIn({'rate': 3.0, 'angle': 0.0}, [rate for rate, output in results])
+        expected = sns.shift(hdus, hdus[2], [sns.sky_motion(rate) for rate, output in results], stacking_mode='MEAN',
+                             section_size=32)
+        for (rate, output), expected_stack in zip(results, expected):
+            # only the 32x32 section holding the source is refined.
+            self.assertEqual(1, output[0].header['SRCHSECT'])
+            refined = numpy.isfinite(output[1].data)
+            self.assertTrue(refined[70, 50])
+            self.assertFalse(refined[:64].any())
+            numpy.testing.assert_array_equal(expected_stack[1].data[64:96, 32:64], output[1].data[64:96, 32:64])
+            numpy.testing.assert_array_equal(expected_stack[2].data[64:96, 32:64], output[2].data[64:96, 32:64])
+
+    def test_pack_mask(self):
+        rng = numpy.random.default_rng(1)
+        bitmask = rng.integers(-2**31, 2**31, (40, 50), dtype='int64').astype('>i4')
+        packed = sns.pack_mask(bitmask)
+        self.assertEqual(numpy.uint8, packed.dtype)
+        for bit, name in enumerate(sns.PACKED_MASK_BITS):
+            numpy.testing.assert_array_equal((bitmask >> sns.LSST_MASK_BITS[name]) & 1, (packed >> bit) & 1)
+        numpy.testing.assert_array_equal(packed, sns.pack_mask(sns.unpack_mask(packed)))
+        numpy.testing.assert_array_equal((bitmask & sum(sns.STACK_MASK)) != 0, (packed & sns.PACKED_STACK_MASK) != 0)
+
+    def test_preprocess_exposures(self):
+        images = [hdu[1].data.copy() for hdu in self.hdus]
+        variances = [hdu[3].data.copy() for hdu in self.hdus]
+        median_variances = sns.preprocess_exposures(self.hdus, clip=1, mask=True)
+        for hdu, image, variance, mvar in zip(self.hdus, images, variances, median_variances):
+            self.assertEqual(numpy.nanmedian(variance), mvar)
+            # masked pixels and the high variance pixels of detected sources.
+            bitmask = hdu[2].data
+            masked = (((bitmask & sum(sns.STACK_MASK)) != 0) |
+                      ((variance > mvar) & ((bitmask & 2**sns.LSST_MASK_BITS['DETECTED']) != 0)))
+            self.assertTrue(masked.any())
+            numpy.testing.assert_array_equal(numpy.isnan(image) | masked, numpy.isnan(hdu[1].data))
+            numpy.testing.assert_array_equal(masked, numpy.isnan(hdu[3].data))
+            numpy.testing.assert_array_equal(image[~masked], hdu[1].data[~masked])
+
+    def test_exposure_cube(self):
+        cache_dir = os.path.join(self.tmpdir.name, 'CUBE-000')
+        self.assertFalse(sns.exposure_cube_is_current(self.filenames, cache_dir))
+        sns.build_exposure_cube(self.filenames, cache_dir)
+        self.assertTrue(sns.exposure_cube_is_current(self.filenames, cache_dir))
+        hdus = sns.load_exposure_cube(cache_dir, self.filenames)
+        for hdu, cube_hdu in zip(self.hdus, hdus):
+            self.assertEqual(hdu[0].header['FRAMEID'], cube_hdu[0].header['FRAMEID'])
+            numpy.testing.assert_array_equal(hdu[1].data, cube_hdu[1].data)
+            numpy.testing.assert_array_equal(hdu[3].data, cube_hdu[3].data)
+            # the mask stays packed, and memory mapped, until used.
+            self.assertIsInstance(cube_hdu[2].data, numpy.memmap)
+            self.assertIs(cube_hdu[2].data, sns.pack_masks([cube_hdu])[0])
+            for flags in [sns.STACK_MASK, sns.LSST_MASK_BITS['DETECTED']]:
+                numpy.testing.assert_array_equal(
+                    sns.bitfield_to_boolean_mask(hdu[2].data, ignore_flags=flags, flip_bits=True),
+                    sns.bitfield_to_boolean_mask(sns.unpack_mask(cube_hdu[2].data), ignore_flags=flags,
+                                                 flip_bits=True))
+        rates = make_rates()
+        expected = sns.shift(self.hdus, self.reference_hdu, rates, section_size=32)
+        result = sns.shift(hdus, hdus[len(hdus) // 2], rates, section_size=32)
+        for expected_stack, result_stack in zip(expected, result):
+            numpy.testing.assert_array_equal(expected_stack[1].data, result_stack[1].data)
+        # masking a loaded exposure does not change the cube.
+        hdus[0][1].data[:] = numpy.nan
+        numpy.testing.assert_array_equal(self.hdus[0][1].data, sns.load_exposure_cube(cache_dir)[0][1].data)
+        os.utime(self.filenames[0], (0, 0))
+        self.assertFalse(sns.exposure_cube_is_current(self.filenames, cache_dir))
+
+    def test_preprocessed_exposure_cube(self):
+        cache_dir = os.path.join(self.tmpdir.name, 'CUBE-000')
+        median_variances = sns.build_exposure_cube(self.filenames, cache_dir, clip=2, mask=True,
+                                                   median_variances=[None, 1.0] + [None] * (len(self.filenames) - 2))
+        self.assertEqual(1.0, median_variances[1])
+        self.assertFalse(sns.exposure_cube_is_current(self.filenames, cache_dir))
+        self.assertTrue(sns.exposure_cube_is_current(self.filenames, cache_dir, clip=2, mask=True))
+        self.assertEqual(median_variances, sns.preprocess_exposures(self.hdus, clip=2, mask=True,
+                                                                    median_variances=median_variances))
+        for hdu, cube_hdu in zip(self.hdus, sns.load_exposure_cube(cache_dir)):
+            self.assertNotIn('MVAR', cube_hdu[3].header)
+            numpy.testing.assert_array_equal(hdu[1].data, cube_hdu[1].data)
+            numpy.testing.assert_array_equal(hdu[3].data, cube_hdu[3].data)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from . import instrument, sns, sns_batch
+from .synthetic import make_exposures
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.basedir = self.tmpdir.name
+        for pointing in ['0,0', '0,1']:
+            dirname = os.path.join(self.basedir, 'rerun', 'diff', 'deepDiff', pointing, 'HSC-R2')
+            os.makedirs(dirname)
+            make_exposures(dirname, n=4)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run_batch(self):
+        published = []
+        sns_args = ['--rerun', 'diff:stack', '--n-sub-stacks', '1', '--stack-mode', 'MEAN',
+                    '--rate-min', '1', '--rate-max', '2', '--rate-step', '1',
+                    '--angle-min', '0', '--angle-max', '0', '--angle-step', '1']
+        failed = sns_batch.run_batch(self.basedir, ['0,0', '0,1', '1,1'], [0], sns_args, publish=published.append)
+        # there are no images of pointing 1,1
+        self.assertEqual([('1,1', 0)], failed)
+        self.assertEqual(4, len(published))
+        for pointing in ['0,0', '0,1']:
+            output_dir = os.path.join(self.basedir, 'rerun', 'stack', 'deepDiff', pointing, 'HSC-R2')
+            self.assertEqual(2, len([filename for filename in published if filename.startswith(output_dir)]))
+
+    def test_run_batch_failure(self):
+        def annotate_stack(*args):
+            raise ValueError('Stacking failed')
+        sns_args = ['--rerun', 'diff:stack', '--n-sub-stacks', '1', '--stack-mode', 'MEAN',
+                    '--rate-min', '1', '--rate-max', '2', '--rate-step', '1',
+                    '--angle-min', '0', '--angle-max', '0', '--angle-step', '1',
+                    '--timing-report', os.path.join(self.basedir, 'timing-{pointing}.json')]
+        n_threads = threading.active_count()
+        # fail the stacking while the background writer runs.
+        sns.annotate_stack, original = annotate_stack, sns.annotate_stack
+        try:
+            failed = sns_batch.run_batch(self.basedir, ['0,0', '0,1'], [0], sns_args)
+        finally:
+            sns.annotate_stack = original
+        self.assertEqual([('0,0', 0), ('0,1', 0)], failed)
+        # the writers of the failed CCDs are stopped and their timings are not carried on.
+        self.assertEqual(n_threads, threading.active_count())
+        self.assertIsNone(instrument.PROFILE)
+
+    def test_command_publisher(self):
+        filename = os.path.join(self.basedir, 'STACK file.fits')
+        destination = os.path.join(self.basedir, 'published')
+        os.mkdir(destination)
+        with open(filename, 'w') as fobj:
+            fobj.write('stack')
+        publish = sns_batch.command_publisher(f'cp {{filename}} {destination}/', delete=True)
+        publish(filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(['STACK file.fits'], os.listdir(destination))
+        with self.assertRaises(OSError):
+            sns_batch.command_publisher('false', retries=2)(filename)
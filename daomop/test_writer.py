@@ -0,0 +1,66 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+
+from . import sns, writer
+
+
+def make_stack(seed=0):
+    rng = numpy.random.default_rng(seed)
+    return sns.stack_hdu_list(fits.Header(), fits.Header(), fits.Header(),
+                              rng.normal(0, 10, (40, 50)), rng.uniform(50, 150, (40, 50)))
+
+
+class InterruptedHDUList(fits.HDUList):
+    """
+    HDUList whose write fails half way, like a full disk.
+    """
+
+    def writeto(self, fileobj, **kwargs):
+        with open(fileobj, 'wb') as fobj:
+            fobj.write(b'SIMPLE')
+        raise OSError('No space left on device')
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_atomic_writeto(self):
+        filename = os.path.join(self.tmpdir.name, 'STACK.fits')
+        stack = make_stack()
+        writer.atomic_writeto(stack, filename, dtype='float32', compression_type='RICE_1')
+        self.assertEqual(['STACK.fits'], os.listdir(self.tmpdir.name))
+        with fits.open(filename) as result:
+            self.assertEqual(['PRIMARY', 'STACK', 'VARIANCE'], [hdu.name for hdu in result])
+            self.assertEqual(numpy.float32, result[1].data.dtype)
+            numpy.testing.assert_allclose(stack[1].data, result[1].data, atol=1.0)
+            numpy.testing.assert_allclose(stack[2].data, result[2].data, atol=20.0)
+        # a failed write leaves neither the output nor its temporary file.
+        with self.assertRaises(OSError):
+            writer.atomic_writeto(InterruptedHDUList(stack), os.path.join(self.tmpdir.name, 'FAILED.fits'))
+        self.assertEqual(['STACK.fits'], os.listdir(self.tmpdir.name))
+
+    def test_writer(self):
+        stack_writer = writer.start_writer(queue_size=1, dtype='float32')
+        filenames = [os.path.join(self.tmpdir.name, f'STACK-{idx}.fits') for idx in range(4)]
+        stacks = [make_stack(idx) for idx in range(4)]
+        for stack, filename in zip(stacks, filenames):
+            writer.submit_write(stack_writer, stack, filename)
+        writer.close_writer(stack_writer)
+        self.assertEqual(sorted(os.path.basename(filename) for filename in filenames),
+                         sorted(os.listdir(self.tmpdir.name)))
+        for stack, filename in zip(stacks, filenames):
+            numpy.testing.assert_array_equal(stack[1].data.astype('float32'), fits.getdata(filename, 1))
+        # a failed write is raised when the writer is closed.
+        stack_writer = writer.start_writer(queue_size=1)
+        writer.submit_write(stack_writer, stacks[0], os.path.join(self.tmpdir.name, 'missing', 'STACK.fits'))
+        with self.assertRaises(OSError):
+            writer.close_writer(stack_writer)
@@ -0,0 +1,139 @@
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+from .instrument import record, stage
+
+COMPRESSION_TYPES = ['RICE_1', 'HCOMPRESS_1']
+
+# quantization of the floating point data when compressing, the noise of each tile is sampled this many times.
+STACK_QUANTIZE_LEVEL = 64
+VARIANCE_QUANTIZE_LEVEL = 4
+
+
+def prepare_hdu_list(hdu_list, dtype=None, compression_type=None):
+    """
+    Convert the image extensions of a stack for writing.
+
+    :param hdu_list: stack HDUList, primary followed by the image (STACK) and VARIANCE extensions.
+    :param dtype: data type to cast the images to (e.g. float32), None keeps the data type.
+    :param compression_type: one of COMPRESSION_TYPES to tile compress the image extensions, the variance is
+                             quantized more coarsely than the stack.
+    :return: HDUList to write.
+    """
+    if dtype is None and compression_type is None:
+        return hdu_list
+    result = fits.HDUList([hdu_list[0]])
+    for hdu in hdu_list[1:]:
+        data = hdu.data if dtype is None else hdu.data.astype(dtype)
+        if compression_type is None:
+            result.append(fits.ImageHDU(data=data, header=hdu.header))
+            continue
+        quantize_level = VARIANCE_QUANTIZE_LEVEL if hdu.name == 'VARIANCE' else STACK_QUANTIZE_LEVEL
+        result.append(fits.CompImageHDU(data=data, header=hdu.header, compression_type=compression_type,
+                                        quantize_level=quantize_level))
+    return result
+
+
+def atomic_writeto(hdu_list, filename, dtype=None, compression_type=None):
+    """
+    Write hdu_list to a temporary file next to filename and rename it into place.
+
+    filename existing means the write completed, a failed write removes its temporary file.
+
+    :param hdu_list: stack HDUList
+    :param filename: name to write to
+    :param dtype: see prepare_hdu_list
+    :param compression_type: see prepare_hdu_list
+    """
+    temporary_filename = f'{filename}.part'
+    with stage('write'):
+        try:
+            prepare_hdu_list(hdu_list, dtype, compression_type).writeto(temporary_filename, overwrite=True)
+            os.replace(temporary_filename, filename)
+        except BaseException:
+            if os.path.exists(temporary_filename):
+                os.unlink(temporary_filename)
+            raise
+    record('write', bytes_written=os.path.getsize(filename))
+    logging.debug(f'Wrote {filename}')
+
+
+def writer_loop(writer):
+    """
+    Write the (hdu_list, filename) entries of the writer queue until the None sentinel arrives.
+    """
+    while True:
+        entry = writer['queue'].get()
+        if entry is None:
+            return
+        if writer['errors']:
+            # keep draining the queue so the compute thread does not block, the first error is raised on close.
+            continue
+        try:
+            atomic_writeto(*entry, dtype=writer['dtype'], compression_type=writer['compression_type'])
+            publish_file(writer, entry[1])
+        except Exception as ex:
+            logging.error(f'Failed writing {entry[1]}: {ex}')
+            writer['errors'].append(ex)
+
+
+def start_writer(queue_size=2, dtype=None, compression_type=None, publish=None):
+    """
+    Start a writer that writes stacks on a background thread while the next stacks are computed.
+
+    :param queue_size: number of stacks that may wait to be written, submitting blocks when the queue is full.
+                       0 writes each stack when it is submitted.
+    :param dtype: see prepare_hdu_list
+    :param compression_type: see prepare_hdu_list
+    :param publish: function called with the filename of each file once it is written, e.g. to copy it elsewhere.
+    :return: writer dictionary, pass to submit_write and close_writer.
+    """
+    writer = {'queue': None, 'thread': None, 'errors': [], 'publish': publish,
+              'dtype': None if dtype is None else np.dtype(dtype), 'compression_type': compression_type}
+    if queue_size > 0:
+        writer['queue'] = queue.Queue(maxsize=queue_size)
+        writer['thread'] = threading.Thread(target=writer_loop, args=(writer,), daemon=True)
+        writer['thread'].start()
+    return writer
+
+
+def submit_write(writer, hdu_list, filename):
+    """
+    Queue hdu_list to be written to filename, hdu_list must not be modified afterwards.
+    """
+    if writer['errors']:
+        raise writer['errors'][0]
+    if writer['queue'] is None:
+        atomic_writeto(hdu_list, filename, dtype=writer['dtype'], compression_type=writer['compression_type'])
+        publish_file(writer, filename)
+    else:
+        writer['queue'].put((hdu_list, filename))
+
+
+def publish_file(writer, filename):
+    """
+    Pass a file that has been written to the publish function of writer, if it has one.
+    """
+    if writer['publish'] is not None:
+        logging.debug(f'Publishing {filename}')
+        writer['publish'](filename)
+
+
+def close_writer(writer, raise_errors=True):
+    """
+    Wait for the queued stacks to be written, raising the first error of the writer thread.
+
+    :param writer: writer from start_writer
+    :param raise_errors: False only stops the writer thread, e.g. when the run is already failing.
+    """
+    if writer['thread'] is not None:
+        writer['queue'].put(None)
+        writer['thread'].join()
+        writer['thread'] = None
+    if raise_errors and writer['errors']:
+        raise writer['errors'][0]
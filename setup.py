@@ -13,8 +13,10 @@ setup(
     entry_points={
         "console_scripts": [
             "daomop-sns = daomop.sns:main",
+            "daomop-sns-batch = daomop.sns_batch:main",
             "daomop-train-cnn = daomop.train_model:main",
             "daomop-build-plant-db = daomop.build_plant_list_db:main",
+            "daomop-benchmark = daomop.benchmark:main",
         ],
     }
 )